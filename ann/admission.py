@@ -0,0 +1,147 @@
+# admission.py
+#
+# Resource-aware admission of annotation jobs
+#
+# The poller runs several jobs at once on the worker pool. Before taking a
+# job it asks Admission whether the instance has room for it: a free worker
+# (the pool is sized from the CPU count) and enough available memory and
+# local disk for the job's estimated footprint, derived from the size of its
+# input (S3 object metadata). Footprints of admitted jobs stay reserved until
+# they finish, so the instance stays busy but is never oversubscribed. A few
+# jobs may be admitted beyond the workers so their inputs download while the
+# running jobs annotate.
+#
+##
+
+import logging
+import os
+
+import reference as ref
+
+# Estimated footprint per input byte: the stages keep two intermediate files
+# plus the growing annotated output on disk; memory is dominated by lookups
+DISK_PER_INPUT_BYTE = ref.config.getfloat("ann", "AdmitDiskPerInputByte", fallback=4.0)
+MEMORY_PER_INPUT_BYTE = ref.config.getfloat(
+    "ann", "AdmitMemoryPerInputByte", fallback=1.0
+)
+MEMORY_PER_JOB = ref.config.getint(
+    "ann", "AdmitMemoryPerJob", fallback=256 * 1024 * 1024
+)
+
+# Jobs admitted beyond the workers, whose inputs are downloaded ahead while
+# the running jobs annotate, and the disk their waiting inputs may take
+PREFETCH_JOBS = ref.config.getint("ann", "PrefetchJobs", fallback=1)
+PREFETCH_BYTES = ref.config.getint(
+    "ann", "PrefetchDiskBytes", fallback=1024 * 1024 * 1024
+)
+
+# Share of the instance's memory and of the disk the jobs may reserve
+HEADROOM = ref.config.getfloat("ann", "AdmitHeadroom", fallback=0.8)
+
+
+def _meminfo(field):
+    try:
+        with open("/proc/meminfo") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def totalMemory():
+    return _meminfo("MemTotal")
+
+
+def availableMemory():
+    return _meminfo("MemAvailable")
+
+
+def diskSize(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def freeDisk(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class Admission(object):
+    def __init__(
+        self, slots, path, prefetch=PREFETCH_JOBS, prefetch_bytes=PREFETCH_BYTES
+    ):
+        self.slots = max(1, int(slots))
+        self.path = path
+        self.prefetch = max(0, int(prefetch))
+        self.prefetch_bytes = prefetch_bytes
+        # job_id -> [memory, disk, holds a worker slot]
+        self.reserved = {}
+
+    def estimate(self, size):
+        size = max(0, int(size))
+        return (
+            MEMORY_PER_JOB + int(size * MEMORY_PER_INPUT_BYTE),
+            int(size * DISK_PER_INPUT_BYTE),
+        )
+
+    def active(self):
+        return len([r for r in self.reserved.values() if r[2]])
+
+    """Jobs that can be taken now: one per worker plus the prefetch allowance
+    """
+
+    def free(self):
+        return self.slots + self.prefetch - self.active()
+
+    """Reserves room for the job and returns True when it fits next to the
+       jobs already admitted; a job is always admitted on an idle instance so
+       a large input cannot starve. The reservations together are held to the
+       instance's capacity (MemTotal, the disk's size): available memory and
+       free disk already leave out what the running jobs use, so they only
+       bound the new job's own footprint. When every worker is taken the job
+       is a prefetch: its input is downloaded ahead and waits for a worker, so
+       inputs waiting (queued_bytes) plus its own must fit the prefetch budget
+    """
+
+    def admit(self, job_id, size, queued_bytes=0):
+        if self.free() <= 0:
+            return False
+        if self.active() >= self.slots and queued_bytes + size > self.prefetch_bytes:
+            logging.info(f"Deferring job {job_id}: prefetch budget used")
+            return False
+        memory, disk = self.estimate(size)
+        if len(self.reserved) > 0:
+            reserved_memory = sum([r[0] for r in self.reserved.values()])
+            reserved_disk = sum([r[1] for r in self.reserved.values()])
+            total = totalMemory()
+            available = availableMemory()
+            if (total is not None and reserved_memory + memory > total * HEADROOM) or (
+                available is not None and memory > available * HEADROOM
+            ):
+                logging.info(f"Deferring job {job_id}: not enough memory")
+                return False
+            if (
+                reserved_disk + disk > diskSize(self.path) * HEADROOM
+                or disk > freeDisk(self.path) * HEADROOM
+            ):
+                logging.info(f"Deferring job {job_id}: not enough disk")
+                return False
+        self.reserved[job_id] = [memory, disk, True]
+        return True
+
+    """The job is annotated and only uploading: it gives back its worker
+       slot and memory, and keeps its disk until released
+    """
+
+    def annotated(self, job_id):
+        if job_id in self.reserved:
+            self.reserved[job_id][0] = 0
+            self.reserved[job_id][2] = False
+
+    def release(self, job_id):
+        self.reserved.pop(job_id, None)
+
+
+### EOF
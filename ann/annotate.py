@@ -10,12 +10,30 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import contextlib
+
 import file_utils as fu
+import lookups as lk
 import utils as u
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
 
+"""Opens a stage's database connection and cursor on stack (the stage's
+   ExitStack), which closes them after the stage's lookups however the
+   stage ends, so a failed job leaves no threads or connections behind in
+   its long-lived worker
+"""
+
+
+def openCursor(stack):
+    conn = u.db_connect()
+    stack.callback(conn.close)
+    cursor = conn.cursor()
+    stack.callback(cursor.close)
+    return cursor
+
+
 def collapseGeneNames(row, indices, region, cnt):
     names = [
         "bin",
@@ -110,6 +128,17 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1  # NOT_FOUND
 
 
+"""Text column value; MySQL returns BLOB columns (e.g. exonStarts) as bytes,
+   the local index as str
+"""
+
+
+def asText(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
 """Cleans characters not accepted by MySQL
 """
 
@@ -153,7 +182,13 @@ def getComplementary(nuc):
 
 
 def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
+    sep="\t",
+    source=None,
 ):
 
     outfile = vcf + tmpextout
@@ -164,82 +199,77 @@ def getSnpsFromDbSnp(
 
     inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
-
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+    # source: lines of an input streamed from elsewhere (e.g. s3_stream)
+    fh = open(vcf) if source is None else source
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        dbsnp = stack.enter_context(lk.openLookup("dbSNP", cursor))
+        linenum = 1
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+        for line in fh:
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+                if chr.startswith("chr"):
+                    chr = chr.replace("chr", "")
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+                compRef = getComplementary(ref)
+                compAlt = getComplementary(alt)
+
+                rows = dbsnp.fetch(
+                    chr,
+                    pos,
+                    match=[
+                        {"REF": ref, "INFO": varclass},
+                        {"REF": compRef, "INFO": varclass},
+                    ],
+                )
 
-            linenum = linenum + 1
+                fields[2] = "."
+                rsids = []
+                mafs = []
+                if len(rows) > 0:
+                    for row in rows:
+                        rsids.append(str(row[3]))
+                        if str(row[7]) != ".":
+                            mafs.append("GMAF=" + str(row[7]))
 
-        else:
-            fh_out.write(line + "\n")
+                    maf_str = ""
+                    if len(mafs) > 0:
+                        maf_str = ";" + ";".join([str(x) for x in mafs])
+
+                    var_count = var_count + 1
+                    if str(fields[7]) == ".":
+                        fields[7] = "DB" + maf_str
+                    else:
+                        fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+                    fields[2] = str(";".join(rsids))
+                    l = "\t".join([str(x) for x in fields])
+                    fh_out.write(l + "\n")
+
+                else:
+                    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+                    fh_out.write("\t".join([str(x) for x in fields]) + "\n")
 
-    conn.close()
+                linenum = linenum + 1
+
+            else:
+                fh_out.write(line + "\n")
+
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+        fh_log.close()
+
+        u.logStageMetrics(vcf, dbsnp.stats())
     fh.close()
     fh_out.close()
 
@@ -259,81 +289,39 @@ def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
-
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
-
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
-
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
-
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        equal_base = stack.enter_context(lk.openLookup("chrom_pos_equal_base", cursor))
+        equal_nobase = stack.enter_context(
+            lk.openLookup("chrom_pos_equal_nobase", cursor)
+        )
+        unequal = stack.enter_context(lk.openLookup("chrom_pos_unequal", cursor))
+        vcf_linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+                if chr.startswith("chr"):
+                    chr = chr.replace("chr", "")
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+                compRef = getComplementary(ref)
+                compAlt = getComplementary(alt)
+
+                keep_going = True
+                rows = equal_base.fetch(
+                    chr,
+                    pos,
+                    match=[
+                        {"haplotypeReference": ref, "haplotypeAlternate": alt},
+                        {"haplotypeReference": compRef, "haplotypeAlternate": compAlt},
+                    ],
+                )
 
                 if len(rows) > 0:
                     keep_going = False
@@ -352,36 +340,57 @@ def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
                     l = "\t".join([str(x) for x in fields])
                     fh_out.write(l + "\n")
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+                if keep_going:
+                    rows = equal_nobase.fetch(chr, pos)
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
+                    if len(rows) > 0:
+                        keep_going = False
+                        m = set([])
+                        for row in rows:
+                            m.add(
+                                collapseRefSeq(
+                                    "\t".join([str(x) for x in row[1 : len(row)]])
+                                )
                             )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+                        fields[7] = fields[7] + ";" + ";".join(m)
+                        if str(fields[7]).startswith(".;"):
+                            fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+                        l = "\t".join([str(x) for x in fields])
+                        fh_out.write(l + "\n")
 
-            if keep_going:
-                fh_out.write(line + "\n")
+                if keep_going:
+                    rows = unequal.fetch(chr, pos)
 
-            vcf_linenum = vcf_linenum + 1
+                    if len(rows) > 0:
+                        keep_going = False
+                        m = set([])
+                        for row in rows:
+                            m.add(
+                                collapseRefSeq(
+                                    "\t".join([str(x) for x in row[1 : len(row)]])
+                                )
+                            )
 
-        else:
-            fh_out.write(line + "\n")
+                        fields[7] = fields[7] + ";" + ";".join(m)
+                        if str(fields[7]).startswith(".;"):
+                            fields[7] = str(fields[7]).replace(".;", "", 1)
+
+                        l = "\t".join([str(x) for x in fields])
+                        fh_out.write(l + "\n")
+
+                if keep_going:
+                    fh_out.write(line + "\n")
+
+                vcf_linenum = vcf_linenum + 1
 
-    conn.close()
+            else:
+                fh_out.write(line + "\n")
+
+        u.logStageMetrics(basefile, equal_base.stats())
+        u.logStageMetrics(basefile, equal_nobase.stats())
+        u.logStageMetrics(basefile, unequal.stats())
     fh.close()
     fh_out.close()
 
@@ -420,215 +429,192 @@ def getGenes(
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        genes = stack.enter_context(
+            lk.openLookup(
+                table, cursor, pad=promoter_offset, start_col="txStart", end_col="txEnd"
             )
+        )
+        cpg_islands = stack.enter_context(lk.openLookup("cpgIslandExt", cursor))
+        linenum = 1
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
-
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+        for line in fh:
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
 
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
+                info_field = clean_mysql_chars(fields[7]).strip()
+                this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
 
-                    else:
+                rows = genes.fetch(chr, pos)
+                info = []
+
+                if len(rows) > 0:
+                    cnt = 1
+                    for row in rows:
+                        # count location
+                        positionType = str(
+                            u.parse_field(info_field, "positionType", ";", "=")
+                        )
+
+                        if positionType == "intron":
+                            intronic_count = intronic_count + 1
+                        elif positionType == "non_coding_intron":
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                        elif positionType == "CDS":
+                            cds_count = cds_count + 1
+                        elif positionType == "non_coding_exon":
+                            non_coding_exonic_count = non_coding_exonic_count + 1
+                        elif positionType == "utr5":
+                            utr5_count = utr5_count + 1
+                        elif positionType == "utr3":
+                            utr3_count = utr3_count + 1
+
+                        txtStart = int(row[4])
+                        txtEnd = int(row[5])
+                        cdsStart = int(row[6])
+                        cdsEnd = int(row[7])
+                        exonCount = int(row[8])
+                        exonStarts = asText(row[9])
+                        exonEnds = asText(row[10])
+                        geneSymbol = str(row[12])
+                        strand = str(row[3])
+
+                        promoter_plus = txtStart - int(promoter_offset)
+                        promoter_minus = txtEnd + int(promoter_offset)
                         region = ""
+                        pos = int(pos)
+                        exons = []
+                        exonsSt = exonStarts.split(",")
+                        exonsEn = exonEnds.split(",")
+
+                        if cdsStart == cdsEnd:
+                            for e in range(0, exonCount):
+                                if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                                    exnum = e + 1
+                                    if strand == "-":
+                                        exnum = exonCount - e
+                                    exons.append(
+                                        "non_coding_exon="
+                                        + "ex"
+                                        + str(exnum)
+                                        + "/"
+                                        + str(exonCount)
+                                    )
+                            if len(exons) > 0:
+                                region = ";".join(exons)
+                        elif u.isBetween(pos, cdsStart, cdsEnd):
+                            for e in range(0, exonCount):
+                                if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                                    exnum = e + 1
+                                    if strand == "-":
+                                        exnum = exonCount - e
+                                    exons.append(
+                                        "exon="
+                                        + "ex"
+                                        + str(exnum)
+                                        + "/"
+                                        + str(exonCount)
+                                    )
+                                    exonic_count = exonic_count + 1
+                            if len(exons) > 0:
+                                region = ";".join(exons)
+
+                        elif u.isBetween(pos, promoter_plus, txtStart) and (
+                            strand == "+"
+                        ):
+                            rows = cpg_islands.fetch(chr, pos, limit=1)
+                            rows = rows[0] if len(rows) > 0 else None
+
+                            if rows is not None:
+                                region = "putativePromoterRegion=" + "".join(
+                                    str(rows[3]).split()
+                                )
+                                promoter_count = promoter_count + 1
+
+                        elif u.isBetween(pos, txtEnd, promoter_minus) and (
+                            strand == "-"
+                        ):
+                            rows = cpg_islands.fetch(chr, pos, limit=1)
+                            rows = rows[0] if len(rows) > 0 else None
+                            if rows is not None:
+                                region = "putativePromoterRegion=" + "".join(
+                                    str(rows[3]).split()
+                                )
+                                promoter_count = promoter_count + 1
 
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
+                        else:
+                            region = ""
+
+                        if region != "":
+                            info.append(
+                                collapseGeneNames(
+                                    row=row,
+                                    indices=indicesKnownGenes,
+                                    region=region,
+                                    cnt=cnt,
+                                )
                             )
-                        )
 
-                    cnt = cnt + 1
+                        cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+                    str_info = ";".join(info)
+                    fields[7] = fields[7] + ";" + str_info
+                    fh_out.write("\t".join(fields) + "\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+                else:
+                    fields[7] = fields[7] + ";positionType=interGenic"
+                    fh_out.write("\t".join(fields) + "\n")
+                    interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+                linenum = linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+            else:
+                fh_out.write(line + "\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In interGenic {str(interGenic_count)}")
+        fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In CDS {str(cds_count)}")
+        fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+        print(f"In '3 UTR {str(utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+        print(f"In '5 UTR {str(utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In Intronic {str(intronic_count)}")
+        fh_log.write(f"In Intronic {str(intronic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Exonic {str(exonic_count)}")
+        fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Putative Promoter Region {str(promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        fh_out.close()
+        fh_log.close()
+        fh.close()
+        u.logStageMetrics(basefile, genes.stats())
+        u.logStageMetrics(basefile, cpg_islands.stats())
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -665,232 +651,217 @@ def getExonsEtAl(
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        genes = stack.enter_context(
+            lk.openLookup(
+                table, cursor, pad=promoter_offset, start_col="txStart", end_col="txEnd"
             )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "-"
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "-")
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+        )
+        cpg_islands = stack.enter_context(lk.openLookup("cpgIslandExt", cursor))
+        linenum = 1
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+        for line in fh:
+            line = line.strip()
+            if not line.startswith("#"):
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
 
-                    else:
+                pos = fields[inds[1]].strip()
+                ref = clean_mysql_chars(fields[inds[2]]).strip()
+                alt = clean_mysql_chars(fields[inds[3]]).strip()
+                info_field = clean_mysql_chars(fields[7]).strip()
+                this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
+
+                rows = genes.fetch(chr, pos)
+                info = []
+                if len(rows) > 0:
+                    cnt = 1
+                    for row in rows:
+                        txtStart = int(row[4])
+                        txtEnd = int(row[5])
+                        cdsStart = int(row[6])
+                        cdsEnd = int(row[7])
+                        exonCount = int(row[8])
+                        exonStarts = asText(row[9])
+                        exonEnds = asText(row[10])
+                        geneSymbol = str(row[12])
+                        strand = str(row[3])
+
+                        promoter_plus = txtStart - int(promoter_offset)
+                        promoter_minus = txtEnd + int(promoter_offset)
                         region = ""
+                        pos = int(pos)
+                        exons = []
+                        exonsSt = exonStarts.split(",")
+                        exonsEn = exonEnds.split(",")
+
+                        if cdsStart == cdsEnd:
+                            for e in range(0, exonCount):
+                                if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                                    exnum = e + 1
+                                    if strand == "-":
+                                        exnum = exonCount - e
+                                    exons.append(
+                                        "non_coding_exon="
+                                        + "ex"
+                                        + str(exnum)
+                                        + "/"
+                                        + str(exonCount)
+                                    )
+                                    non_coding_exonic_count = (
+                                        non_coding_exonic_count + 1
+                                    )
+                            if len(exons) > 0:
+                                region = "positionType=non_coding_exon;" + ";".join(
+                                    exons
+                                )
+                            else:
+                                non_coding_intronic_count = (
+                                    non_coding_intronic_count + 1
+                                )
+                                region = "positionType=non_coding_intron"
+
+                        elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                            cds_count = cds_count + 1
+                            for e in range(0, exonCount):
+                                if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                                    exnum = e + 1
+                                    if strand == "-":
+                                        exnum = exonCount - e
+                                    exons.append(
+                                        "exon="
+                                        + "ex"
+                                        + str(exnum)
+                                        + "/"
+                                        + str(exonCount)
+                                    )
+                                    exonic_count = exonic_count + 1
+                            if len(exons) > 0:
+                                region = "positionType=CDS;" + ";".join(exons)
+                            else:
+                                intronic_count = intronic_count + 1
+                                region = "positionType=CDS;" + "intron"
+
+                        elif (
+                            u.isBetween(pos, txtStart, cdsStart)
+                            and (cdsStart < cdsEnd)
+                            and (strand == "+")
+                        ):
+                            utr5_count = utr5_count + 1
+                            region = "positionType=utr5"
+
+                        elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
+                            strand == "+"
+                        ):
+                            utr3_count = utr3_count + 1
+                            region = "positionType=utr3"
+
+                        elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
+                            strand == "-"
+                        ):
+                            utr5_count = utr5_count + 1
+                            region = "positionType=utr5"
+
+                        elif (
+                            u.isBetween(pos, txtStart, cdsStart)
+                            and (cdsStart < cdsEnd)
+                            and (strand == "-")
+                        ):
+                            utr3_count = utr3_count + 1
+                            region = "positionType=utr3"
+
+                        elif u.isBetween(pos, promoter_plus, txtStart) and (
+                            strand == "+"
+                        ):
+                            rows = cpg_islands.fetch(chr, pos, limit=1)
+                            rows = rows[0] if len(rows) > 0 else None
+
+                            if rows is not None:
+                                region = "putativePromoterRegion=" + "".join(
+                                    str(rows[3]).split()
+                                )
+                                promoter_count = promoter_count + 1
+
+                        elif u.isBetween(pos, txtEnd, promoter_minus) and (
+                            strand == "-"
+                        ):
+                            rows = cpg_islands.fetch(chr, pos, limit=1)
+                            rows = rows[0] if len(rows) > 0 else None
 
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
+                            if rows is not None:
+                                region = "putativePromoterRegion=" + "".join(
+                                    str(rows[3]).split()
+                                )
+                                promoter_count = promoter_count + 1
+
+                        else:
+                            region = ""
+
+                        if region != "":
+                            info.append(
+                                collapseGeneNames(
+                                    row=row,
+                                    indices=indicesKnownGenes,
+                                    region=region,
+                                    cnt=cnt,
+                                )
                             )
-                        )
 
-                    cnt = cnt + 1
+                        cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+                    str_info = ";".join(info)
+                    fields[7] = fields[7] + ";" + str_info
+                    fh_out.write("\t".join(fields) + "\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+                else:
+                    fields[7] = fields[7] + ";positionType=interGenic"
+                    fh_out.write("\t".join(fields) + "\n")
+                    interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+                linenum = linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+            else:
+                fh_out.write(line + "\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In interGenic {str(interGenic_count)}")
+        fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In CDS {str(cds_count)}")
+        fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+        print(f"In '3 UTR {str(utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+        print(f"In '5 UTR {str(utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
+        print(f"In Intronic {str(intronic_count)}")
+        fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Exonic {str(exonic_count)}")
+        fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Putative Promoter Region {str(promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        fh_out.close()
+        fh_log.close()
+        fh.close()
+        u.logStageMetrics(basefile, genes.stats())
+        u.logStageMetrics(basefile, cpg_islands.stats())
 
 
 """Overlap with tfbsConsSites
@@ -898,7 +869,13 @@ def getExonsEtAl(
 
 
 def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    sink=None,
 ):
 
     allowed_chrom = [
@@ -932,7 +909,9 @@ def addOverlapWithTfbsConsSites(
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
+    # sink: file-like object taking the output instead of outfile (e.g.
+    # s3_upload.MultipartWriter); the caller closes it
+    fh_out = open(outfile, "w") if sink is None else sink
     fh = open(vcf)
 
     logcountfile = basefile + ".count.log"
@@ -941,89 +920,80 @@ def addOverlapWithTfbsConsSites(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
-
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        tfbs = stack.enter_context(lk.openLookup(table, cursor))
+
+        linenum = 1
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if line.startswith("##"):
+                fh_out.write(line + "\n")
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+            # header line
+            elif line.startswith("#CHROM") or line.startswith("CHROM"):
+                fh_out.write(line + "\n")
 
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
+            else:
+                fields = line.split(sep)
+                chr = fields[inds[0]].strip()
+                # For some reason this table has no "chr" preceeding number
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
 
-            if chrIndex in allowed_chrom:
+                pos = fields[inds[1]].strip()
                 isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
+                chrIndex = chr.replace("chr", "")
+
+                if chrIndex in allowed_chrom:
+                    isOverlap = False
+                    rows = tfbs.fetch(chr, pos)
+                    records = []
+
+                    if len(rows) > 0:
+                        records_count = 1
+                        line_count = line_count + 1
+
+                        for row in rows:
+                            var_count = var_count + 1
+                            t = (
+                                str(row[3])
+                                + "."
+                                + str(row[0])
+                                + "."
+                                + str(row[1])
+                                + "."
+                                + str(row[2])
+                            )
+                            t = t.strip()
+                            records.append("tfbsRegion" + "=" + t)
+                            records_count = records_count + 1
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + ";".join(records)
+                        else:
+                            fields[7] = fields[7] + ";" + ";".join(records)
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
+                        fh_out.write("\t".join(fields) + "\n")
 
-                    fh_out.write("\t".join(fields) + "\n")
+                    else:  # chrom is not on the list
+                        fh_out.write(line + "\n")
 
                 else:  # chrom is not on the list
                     fh_out.write(line + "\n")
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
-
-        linenum = linenum + 1
+            linenum = linenum + 1
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, tfbs.stats())
     fh.close()
-    fh_out.close()
+    if sink is None:
+        fh_out.close()
 
 
 """Overlap with GadAll table
@@ -1047,70 +1017,59 @@ def addOverlapWithGadAll(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        gad = stack.enter_context(lk.openLookup(table, cursor, chrom_col="chromosome"))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
                     fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    # For some reason this table has no "chr" preceeding number
+                    if chr.startswith("chr"):
+                        chr = str(chr).replace("chr", "")
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    rows = gad.fetch(chr, pos)
+                    records = []
+
+                    if len(rows) > 0:
+                        records_count = 1
+                        line_count = line_count + 1
+                        r_tmp = []
+                        for row in rows:
+                            var_count = var_count + 1
+                            if not fu.isOnTheList(r_tmp, str(row[3])):
+                                r_tmp.append(str(row[3]))
+                                records.append(str(table) + "=" + str(row[3]))
+                                records_count = records_count + 1
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + ";".join(records)
+                        else:
+                            fields[7] = fields[7] + ";" + ";".join(records)
+                        fh_out.write("\t ".join(fields) + "\n")
+                    else:
+                        fh_out.write(line + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, gad.stats())
     fh.close()
     fh_out.close()
 
@@ -1135,72 +1094,63 @@ def addOverlapWithGwasCatalog(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        gwas = stack.enter_context(lk.openLookup(table, cursor, start_col="chromEnd"))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
                     fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    rows = gwas.fetch(chr, pos)
+                    records = []
+
+                    if len(rows) > 0:
+                        line_count = line_count + 1
+                        records_count = 1
+                        for row in rows:
+                            var_count = var_count + 1
+                            records.append(
+                                str(table)
+                                + "="
+                                + str("pubMedID")
+                                + "="
+                                + str(row[5])
+                                + ",trait="
+                                + str(row[10])
+                            )
+                            records_count = records_count + 1
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + ";".join(records)
+                        else:
+                            fields[7] = fields[7] + ";" + ";".join(records)
+                        fh_out.write("\t".join(fields) + "\n")
+                    else:
+                        fh_out.write(line + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, gwas.stats())
     fh.close()
     fh_out.close()
 
@@ -1226,73 +1176,62 @@ def addOverlapWitHUGOGeneNomenclature(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        hugo = stack.enter_context(lk.openLookup(table, cursor))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    rows = hugo.fetch(chr, pos)
+                    records = []
+
+                    if len(rows) > 0:
+                        line_count = line_count + 1
+                        records_count = 1
+                        r_tmp = []
+                        for row in rows:
+                            var_count = var_count + 1
+                            t = str(str(row[5]) + "," + str(row[6])).strip()
+                            if not fu.isOnTheList(r_tmp, t):
+                                r_tmp.append(t)
+                                records.append("HGNC_GeneAnnotation" + "=" + t)
+                            records_count = records_count + 1
 
-                    records_str = ",".join(records).replace(";", ",")
+                        records_str = ",".join(records).replace(";", ",")
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + records_str
+                        else:
+                            fields[7] = fields[7] + ";" + records_str
+                        fh_out.write("\t".join(fields) + "\n")
                     else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+                        fh_out.write(line + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, hugo.stats())
     fh.close()
     fh_out.close()
 
@@ -1318,78 +1257,68 @@ def addOverlapWithGenomicSuperDups(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        superdups = stack.enter_context(lk.openLookup(table, cursor))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+                    otherChrom = ""
+                    otherStart = ""
+                    otherEnd = ""
+                    l = str(isOverlap)
+
+                    rows = superdups.fetch(chr, pos, limit=1)
+                    rows = rows[0] if len(rows) > 0 else None
+
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        isOverlap = True
+                        otherChrom = rows[7]
+                        otherStart = rows[8]
+                        otherEnd = rows[9]
+                        fields[7] = (
+                            fields[7]
+                            + ";"
+                            + str(table)
+                            + "="
+                            + str(isOverlap)
+                            + ";"
+                            + "otherChrom="
+                            + str(otherChrom)
+                            + ";otherStart="
+                            + str(otherStart)
+                            + ";otherEnd="
+                            + str(otherEnd)
+                        )
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
-
-                fh_out.write("\t".join(fields) + "\n")
+                    fh_out.write("\t".join(fields) + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, superdups.stats())
     fh.close()
     fh_out.close()
 
@@ -1421,76 +1350,63 @@ def addOverlapWithRefGene(
     endName = "txEnd"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        genes = stack.enter_context(
+            lk.openLookup(table, cursor, start_col=startName, end_col=endName)
+        )
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    overlapsWith = []
+                    rows = genes.fetch(chr, pos)
+
+                    if len(rows) > 0:
+                        line_count = line_count + 1
+                        for row in rows:
+                            var_count = var_count + 1
+                            overlapsWith.append(
+                                name2
+                                + "="
+                                + str(row[colindex2])
+                                + ";"
+                                + name
+                                + "="
+                                + str(row[colindex])
+                            )
 
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
+                        genes = ";".join([str(x) for x in overlapsWith])
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + str(genes)
+                        else:
+                            fields[7] = fields[7] + ";" + str(genes)
+                    fh_out.write("\t".join(fields) + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, genes.stats())
     fh.close()
     fh_out.close()
 
@@ -1523,69 +1439,58 @@ def addOverlapWithCytoband(
         endName = "chromEnd"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        bands = stack.enter_context(
+            lk.openLookup(table, cursor, start_col=startName, end_col=endName)
+        )
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+
+                    overlapsWith = []
+                    rows = bands.fetch(chr, pos)
+
+                    if len(rows) > 0:
+                        line_count = line_count + 1
+                        for row in rows:
+                            var_count = var_count + 1
+                            overlapsWith.append(str(row[colindex]))
+                        overlapsWith = u.dedup(overlapsWith)
+                        cytoband = ";".join([str(x) for x in overlapsWith])
+
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + str(table) + "=" + str(cytoband)
+                        else:
+                            fields[7] = (
+                                fields[7] + ";" + str(table) + "=" + str(cytoband)
+                            )
+                    fh_out.write("\t".join(fields) + "\n")
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, bands.stats())
     fh.close()
     fh_out.close()
 
@@ -1611,59 +1516,51 @@ def addOverlapWithCnvDatabase(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        cnvs = stack.enter_context(lk.openLookup(table, cursor))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
+
+                    pos = fields[inds[1]].strip()
+                    isOverlap = False
+                    rows = cnvs.fetch(chr, pos, limit=1)
+                    rows = rows[0] if len(rows) > 0 else None
+
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        isOverlap = True
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
+                        else:
+                            fields[7] = (
+                                fields[7] + ";" + str(table) + "=" + str(isOverlap)
+                            )
+                    fh_out.write("\t".join(fields) + "\n")
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+                linenum = linenum + 1
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, cnvs.stats())
     fh.close()
     fh_out.close()
 
@@ -1689,67 +1586,57 @@ def addOverlapWithMiRNA(
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    with contextlib.ExitStack() as stack:
+        cursor = openCursor(stack)
+        mirna = stack.enter_context(lk.openLookup(table, cursor))
+        linenum = 1
+
+        for line in fh:
+            line = line.strip()
+            ## not comments
+            if not line.startswith("##"):
+                # header line
+                if line.startswith("CHROM") or line.startswith("#CHROM"):
+                    fh_out.write(line + "\n")
+                else:
+                    fields = line.split(sep)
+                    chr = fields[inds[0]].strip()
+                    if not chr.startswith("chr"):
+                        chr = "chr" + chr
 
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                    pos = fields[inds[1]].strip()
+                    rows = mirna.fetch(chr, pos, limit=1)
+                    rows = rows[0] if len(rows) > 0 else None
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
+                    if rows is not None:
+                        line_count = line_count + 1
+                        var_count = var_count + 1
+                        t = (
+                            str(rows[4])
+                            + ","
+                            + str(rows[1])
+                            + "_"
+                            + str(rows[2])
+                            + "_"
+                            + str(rows[3])
+                        )
+                        t = "miRNAsites=" + t.strip()
+                        if str(fields[7]).endswith(";"):
+                            fields[7] = fields[7] + t
+                        else:
+                            fields[7] = fields[7] + ";" + t
+                    fh_out.write("\t".join(fields) + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+                linenum = linenum + 1
+            else:
+                fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+        fh_log.write(
+            f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        )
+        fh_log.close()
 
-    conn.close()
+        u.logStageMetrics(basefile, mirna.stats())
     fh.close()
     fh_out.close()
 
@@ -1,6 +1,5 @@
 import boto3
 import os
-import subprocess
 from botocore.exceptions import NoCredentialsError, ClientError
 from botocore.client import Config
 import json
@@ -8,6 +7,19 @@ import json
 # https://www.geeksforgeeks.org/how-to-log-a-python-exception/
 import logging
 import configparser
+import worker_pool
+import admission as admission_
+import heartbeat
+import scatter
+import shards
+import metrics
+import backlog as backlog_
+import tracing
+import profiling
+import shutil
+import concurrent.futures
+import signal
+import time
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,10 +33,17 @@ AWS_REGION = config['aws']['AwsRegionName']
 QUEUE_URL = config['sqs']['QueueUrl']
 WAIT_TIME = int(config['sqs']['WaitTime'])
 MAX_MESSAGES = int(config['sqs']['MaxMessages'])
+HEARTBEAT_INTERVAL = config.getint('sqs', 'HeartbeatInterval', fallback=30)
+INITIAL_VISIBILITY = config.getint('sqs', 'InitialVisibility', fallback=300)
+DOWNLOAD_THREADS = config.getint('s3', 'DownloadThreads', fallback=2)
+STREAM_INPUT = config.getboolean('s3', 'StreamInput', fallback=False)
 INPUTS_BUCKET_NAME = config['s3']['InputsBucketName']
 RESULTS_BUCKET_NAME = config['s3']['ResultsBucketName']
 KEY_PREFIX = config['s3']['KeyPrefix']
 ANNOTATIONS_TABLE = config['dynamodb']['AnnotationsTable']
+REFERENCE_VERSION = config.get('ann', 'ReferenceVersion', fallback='1')
+DRAIN_SECONDS = config.getint('ann', 'DrainSeconds', fallback=90)
+DRAIN_FLAG_FILE = config.get('ann', 'DrainFlagFile', fallback='./drain')
 
 # Define directories for input files and job information
 INPUT_FILE_DIR = os.path.expanduser('~/gas/ann/anntools/data')
@@ -52,69 +71,394 @@ s3_client = boto3.client('s3', region_name=AWS_REGION, config=Config(signature_v
 dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
 table = dynamodb.Table(ANNOTATIONS_TABLE)
 
+# Warm, long-lived annotation workers; jobs run in them instead of a new
+# "python run.py" process per job. It forks them, so it starts before any
+# thread below does (worker_pool.py)
+pool = worker_pool.WorkerPool()
+
+
+# Admitted jobs: job_id -> SQS message, deleted once the job is done
+running_jobs = {}
+admission = admission_.Admission(pool.size, JOB_INFO_DIR)
+
+# Inputs are downloaded in the background, so the next job's input arrives
+# while the current jobs annotate: job_id -> (future, input size)
+downloader = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)
+downloads = {}
+job_sizes = {}
+
+# Running chunks of split jobs (scatter.py): job_id -> chunk
+chunks = {}
+
+# Jobs to annotate under the profiler (profiling.py)
+profiled = set()
+
+# Advertises this instance's warm reference shards and routes chunks of
+# split jobs towards the instances holding theirs (shards.py)
+router = shards.Router(s3_client, RESULTS_BUCKET_NAME) if shards.SHARD_ROUTING else None
+
+# Latency spans of the traced jobs this instance holds (tracing.py)
+tracer = tracing.Tracer()
+
+# Keeps the messages of running jobs invisible for as long as they run
+visibility = heartbeat.Heartbeat(
+    QUEUE_URL,
+    AWS_REGION,
+    pool.progress.get,
+    interval=HEARTBEAT_INTERVAL,
+    initial_visibility=INITIAL_VISIBILITY
+)
+
+
+# Set by SIGTERM (scale-in, instance stop); the drain flag file does the same
+# for a lifecycle hook or an operator
+drain_requested = False
+
+
+def request_drain(signum, frame):
+    global drain_requested
+    drain_requested = True
+
+
+signal.signal(signal.SIGTERM, request_drain)
+
+
+def draining():
+    return drain_requested or os.path.exists(DRAIN_FLAG_FILE)
+
+
+def parse_message(message):
+    sns_message = json.loads(message.body)
+
+    # Check if it's an SNS Notification and extract the actual message
+    # https://docs.aws.amazon.com/ses/latest/dg/notification-examples.html
+    if 'Message' in sns_message and 'Type' in sns_message and sns_message['Type'] == 'Notification':
+        return json.loads(sns_message['Message'])
+    return sns_message
+
 
 def process_message(message):
+    """Admit, download and start one job; returns False when the instance has no room for it."""
+    # Set once the job holds an admission slot; a failure after that releases it
+    admitted = None
     try:
-        sns_message = json.loads(message.body)
-        
-        # Check if it's an SNS Notification and extract the actual message
-        # https://docs.aws.amazon.com/ses/latest/dg/notification-examples.html
-        if 'Message' in sns_message and 'Type' in sns_message and sns_message['Type'] == 'Notification':
-            data = json.loads(sns_message['Message'])
-        else:
-            data = sns_message
-        
+        # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
+        received = time.time()
+        sent = (message.attributes or {}).get('SentTimestamp')
+        if sent is not None:
+            sent = int(sent) / 1000.0
+            metrics.RECEIVE_LATENCY.observe(max(0.0, received - sent))
+
+        data = parse_message(message)
+
         job_id = data['job_id']
+        tracer.received(job_id, data, sent, received)
         bucket_name = data['s3_inputs_bucket']
         key = data['s3_key_input_file']
+        chunk = data.get('chunk')
 
-        job_dir = os.path.join(JOB_INFO_DIR, job_id)
-        try:
-            os.makedirs(job_dir, exist_ok=True)
-        except OSError as e:
-            logging.error(f"Failed to create directory {job_dir}: {str(e)}")
-            raise
+        # Input size from the object metadata decides whether the job fits now
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+        if chunk is not None:
+            size = chunk['end'] - chunk['start']
+        else:
+            size = s3_client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
 
-        local_filename = os.path.join(job_dir, key.split('/')[-1])
-        s3_client.download_file(bucket_name, key, local_filename)
+        backlog.received(size)
 
-        ann_process = subprocess.Popen(['python', 'run.py', local_filename])
-        
-        
-        # Update job status in DynamoDB
-        # https://docs.python.org/3/library/asyncio-subprocess.html#asyncio.subprocess.Process.returncode
-        if ann_process.returncode == 0:
-            status = 'COMPLETED'
-        else:
-            status = 'FAILED'
-            logging.warning(f"Annotation process for job {job_id} exited with return code {ann_process.returncode}")
+        # A huge input is split into chunks that any annotator can take
+        if scatter.shouldSplit(data, size):
+            tracer.mark(job_id, 'split')
+            count = scatter.split(data, size, s3_client, queue, table)
+            tracer.since(job_id, 'split', 'split')
+            tracer.finish(job_id, table)
+            logging.info(f"Split job {job_id} into {count} chunks")
+            message.delete()
+            return True
 
-        table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression='SET job_status = :status',
-            ExpressionAttributeValues={':status': status}
-        )
-        
-         # Successfully processed, delete the message
-        message.delete()
+        if router is not None and chunk is not None and router.defer(chunk):
+            # Another instance holds the chunk's reference shards warm
+            tracer.discard(job_id)
+            message.change_visibility(VisibilityTimeout=shards.DEFER_VISIBILITY)
+            return True
+
+        if not admission.admit(job_id, size, queued_bytes=queued_bytes()):
+            # Hand the message back so this or another instance picks it up later
+            tracer.discard(job_id)
+            message.change_visibility(VisibilityTimeout=0)
+            return False
+        admitted = job_id
+
+        if router is not None and chunk is not None:
+            router.taken(chunk)
+
+        if profiling.shouldProfile(data):
+            logging.info(f"Job {job_id} will be profiled")
+            profiled.add(job_id)
+
+        visibility.register(job_id, message.receipt_handle)
+        running_jobs[job_id] = message
+        if chunk is not None:
+            chunks[job_id] = chunk
+
+        job_dir = os.path.join(JOB_INFO_DIR, job_id)
+        local_filename = os.path.join(job_dir, key.split('/')[-1])
+        if STREAM_INPUT:
+            # The worker reads the input from S3 as it annotates; only outputs go to job_dir
+            os.makedirs(job_dir, exist_ok=True)
+            job_sizes[job_id] = size
+            tracer.mark(job_id, 'submitted')
+            pool.submit(job_id, local_filename, source=(bucket_name, key), chunk=chunk, profile=job_id in profiled)
+            return True
+
+        # Download in the background; the job goes to the pool once its input is local
+        tracer.mark(job_id, 'download')
+        downloads[job_id] = (downloader.submit(download_input, bucket_name, key, job_dir, local_filename, chunk), size)
+        return True
 
     except ClientError as e:
         logging.error(f"Failed to download file or update DynamoDB: {str(e)}")
+        if admitted is not None:
+            release_job(admitted, message)
         raise
     except Exception as e:
         logging.error(f"Error processing message: {str(e)}")
+        if admitted is not None:
+            release_job(admitted, message)
+        return True
+
+
+def download_input(bucket_name, key, job_dir, local_filename, chunk=None):
+    os.makedirs(job_dir, exist_ok=True)
+    if chunk is None:
+        s3_client.download_file(bucket_name, key, local_filename)
+        return local_filename
+    # Only the chunk's byte range of the input
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+    response = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={chunk['start']}-{chunk['end'] - 1}")
+    with open(local_filename, 'wb') as fh:
+        shutil.copyfileobj(response['Body'], fh)
+    return local_filename
+
+
+def queued_bytes():
+    """Input bytes downloaded ahead or downloading that no worker has started on yet."""
+    waiting = [job_id for job_id in pool.queued() if job_id in job_sizes]
+    return sum([size for future, size in downloads.values()]) + sum([job_sizes[job_id] for job_id in waiting])
+
+
+def remaining_bytes():
+    """Input bytes of the admitted jobs not annotated yet, from their progress."""
+    remaining = sum([size for future, size in downloads.values()])
+    for job_id, size in job_sizes.items():
+        if job_id in pool.uploading:
+            # Annotated; only its results are uploading
+            continue
+        remaining = remaining + size * (1.0 - (pool.progress.get(job_id) or 0.0))
+    return remaining
+
+
+def start_downloaded():
+    """Hand jobs whose input download finished to the pool."""
+    for job_id, (future, size) in list(downloads.items()):
+        if not future.done():
+            continue
+        del downloads[job_id]
+        try:
+            local_filename = future.result()
+        except Exception as e:
+            logging.error(f"Failed to download input of job {job_id}: {str(e)}")
+            running_jobs.pop(job_id, None)
+            chunks.pop(job_id, None)
+            admission.release(job_id)
+            visibility.unregister(job_id)
+            tracer.discard(job_id)
+            profiled.discard(job_id)
+            continue
+        tracer.since(job_id, 'download', 'download')
+        job_sizes[job_id] = size
+        tracer.mark(job_id, 'submitted')
+        pool.submit(job_id, local_filename, chunk=chunks.get(job_id), profile=job_id in profiled)
+
+
+def release_job(job_id, message=None):
+    """Hand an unfinished job's message straight back to the queue for another instance.
+
+    message is the job's message when it may not be in running_jobs yet.
+    """
+    message = running_jobs.pop(job_id, None) or message
+    future, size = downloads.pop(job_id, (None, 0))
+    if future is not None:
+        future.cancel()
+    pool.cancel(job_id)
+    job_sizes.pop(job_id, None)
+    chunks.pop(job_id, None)
+    admission.release(job_id)
+    visibility.unregister(job_id)
+    tracer.discard(job_id)
+    profiled.discard(job_id)
+    if message is None:
+        return
+    try:
+        message.change_visibility(VisibilityTimeout=0)
+        logging.info(f"Released job {job_id} back to the queue")
+    except ClientError as e:
+        logging.error(f"Failed to release job {job_id}: {str(e)}")
+
+
+def finish_job(result):
+    if result.status == 'INTERRUPTED':
+        # Stopped at a checkpoint by the drain; another instance resumes it
+        logging.info(f"Job {result.job_id} stopped at a checkpoint after {result.seconds}s")
+        release_job(result.job_id)
+        return
+
+    if result.status == 'ANNOTATED':
+        # Results are uploading in the background; the worker is free again
+        admission.annotated(result.job_id)
+        tracer.mark(result.job_id, 'annotated')
+        tracer.stages(result.job_id, result.stage_spans)
+        return
+
+    size = job_sizes.pop(result.job_id, 0)
+    message = running_jobs.pop(result.job_id, None)
+    profiled.discard(result.job_id)
+    admission.release(result.job_id)
+    visibility.unregister(result.job_id)
+
+    metrics.JOBS.inc(status=result.status)
+    metrics.JOB_SECONDS.observe(result.seconds, status=result.status)
+    metrics.JOB_QUEUED_SECONDS.observe(result.queued)
+    if result.status == 'COMPLETED':
+        backlog.finished(size, result.seconds)
+    tracer.ran(result)
+
+    # Update job status in DynamoDB with the outcome reported by the worker
+    status = result.status
+    if status == 'COMPLETED':
+        logging.info(f"Job {result.job_id} completed in {result.seconds}s (queued {result.queued}s)")
+    else:
+        logging.warning(f"Annotation of job {result.job_id} failed: {result.error}")
+
+    chunk = chunks.pop(result.job_id, None)
+    tracer.mark(result.job_id, 'record')
+    try:
+        if chunk is None:
+            update = 'SET job_status = :status'
+            values = {':status': status}
+            input_hash = parse_message(message).get('input_hash') if message is not None else None
+            if status == 'COMPLETED' and input_hash:
+                # Indexed by content hash and reference release, so the web app
+                # can reuse these results for an identical input
+                update = update + ', cache_key = :ck, reference_version = :rv'
+                values[':ck'] = f"{input_hash}#{REFERENCE_VERSION}"
+                values[':rv'] = REFERENCE_VERSION
+            table.update_item(
+                Key={'job_id': result.job_id},
+                UpdateExpression=update,
+                ExpressionAttributeValues=values
+            )
+        elif status != 'COMPLETED':
+            # A failed chunk fails its parent job; a completed one was recorded
+            # on the parent by the worker (and gathered if it was the last)
+            table.update_item(
+                Key={'job_id': chunk['parent']},
+                UpdateExpression='SET job_status = :status',
+                ExpressionAttributeValues={':status': status}
+            )
+
+        # Successfully processed, delete the message
+        if message is not None:
+            message.delete()
+    except ClientError as e:
+        logging.error(f"Failed to update DynamoDB for job {result.job_id}: {str(e)}")
+    tracer.since(result.job_id, 'record', 'record')
+    tracer.finish(result.job_id, table)
+
+
+def wait_for_jobs():
+    """Wait a little for running jobs to report, handing on finished downloads."""
+    start_downloaded()
+    for result in pool.poll(timeout=1 if downloads else worker_pool.REAP_INTERVAL):
+        finish_job(result)
+
+
+def drain():
+    """Stop taking jobs, give running ones until the deadline and release the rest.
+
+    Jobs not started yet go back to the queue at once; running jobs are asked to
+    stop at their next checkpoint. Whatever is still running at the deadline is
+    killed and its message released with visibility 0, so another instance takes
+    it right away instead of after the visibility timeout.
+    """
+    deadline = time.time() + DRAIN_SECONDS
+    logging.info(f"Draining: {len(running_jobs)} jobs admitted, deadline in {DRAIN_SECONDS}s")
+    for job_id in list(downloads) + pool.drain():
+        release_job(job_id)
+    while running_jobs and time.time() < deadline:
+        for result in pool.poll(timeout=max(0, min(1, deadline - time.time()))):
+            finish_job(result)
+    for result in pool.poll():
+        finish_job(result)
+    pool.terminate()
+    for job_id in list(running_jobs):
+        logging.warning(f"Job {job_id} did not finish before the drain deadline")
+        release_job(job_id)
+    visibility.stop()
+    if router is not None:
+        logging.info(f"Shard routing: {router.stats()}")
+        router.stop()
+    downloader.shutdown(wait=False)
+    logging.info("Drained, exiting")
+
+
+# Estimated work waiting, in seconds of this instance's throughput, for scaling
+backlog = backlog_.Backlog(queue, pool.size, backlog_.openSink())
+
+# Read when the /metrics endpoint is scraped
+metrics.Gauge('ann_jobs_in_flight', 'Jobs admitted and not yet finished', function=lambda: len(running_jobs))
+metrics.Gauge('ann_jobs_downloading', 'Admitted jobs whose input is downloading', function=lambda: len(downloads))
+metrics.Gauge('ann_workers', 'Annotation worker processes', function=lambda: pool.size)
+metrics.Gauge('ann_workers_busy', 'Workers annotating a job', function=pool.busy)
+metrics.Gauge('ann_worker_utilization', 'Share of the workers annotating a job', function=lambda: pool.busy() / float(pool.size))
+metrics.serve()
 
 
 # Poll the message queue in a loop using long polling
 # https://stackoverflow.com/questions/76498541/optimal-method-to-long-poll-keep-on-retrieving-new-sqs-messages
-while True:
+# Jobs run concurrently on the pool; only as many messages as there are free
+# slots are received, and while jobs run the poll is kept short so finished
+# jobs are recorded promptly; on SIGTERM or the drain flag file the loop ends
+# with a drain
+while not draining():
     try:
-        messages = queue.receive_messages(WaitTimeSeconds=WAIT_TIME, MaxNumberOfMessages=MAX_MESSAGES)
+        start_downloaded()
+        for result in pool.poll():
+            finish_job(result)
+        backlog.maybePublish(remaining_bytes())
+
+        if admission.free() <= 0:
+            wait_for_jobs()
+            continue
+
+        messages = queue.receive_messages(
+            WaitTimeSeconds=WAIT_TIME if not running_jobs else 1,
+            MaxNumberOfMessages=min(MAX_MESSAGES, admission.free()),
+            AttributeNames=['SentTimestamp']
+        )
         for message in messages:
-            process_message(message)
+            if draining():
+                # Received while the drain was requested
+                message.change_visibility(VisibilityTimeout=0)
+                continue
+            if not process_message(message):
+                # Out of room: wait for a running job before taking more
+                wait_for_jobs()
     except NoCredentialsError as e:
         logging.error("No AWS credentials found: " + str(e))
     except ClientError as e:
         logging.error("SQS client error occurred: " + str(e))
     except Exception as e:
         logging.error("Unexpected error during queue processing: " + str(e))
+
+drain()
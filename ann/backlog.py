@@ -0,0 +1,194 @@
+# backlog.py
+#
+# Backlog-per-instance scaling signal
+#
+# Queue depth counts a 10-line VCF and a whole genome alike. Every
+# BacklogInterval seconds the poller estimates the work waiting, in seconds
+# of this instance's measured throughput:
+#   queue backlog    = visible messages x mean input bytes of the messages
+#                      received lately / instance bytes per second
+#   instance backlog = input bytes of this instance's admitted jobs not yet
+#                      annotated (from their progress) / bytes per second
+# Throughput is measured from finished jobs (input bytes over wall time, a
+# moving average, times the number of workers). Input bytes stand in for
+# variants: the message metadata gives a job's size, not its line count.
+# The record is written to a pluggable sink: CloudWatch (for a target
+# tracking policy, dividing the queue backlog by the group's instances with
+# metric math), a local file of JSON lines, or stdout for testing.
+#
+##
+
+import json
+import logging
+import sys
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import metrics
+import reference as ref
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+
+# cloudwatch, file:<path>, stdout or none
+BACKLOG_SINK = ref.config.get("ann", "BacklogSink", fallback="none")
+BACKLOG_INTERVAL = ref.config.getint("ann", "BacklogInterval", fallback=60)
+BACKLOG_NAMESPACE = ref.config.get("ann", "BacklogNamespace", fallback="GAS/Annotator")
+AUTO_SCALING_GROUP = ref.config.get("ann", "AutoScalingGroup", fallback="")
+# Throughput assumed per worker until a job has been measured
+DEFAULT_BYTES_PER_SECOND = ref.config.getfloat(
+    "ann", "BacklogBytesPerSecond", fallback=1024 * 1024
+)
+
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.2
+
+BACKLOG_SECONDS = metrics.Gauge(
+    "ann_backlog_seconds",
+    "Estimated work waiting in seconds of this instance's throughput",
+    labels=("scope",),
+)
+
+
+class CloudWatchSink(object):
+    def __init__(self, namespace=BACKLOG_NAMESPACE, group=AUTO_SCALING_GROUP):
+        self.cloudwatch = boto3.client("cloudwatch", region_name=AWS_REGION)
+        self.namespace = namespace
+        self.dimensions = (
+            [{"Name": "AutoScalingGroupName", "Value": group}] if group else []
+        )
+
+    def write(self, record):
+        # https://docs.aws.amazon.com/AmazonCloudWatch/latest/APIReference/API_PutMetricData.html
+        self.cloudwatch.put_metric_data(
+            Namespace=self.namespace,
+            MetricData=[
+                {
+                    "MetricName": "QueueBacklogSeconds",
+                    "Dimensions": self.dimensions,
+                    "Value": record["queue_backlog_seconds"],
+                    "Unit": "Seconds",
+                },
+                {
+                    "MetricName": "InstanceBacklogSeconds",
+                    "Dimensions": self.dimensions,
+                    "Value": record["instance_backlog_seconds"],
+                    "Unit": "Seconds",
+                },
+                {
+                    "MetricName": "InstanceBytesPerSecond",
+                    "Dimensions": self.dimensions,
+                    "Value": record["bytes_per_second"],
+                    "Unit": "Bytes/Second",
+                },
+            ],
+        )
+
+
+class FileSink(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, record):
+        with open(self.path, "a") as fh:
+            fh.write(json.dumps(record) + "\n")
+
+
+class StdoutSink(object):
+    def write(self, record):
+        sys.stdout.write(json.dumps(record) + "\n")
+        sys.stdout.flush()
+
+
+"""Sink named by spec (BacklogSink), None for none
+"""
+
+
+def openSink(spec=BACKLOG_SINK):
+    spec = spec.strip()
+    if spec == "cloudwatch":
+        return CloudWatchSink()
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:") :])
+    if spec == "stdout":
+        return StdoutSink()
+    if spec in ("", "none"):
+        return None
+    raise ValueError(f"Unknown backlog sink: {spec}")
+
+
+class Backlog(object):
+    def __init__(self, queue, workers, sink=None, interval=BACKLOG_INTERVAL):
+        self.queue = queue
+        self.workers = max(1, int(workers))
+        self.sink = sink
+        self.interval = interval
+        self.message_bytes = None
+        self.job_bytes_per_second = None
+        self.published = 0.0
+
+    def _average(self, current, sample):
+        if current is None:
+            return float(sample)
+        return (1.0 - SMOOTHING) * current + SMOOTHING * sample
+
+    """Notes the input size of a job request taken from the queue
+    """
+
+    def received(self, size):
+        self.message_bytes = self._average(self.message_bytes, size)
+
+    """Notes a finished job's input size and wall time
+    """
+
+    def finished(self, size, seconds):
+        if size > 0 and seconds > 0:
+            self.job_bytes_per_second = self._average(
+                self.job_bytes_per_second, size / float(seconds)
+            )
+
+    def bytesPerSecond(self):
+        per_job = self.job_bytes_per_second or DEFAULT_BYTES_PER_SECOND
+        return per_job * self.workers
+
+    def estimate(self, depth, instance_bytes):
+        rate = self.bytesPerSecond()
+        queued_bytes = depth * (self.message_bytes or 0.0)
+        return {
+            "time": int(time.time()),
+            "queue_messages": depth,
+            "queued_bytes": int(queued_bytes),
+            "instance_bytes": int(instance_bytes),
+            "bytes_per_second": round(rate, 3),
+            "queue_backlog_seconds": round(queued_bytes / rate, 3),
+            "instance_backlog_seconds": round(instance_bytes / rate, 3),
+        }
+
+    """Publishes the estimate if the interval has passed; instance_bytes is
+       the input not yet annotated of the jobs this instance admitted
+    """
+
+    def maybePublish(self, instance_bytes, now=None):
+        now = now or time.time()
+        if now - self.published < self.interval:
+            return None
+        self.published = now
+        try:
+            self.queue.load()
+            depth = int(self.queue.attributes["ApproximateNumberOfMessages"])
+        except (ClientError, KeyError, ValueError) as e:
+            logging.error(f"Failed to read the queue depth: {str(e)}")
+            return None
+        record = self.estimate(depth, instance_bytes)
+        BACKLOG_SECONDS.set(record["queue_backlog_seconds"], scope="queue")
+        BACKLOG_SECONDS.set(record["instance_backlog_seconds"], scope="instance")
+        if self.sink is not None:
+            try:
+                self.sink.write(record)
+            except (ClientError, IOError) as e:
+                logging.error(f"Failed to publish the backlog: {str(e)}")
+        return record
+
+
+### EOF
@@ -0,0 +1,150 @@
+# bloom.py
+#
+# Probabilistic pre-screen for sparse-hit reference tables
+#
+# A Bloom filter over (chrom, bin) keys is built alongside the reference
+# snapshot (see reference.py). Annotation stages consult it before querying
+# the database and skip the lookup when the filter says "definitely absent".
+#
+##
+
+import hashlib
+import math
+import struct
+
+import utils as u
+
+MAGIC = b"GASBLOOM1\n"
+
+
+"""Fixed-size Bloom filter using double hashing over a blake2b digest
+"""
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01, num_bits=None, num_hashes=None):
+        capacity = max(1, int(capacity))
+        if num_bits is None:
+            num_bits = int(
+                math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+            )
+        if num_hashes is None:
+            num_hashes = int(round((num_bits / float(capacity)) * math.log(2)))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = max(1, num_hashes)
+        self.count = 0
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count = self.count + 1
+
+    def __contains__(self, key):
+        for p in self._positions(key):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        with open(path, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(
+                struct.pack(
+                    "<QQQd", self.num_bits, self.num_hashes, self.count, self.error_rate
+                )
+            )
+            fh.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a GAS Bloom filter file")
+            num_bits, num_hashes, count, error_rate = struct.unpack(
+                "<QQQd", fh.read(struct.calcsize("<QQQd"))
+            )
+            bloom = cls(
+                max(1, count),
+                error_rate=error_rate,
+                num_bits=num_bits,
+                num_hashes=num_hashes,
+            )
+            bloom.bits = bytearray(fh.read())
+            bloom.count = count
+        return bloom
+
+
+"""Key for a feature or probe: chromosome as stored in the table plus UCSC bin
+"""
+
+
+def binKey(chrom, bin):
+    return f"{chrom}:{bin}"
+
+
+"""Keys of a feature covering the closed interval [start, end]
+"""
+
+
+def featureKey(chrom, start, end):
+    return binKey(chrom, u.binFromRange(int(start), int(end) + 1))
+
+
+"""Wraps a table's filter and keeps the per-stage counters for job metrics
+"""
+
+
+class Prescreen(object):
+    def __init__(self, table, bloom):
+        self.table = table
+        self.bloom = bloom
+        self.probes = 0
+        self.skipped = 0
+        self.false_positives = 0
+
+    def mayContain(self, chrom, pos):
+        self.probes = self.probes + 1
+        if self.check(chrom, pos):
+            return True
+        self.skipped = self.skipped + 1
+        return False
+
+    """Filter test without touching the counters (for read-ahead lookups)
+    """
+
+    def check(self, chrom, pos):
+        pos = int(pos)
+        for bin in u.binsOverlapping(pos, pos + 1):
+            if binKey(chrom, bin) in self.bloom:
+                return True
+        return False
+
+    """Called by the stage when a lookup the filter let through came back empty
+    """
+
+    def recordMiss(self):
+        self.false_positives = self.false_positives + 1
+
+    def stats(self):
+        negatives = self.skipped + self.false_positives
+        fp_rate = (self.false_positives / float(negatives)) if negatives > 0 else 0.0
+        return {
+            "stage": self.table,
+            "prescreen": "bloom",
+            "probes": self.probes,
+            "skipped_lookups": self.skipped,
+            "false_positives": self.false_positives,
+            "false_positive_rate": round(fp_rate, 6),
+        }
+
+
+### EOF
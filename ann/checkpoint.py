@@ -0,0 +1,237 @@
+# checkpoint.py
+#
+# Chunk-level checkpoints of annotation jobs, for resuming interrupted jobs
+#
+# A job whose instance dies (spot reclaim, scale-in, OOM) reappears on the
+# queue and used to be annotated again from its first line. With
+# CheckpointVariants set, the job's input is annotated in runs of that many
+# variants, each run going through all the stages on its own. After every
+# run a durable checkpoint is written to the results bucket: the run's
+# annotated output as a part object, and a state object holding the input
+# byte offset reached and each run's count log (the stage counters). An
+# annotator that picks the job up again downloads the finished parts and
+# carries on from the saved offset.
+#
+# The job's output is the concatenation of the runs' outputs and its count
+# log the merge of theirs (scatter.mergeCountLogs), as for a split job, so
+# a resumed job produces exactly the output of an uninterrupted one. With
+# SortInput the whole input is sorted once before it is cut into runs (the
+# runs are not sorted again, and the offsets are those of the sorted input)
+# and with RestoreInputOrder the job's output is put back in input order
+# once all the runs are done, as driver.run does for a job run in one go.
+#
+# interrupt() (the annotator's drain on scale-in) makes run() stop after the
+# run in progress is checkpointed, raising Interrupted, so the job can be
+# handed to another instance without losing any finished run.
+#
+##
+
+import json
+import os
+import shutil
+
+import boto3
+from botocore.exceptions import ClientError
+
+import driver
+import file_utils as fu
+import reference as ref
+import scatter
+import vcf_sort as vs
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+
+# Variants per checkpoint; 0 disables checkpoints
+CHECKPOINT_VARIANTS = ref.config.getint("ann", "CheckpointVariants", fallback=0)
+
+
+# Set by interrupt(); checked after every run
+_interrupted = False
+
+
+class Interrupted(Exception):
+    pass
+
+
+def enabled():
+    return CHECKPOINT_VARIANTS > 0
+
+
+"""Asks run() to stop at its next checkpoint; safe to call from a signal
+   handler
+"""
+
+
+def interrupt():
+    global _interrupted
+    _interrupted = True
+
+
+def _client(s3):
+    return s3 or boto3.client("s3", region_name=AWS_REGION)
+
+
+def _prefix(job_id):
+    return f"{scatter.RESULTS_PREFIX}/{job_id}/checkpoint"
+
+
+"""The job's saved state, None when it has no checkpoint
+"""
+
+
+def load(job_id, s3=None, bucket=None):
+    try:
+        response = _client(s3).get_object(
+            Bucket=bucket or scatter.RESULTS_BUCKET_NAME,
+            Key=_prefix(job_id) + "/state.json",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read().decode("utf-8"))
+
+
+def save(job_id, state, s3=None, bucket=None):
+    _client(s3).put_object(
+        Bucket=bucket or scatter.RESULTS_BUCKET_NAME,
+        Key=_prefix(job_id) + "/state.json",
+        Body=json.dumps(state).encode("utf-8"),
+    )
+
+
+"""Deletes the job's checkpoint once its results are published
+"""
+
+
+def clear(job_id, s3=None, bucket=None):
+    s3 = _client(s3)
+    bucket = bucket or scatter.RESULTS_BUCKET_NAME
+    state = load(job_id, s3, bucket)
+    if state is None:
+        return
+    for key in state["parts"]:
+        s3.delete_object(Bucket=bucket, Key=key)
+    s3.delete_object(Bucket=bucket, Key=_prefix(job_id) + "/state.json")
+
+
+"""Copies the next run of input lines (the header lines first, then up to
+   variants data lines) to fh_out; returns the number of data lines
+"""
+
+
+def _readRun(fh, fh_out, variants):
+    count = 0
+    while count < variants:
+        line = fh.readline()
+        if not line:
+            break
+        fh_out.write(line)
+        if not line.startswith(b"#"):
+            count = count + 1
+    return count
+
+
+"""Annotates infile in runs of variants variants, checkpointing after each
+   one and resuming from the job's checkpoint if it has one; leaves the same
+   results and count log files as driver.run. Raises Interrupted after a
+   checkpoint once interrupt() was called during this job
+"""
+
+
+def run(
+    infile, format, progress=None, variants=CHECKPOINT_VARIANTS, s3=None, bucket=None
+):
+    global _interrupted
+    _interrupted = False
+    s3 = _client(s3)
+    bucket = bucket or scatter.RESULTS_BUCKET_NAME
+    job_id = os.path.basename(infile).split("~")[0]
+
+    # The sort is deterministic, so a resumed job gets the same sorted input
+    order_file = None
+    if vs.SORT_INPUT and not vs.isSorted(infile):
+        if vs.RESTORE_INPUT_ORDER:
+            order_file = infile + ".order"
+        vs.sortVcf(infile, infile + ".sorted", order_file=order_file)
+        os.replace(infile + ".sorted", infile)
+        print("Sort input - done.")
+    size = os.path.getsize(infile)
+    variants = max(1, int(variants))
+
+    state = load(job_id, s3, bucket)
+    if state is not None and (state["size"] != size or state["variants"] != variants):
+        print("Checkpoint does not match the input - starting over.")
+        clear(job_id, s3, bucket)
+        state = None
+    if state is None:
+        state = {
+            "size": size,
+            "variants": variants,
+            "offset": 0,
+            "parts": [],
+            "count_logs": [],
+        }
+
+    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+    run_dir = infile + ".runs"
+    os.makedirs(run_dir, exist_ok=True)
+    run_file = os.path.join(run_dir, os.path.basename(infile))
+    run_out = (run_file + ".annot").replace(".vcf.annot", ".annot.vcf")
+    metrics_file = infile + ".metrics.log"
+
+    with open(finalout, "wb") as fh_out, open(infile, "rb") as fh:
+        for key in state["parts"]:
+            shutil.copyfileobj(s3.get_object(Bucket=bucket, Key=key)["Body"], fh_out)
+        if state["parts"]:
+            print(
+                f"Resuming from checkpoint - {len(state['parts'])} runs, "
+                + f"{state['offset']} of {size} bytes done."
+            )
+
+        fh.seek(state["offset"])
+        while True:
+            start = state["offset"]
+            with open(run_file, "wb") as fh_run:
+                _readRun(fh, fh_run, variants)
+            end = fh.tell()
+
+            def report(fraction, start=start, end=end):
+                if progress is not None and size > 0:
+                    progress((start + fraction * (end - start)) / float(size))
+
+            driver.run(run_file, format, progress=report, sort_input=False)
+
+            key = f"{_prefix(job_id)}/part-{len(state['parts']):05d}.annot.vcf"
+            s3.upload_file(run_out, bucket, key)
+            with open(run_out, "rb") as fh_run:
+                shutil.copyfileobj(fh_run, fh_out)
+            with open(run_file + ".count.log") as fh_log:
+                state["count_logs"].append(fh_log.read())
+            if os.path.exists(run_file + ".metrics.log"):
+                with open(run_file + ".metrics.log") as fh_in, open(
+                    metrics_file, "a"
+                ) as fh_metrics:
+                    shutil.copyfileobj(fh_in, fh_metrics)
+            state["parts"].append(key)
+            state["offset"] = end
+            save(job_id, state, s3, bucket)
+            print(f"Checkpoint - {end} of {size} bytes done.")
+
+            for name in (run_out, run_file + ".count.log", run_file + ".metrics.log"):
+                if os.path.exists(name):
+                    fu.delete(name)
+            if end >= size:
+                break
+            if _interrupted:
+                raise Interrupted(f"Stopped at checkpoint, {end} of {size} bytes done")
+
+    if order_file is not None:
+        vs.restoreOrder(finalout, order_file, finalout)
+        fu.delete(order_file)
+    with open(infile + ".count.log", "w") as fh_log:
+        fh_log.write(scatter.mergeCountLogs(state["count_logs"]))
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+
+### EOF
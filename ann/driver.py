@@ -12,168 +12,328 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import time
 import file_utils as fu
 import annotate as ann
+import vcf_sort as vs
+import lookups as lk
+import planner as pl
+import reference as ref
+import utils as u
 
+# Annotation stages run by run(), named by the table they annotate from
+STAGE_NAMES = [
+    "dbSNP",
+    "bigRefGene",
+    "refGene",
+    "cytoBand",
+    "gadAll",
+    "gwasCatalog",
+    "targetScanS",
+    "hugo",
+    "dgv_Cnv",
+    "abParts_IG_T_CelReceptors",
+    "mcCarroll_Cnv",
+    "conrad_Cnv",
+    "genomicSuperDups",
+    "tfbsConsSites",
+]
+STAGES = len(STAGE_NAMES)
 
-def run(infile, format):
+
+"""Data lines of the job, from the count log the first stage writes
+"""
+
+
+def countVariants(infile):
+    with open(infile + ".count.log") as fh:
+        for line in fh:
+            if line.startswith("Total:"):
+                return int(line.split(":")[1]) - 1
+    return 0
+
+
+def run(
+    infile,
+    format,
+    sort_input=vs.SORT_INPUT,
+    restore_order=vs.RESTORE_INPUT_ORDER,
+    use_planner=pl.PLANNER,
+    progress=None,
+    source=None,
+    sink=None,
+):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+    ## Wall time of each stage, for its throughput in the job metrics, and
+    ## its start and end (epoch milliseconds) for the job's trace
+    stage_seconds = {}
+    stage_spans = {}
+    clock = [time.perf_counter(), time.time()]
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    ## progress, if given, is called with the fraction of stages done; sink,
+    ## if given, is called to open a writer the last stage streams the final
+    ## output to (unless the input order must be restored from a local file)
+    ## and run() returns that writer, else None
+    def report(done):
+        now = time.perf_counter()
+        stage_seconds[STAGE_NAMES[done - 1]] = round(now - clock[0], 6)
+        stage_spans[STAGE_NAMES[done - 1]] = [
+            int(clock[1] * 1000),
+            int(time.time() * 1000),
+        ]
+        clock[0] = now
+        clock[1] = time.time()
+        if progress is not None:
+            progress(done / float(STAGES))
+
+    ## Sorting, the read-ahead key source (batch, pipeline) and the engine
+    ## choice need the whole input on local disk; a streamed input gets them
+    ## from the first stage's output, which has the same data lines
+    def prepare(path, tables):
+        ## Coordinate-sort (in place) so range lookups see sorted positions
+        order_file = None
+        if sort_input and not vs.isSorted(path):
+            if restore_order:
+                order_file = infile + ".order"
+            vs.sortVcf(path, path + ".sorted", order_file=order_file)
+            os.replace(path + ".sorted", path)
+            print("Sort input - done.")
+
+        lk.setKeySource(path)
+
+        ## Choose a lookup engine per table from the shape of the input
+        profile = None
+        choices = None
+        if use_planner:
+            profile = pl.profileInput(path)
+            choices = pl.plan(profile, tables)
+        return order_file, profile, choices
+
+    ## After stage n its input (.n-1) is no longer needed, unless it is the
+    ## key source of the read-ahead engines
+    def advance(done):
+        previous = infile + "." + str(done - 1)
+        if previous != keys_file:
+            fu.delete(previous)
+        report(done)
+
+    ## A pooled worker runs the next job in this process: the engine choices
+    ## and key source of this one go, whether its stages finish or raise
+    try:
+        if source is None:
+            keys_file = infile
+            order_file, profile, choices = prepare(infile, ref.STAGE_TABLES)
+            clock[0] = time.perf_counter()
+            clock[1] = time.time()
+            ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
+        else:
+            ## Stream the input straight into the first stage; no local copy
+            keys_file = infile + ".1"
+            ann.getSnpsFromDbSnp(
+                vcf=infile, format="vcf", tmpextin="", tmpextout=".1", source=source
+            )
+            if hasattr(source, "stats"):
+                u.logStageMetrics(infile, source.stats())
+            order_file, profile, choices = prepare(
+                keys_file, [t for t in ref.STAGE_TABLES if t != "dbSNP"]
+            )
+        print("dbSNP - done.")
+        tmpextin = 1
+        tmpextout = 2
+        report(tmpextin)
+
+        ann.getBigRefGene(
+            vcf=infile,
+            format="vcf",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("BigRefGene - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.getGenes(
+            vcf=infile,
+            format="vcf",
+            table="refGene",
+            promoter_offset=500,
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("BigRefGene - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithCytoband(
+            vcf=infile,
+            format="vcf",
+            table="cytoBand",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("Cytoband - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithGadAll(
+            vcf=infile,
+            format="vcf",
+            table="gadAll",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("gadAll - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithGwasCatalog(
+            vcf=infile,
+            format="vcf",
+            table="gwasCatalog",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("GwasCatalog - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithMiRNA(
+            vcf=infile,
+            format="vcf",
+            table="targetScanS",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("miRNA - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWitHUGOGeneNomenclature(
+            vcf=infile,
+            format="vcf",
+            table="hugo",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("HUGO Gene Nomenclature Committee - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="dgv_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("dgv_Cnv - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="abParts_IG_T_CelReceptors",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("abParts_IG_T_CelReceptors - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="mcCarroll_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("mcCarroll_Cnv - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="conrad_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("conrad_Cnv - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        ann.addOverlapWithGenomicSuperDups(
+            vcf=infile,
+            format="vcf",
+            table="genomicSuperDups",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
+        print("genomicSuperDups - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        out = None
+        if sink is not None and order_file is None:
+            out = sink()
+        ann.addOverlapWithTfbsConsSites(
+            vcf=infile,
+            table="tfbsConsSites",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+            sink=out,
+        )
+        print("addOverlapWithTfbsConsSites - done.")
+        tmpextin = tmpextin + 1
+        tmpextout = tmpextout + 1
+        advance(tmpextin)
+
+        if choices is not None:
+            pl.report(choices, profile, infile)
+    finally:
+        lk.resetEngines()
+        lk.setKeySource(None)
+    u.logStageMetrics(
+        infile,
+        {
+            "stage": "driver",
+            "variants": countVariants(infile),
+            "stage_seconds": stage_seconds,
+            "stage_spans": stage_spans,
+        },
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
     ## Cleanup
     for i in range(1, tmpextin):
         fu.delete(infile + "." + str(i))
 
+    if out is not None:
+        return out
+
     os.rename(infile + "." + str(tmpextin), infile + ".annot")
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
     os.rename(infile + ".annot", finalout)
 
+    if order_file is not None:
+        vs.restoreOrder(finalout, order_file, finalout)
+        fu.delete(order_file)
+        print("Restore input order - done.")
+    return None
+
 
 ### EOF
@@ -0,0 +1,113 @@
+# heartbeat.py
+#
+# SQS visibility heartbeat for running annotation jobs
+#
+# A job's message stays invisible only for the visibility timeout; a job
+# that outlives it reappears on the queue and gets annotated twice. While a
+# job runs, a background thread keeps pushing its message's visibility out
+# with ChangeMessageVisibility. Each extension is sized from the job's
+# progress (elapsed time and fraction of stages done give the expected time
+# left), so long jobs are covered without holding a failed job's message for
+# hours. Jobs are unregistered when they finish, before their message is
+# deleted, and the thread stops cleanly with the poller.
+#
+##
+
+import logging
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+# SQS caps a message's total visibility at 12 hours from its receipt
+MAX_VISIBILITY = 43200
+
+# Expected time left is padded by this factor
+SAFETY_FACTOR = 1.5
+
+
+class Heartbeat(object):
+    def __init__(
+        self, queue_url, region, progress, interval=30, initial_visibility=300
+    ):
+        self.queue_url = queue_url
+        self.sqs = boto3.client("sqs", region_name=region)
+        self.progress = progress
+        self.interval = interval
+        self.initial_visibility = initial_visibility
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def register(self, job_id, receipt_handle):
+        now = time.time()
+        with self.lock:
+            self.jobs[job_id] = {
+                "receipt_handle": receipt_handle,
+                "received": now,
+                "started": now,
+                "expires": now,
+            }
+        self._extend(job_id, self.initial_visibility)
+
+    def unregister(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    """Seconds of visibility to ask for: the expected time left, padded, at
+       least two heartbeats and within the 12 hour limit
+    """
+
+    def timeout(self, job, now):
+        elapsed = now - job["started"]
+        fraction = self.progress(job["job_id"]) or 0.0
+        if fraction > 0:
+            remaining = elapsed * (1.0 - fraction) / fraction
+        else:
+            remaining = max(elapsed, self.initial_visibility)
+        timeout = int(remaining * SAFETY_FACTOR) + 2 * self.interval
+        timeout = max(timeout, 2 * self.interval)
+        return min(timeout, int(MAX_VISIBILITY - (now - job["received"])))
+
+    def _extend(self, job_id, timeout):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            receipt_handle = job["receipt_handle"]
+        if timeout <= 0:
+            return
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=timeout,
+            )
+        except ClientError as e:
+            logging.error(f"Failed to extend visibility of job {job_id}: {str(e)}")
+            return
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id]["expires"] = time.time() + timeout
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            now = time.time()
+            with self.lock:
+                due = [
+                    dict(job, job_id=job_id)
+                    for job_id, job in self.jobs.items()
+                    if job["expires"] - now < 2 * self.interval
+                ]
+            for job in due:
+                self._extend(job["job_id"], self.timeout(job, now))
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+
+### EOF
@@ -0,0 +1,233 @@
+# index_advisor.py
+#
+# Reference-database index advisor for the annotator schema
+#
+# Knows the query shape of every annotation stage (reference.TABLES plus the
+# CNV/HGNC tables the driver passes by name), reports the composite indexes
+# those queries need but the schema lacks, optionally creates them, and
+# captures EXPLAIN plans and sample query latency before and after.
+#
+# Usage:
+#   python index_advisor.py [--apply] [--covering] [--repeat N]
+#                           [--report FILE] [table ...]
+#
+# The JSON report goes to FILE or to stdout; progress goes to stderr.
+#
+##
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import lookups as lk
+import reference as ref
+import utils as u
+
+# Columns the stages always filter on besides chrom/position
+MATCH_COLUMNS = {"dbSNP": ["INFO"]}
+
+# Name prefix that marks indexes created by the advisor
+INDEX_PREFIX = "gas_"
+
+# Prefix length used when an indexed column is TEXT/BLOB
+TEXT_PREFIX_LENGTH = 32
+
+
+"""Index columns matching a stage's query: equality columns first (chrom,
+   bin for range queries), then the position and match columns
+"""
+
+
+def desiredIndex(spec, covering=False):
+    cols = []
+    if not spec.per_chrom:
+        cols.append(spec.chrom_col)
+    if spec.binned and spec.end_col != spec.start_col:
+        cols.append("bin")
+    cols.append(spec.start_col)
+    cols = cols + MATCH_COLUMNS.get(spec.table, [])
+    if spec.end_col != spec.start_col:
+        cols.append(spec.end_col)
+    if covering and spec.columns != "*":
+        cols = cols + [
+            c.strip() for c in spec.columns.split(",") if c.strip() not in cols
+        ]
+    return cols
+
+
+def existingIndexes(cursor, table):
+    cursor.execute(
+        "select INDEX_NAME, COLUMN_NAME from information_schema.STATISTICS"
+        + " where TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+        + " order by INDEX_NAME, SEQ_IN_INDEX;",
+        (table,),
+    )
+    indexes = {}
+    for name, column in cursor.fetchall():
+        indexes.setdefault(name, []).append(column)
+    return indexes
+
+
+def columnTypes(cursor, table):
+    cursor.execute(
+        "select COLUMN_NAME, DATA_TYPE from information_schema.COLUMNS"
+        + " where TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s;",
+        (table,),
+    )
+    return dict([(c, str(t).lower()) for c, t in cursor.fetchall()])
+
+
+"""An existing index serves the query when the desired columns are a prefix
+   of its column list
+"""
+
+
+def isCovered(indexes, cols):
+    for existing in indexes.values():
+        if existing[: len(cols)] == cols:
+            return True
+    return False
+
+
+def indexDdl(table, cols, types):
+    parts = []
+    for c in cols:
+        if "text" in types.get(c, "") or "blob" in types.get(c, ""):
+            parts.append(f"{c}({TEXT_PREFIX_LENGTH})")
+        else:
+            parts.append(c)
+    name = INDEX_PREFIX + "_".join(cols)[:60]
+    return f"alter table {table} add index {name} ({', '.join(parts)});"
+
+
+"""Representative stage query: the first feature of the table, shaped exactly
+   as SqlLookup would issue it
+"""
+
+
+def sampleQuery(cursor, spec, table):
+    cursor.execute(f"select {spec.chrom_col}, {spec.start_col} from {table} limit 1;")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    sql = lk.SqlLookup(spec, cursor).rangeSql(row[0], int(row[1]), int(row[1]))
+    if spec.table in MATCH_COLUMNS:
+        cursor.execute(
+            f"select {', '.join(MATCH_COLUMNS[spec.table])} from {table}"
+            + f" where {spec.chrom_col} = %s AND {spec.start_col} = %s limit 1;",
+            (row[0], row[1]),
+        )
+        values = cursor.fetchone()
+        if values is not None:
+            sql = sql + lk.matchSql([dict(zip(MATCH_COLUMNS[spec.table], values))])
+    return sql
+
+
+def explain(cursor, sql):
+    cursor.execute("explain " + sql)
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, [str(v) for v in row])) for row in cursor.fetchall()]
+
+
+def timeQuery(cursor, sql, repeat):
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(sql)
+        cursor.fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(samples), 4)
+
+
+def measure(cursor, spec, table, repeat):
+    sql = sampleQuery(cursor, spec, table)
+    if sql is None:
+        return None
+    return {
+        "query": sql,
+        "explain": explain(cursor, sql),
+        "median_ms": timeQuery(cursor, sql, repeat),
+    }
+
+
+def advise(conn, tables, apply=False, covering=False, repeat=20):
+    cursor = conn.cursor()
+    report = []
+    for name in tables:
+        spec = ref.tableSpec(name)
+        for table in ref.tableNames(spec):
+            types = columnTypes(cursor, table)
+            entry = {"stage": spec.table, "table": table}
+            if not types:
+                entry["error"] = "table not found"
+                report.append(entry)
+                continue
+            if spec.binned and "bin" not in types:
+                # SqlLookup would fail on this table; the spec must be fixed
+                entry["error"] = "spec says binned but table has no bin column"
+                report.append(entry)
+                continue
+
+            cols = desiredIndex(spec, covering=covering)
+            indexes = existingIndexes(cursor, table)
+            entry["existing_indexes"] = indexes
+            entry["desired_index"] = cols
+            entry["missing"] = not isCovered(indexes, cols)
+            entry["before"] = measure(cursor, spec, table, repeat)
+
+            if entry["missing"]:
+                entry["ddl"] = indexDdl(table, cols, types)
+                print(f"{table}: missing index ({', '.join(cols)})", file=sys.stderr)
+                if apply:
+                    cursor.execute(entry["ddl"])
+                    conn.commit()
+                    entry["after"] = measure(cursor, spec, table, repeat)
+                    if entry["before"] and entry["after"]:
+                        print(
+                            f"{table}: {entry['before']['median_ms']} ms -> "
+                            + f"{entry['after']['median_ms']} ms",
+                            file=sys.stderr,
+                        )
+            else:
+                print(f"{table}: ok", file=sys.stderr)
+            report.append(entry)
+    cursor.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotator index advisor")
+    parser.add_argument("tables", nargs="*", help="stage tables (default: all)")
+    parser.add_argument("--apply", action="store_true", help="create missing indexes")
+    parser.add_argument(
+        "--covering", action="store_true", help="add selected columns to the index"
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per query")
+    parser.add_argument("--report", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    conn = u.db_connect()
+    try:
+        report = advise(
+            conn,
+            args.tables or ref.STAGE_TABLES,
+            apply=args.apply,
+            covering=args.covering,
+            repeat=args.repeat,
+        )
+    finally:
+        conn.close()
+
+    if args.report:
+        with open(args.report, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
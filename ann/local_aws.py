@@ -0,0 +1,243 @@
+# local_aws.py
+#
+# In-memory stand-ins for the S3, SQS and DynamoDB calls the annotator makes
+#
+# They implement just the calls (and the UpdateExpression forms) used by the
+# annotator modules, with the same arguments and response shapes as boto3,
+# so flows such as scatter-gather (scatter.py) can be run and checked on one
+# machine without AWS:
+#   s3 = LocalS3(); queue = LocalQueue(); table = LocalTable("job_id")
+#   scatter.split(data, size, s3, queue, table)
+# scatter_check.py runs the whole scatter-gather flow on them.
+#
+##
+
+import collections
+import io
+import json
+import re
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+def _error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+# SET name = list_append(if_not_exists(name, :empty), :values)
+LIST_APPEND = re.compile(
+    r"list_append\(\s*if_not_exists\(\s*(\w+)\s*,\s*(:\w+)\s*\)\s*,\s*(:\w+)\s*\)"
+)
+
+
+"""Clauses of an update action, split at the commas outside parentheses
+"""
+
+
+def _assignments(body):
+    assignments = []
+    depth = 0
+    current = ""
+    for c in body:
+        if c == "," and depth == 0:
+            assignments.append(current.strip())
+            current = ""
+            continue
+        if c == "(":
+            depth = depth + 1
+        elif c == ")":
+            depth = depth - 1
+        current = current + c
+    assignments.append(current.strip())
+    return [a for a in assignments if a]
+
+
+"""S3 client: objects are bytes kept per (bucket, key)
+"""
+
+
+class LocalS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def _get(self, bucket, key, operation):
+        if (bucket, key) not in self.objects:
+            raise _error("NoSuchKey", operation)
+        return self.objects[(bucket, key)]
+
+    def put_object(self, Bucket, Key, Body=b""):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as fh:
+            self.put_object(Bucket, Key, fh.read())
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, "wb") as fh:
+            fh.write(self._get(Bucket, Key, "GetObject"))
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self._get(Bucket, Key, "HeadObject"))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self._get(Bucket, Key, "GetObject")
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def list_objects_v2(self, Bucket, Prefix=""):
+        keys = sorted(
+            [k for b, k in self.objects if b == Bucket and k.startswith(Prefix)]
+        )
+        return {
+            "Contents": [
+                {"Key": k, "Size": len(self.objects[(Bucket, k)])} for k in keys
+            ],
+            "KeyCount": len(keys),
+        }
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"{UploadId}-{PartNumber}"}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource):
+        data = self._get(CopySource["Bucket"], CopySource["Key"], "UploadPartCopy")
+        self.uploads[UploadId][PartNumber] = data
+        return {"CopyPartResult": {"ETag": f"{UploadId}-{PartNumber}"}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        if numbers != sorted(numbers) or set(numbers) != set(parts):
+            raise _error("InvalidPart", "CompleteMultipartUpload")
+        self.objects[(Bucket, Key)] = b"".join([parts[n] for n in numbers])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+class LocalMessage(object):
+    def __init__(self, queue, body):
+        self.queue = queue
+        self.body = body
+        self.receipt_handle = uuid.uuid4().hex
+
+    def delete(self):
+        self.queue.inflight.pop(self.receipt_handle, None)
+
+    def change_visibility(self, VisibilityTimeout):
+        if VisibilityTimeout == 0 and self.receipt_handle in self.queue.inflight:
+            del self.queue.inflight[self.receipt_handle]
+            self.queue.messages.append(self.body)
+
+
+"""SQS queue resource: received messages stay in flight until deleted or
+   handed back (visibility timeouts do not expire)
+"""
+
+
+class LocalQueue(object):
+    def __init__(self):
+        self.messages = collections.deque()
+        self.inflight = {}
+
+    def send_message(self, MessageBody):
+        self.messages.append(MessageBody)
+        return {"MessageId": uuid.uuid4().hex}
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        received = []
+        while self.messages and len(received) < MaxNumberOfMessages:
+            message = LocalMessage(self, self.messages.popleft())
+            self.inflight[message.receipt_handle] = message
+            received.append(message)
+        return received
+
+    def bodies(self):
+        return [json.loads(body) for body in self.messages]
+
+
+"""DynamoDB table resource supporting "SET a = :x, b = :y", "ADD a :x"
+   (numbers and sets) and the condition "attribute_not_exists(a)"
+"""
+
+
+class LocalTable(object):
+    def __init__(self, key="job_id"):
+        self.key = key
+        self.items = {}
+
+    def put_item(self, Item):
+        self.items[Item[self.key]] = dict(Item)
+        return {}
+
+    def get_item(self, Key):
+        item = self.items.get(Key[self.key])
+        return {"Item": dict(item)} if item is not None else {}
+
+    def update_item(
+        self,
+        Key,
+        UpdateExpression,
+        ExpressionAttributeValues=None,
+        ConditionExpression=None,
+        ReturnValues="NONE",
+    ):
+        values = ExpressionAttributeValues or {}
+        item = self.items.setdefault(Key[self.key], dict(Key))
+        if ConditionExpression is not None:
+            m = re.fullmatch(
+                r"\s*attribute_not_exists\((\w+)\)\s*", ConditionExpression
+            )
+            if m is None:
+                raise NotImplementedError(ConditionExpression)
+            if m.group(1) in item:
+                raise _error("ConditionalCheckFailedException", "UpdateItem")
+
+        updated = {}
+        clauses = re.split(r"\b(SET|ADD)\b", UpdateExpression)
+        for action, body in zip(clauses[1::2], clauses[2::2]):
+            for assignment in _assignments(body):
+                if action == "SET":
+                    name, value = [x.strip() for x in assignment.split("=", 1)]
+                    m = LIST_APPEND.fullmatch(value)
+                    if m is not None:
+                        existing = item.get(m.group(1), values[m.group(2)])
+                        item[name] = list(existing) + list(values[m.group(3)])
+                    else:
+                        item[name] = values[value]
+                else:
+                    name, value = assignment.split()
+                    if isinstance(values[value], (set, frozenset)):
+                        item[name] = set(item.get(name, set())) | values[value]
+                    else:
+                        item[name] = item.get(name, 0) + values[value]
+                updated[name] = item[name]
+
+        if ReturnValues == "UPDATED_NEW":
+            return {"Attributes": dict(updated)}
+        if ReturnValues == "ALL_NEW":
+            return {"Attributes": dict(item)}
+        return {}
+
+
+### EOF
@@ -0,0 +1,210 @@
+# lookup_broker.py
+#
+# Annotator-level broker coalescing reference lookups across jobs
+#
+# When many small jobs run at once, each worker queries the same reference
+# tables for its own variants. The broker runs in the poller process, next
+# to the worker pool: every worker sends its lookup batches to it over a
+# pipe (lookups.BrokeredLookup), and the broker gathers the requests of all
+# running jobs per table. A table's requests are flushed as shared UNION ALL
+# queries (keys asked by several jobs are fetched once) when they reach
+# BrokerBatchSize keys, when the oldest has waited BrokerDeadlineMs or when
+# every active worker is waiting on one, and each job gets back the rows of
+# its own keys only.
+#
+##
+
+import logging
+import multiprocessing.connection as mpc
+import threading
+import time
+
+import lookups as lk
+import reference as ref
+import utils as u
+
+BATCH_SIZE = ref.config.getint("ann", "BrokerBatchSize", fallback=1000)
+DEADLINE = ref.config.getfloat("ann", "BrokerDeadlineMs", fallback=5.0) / 1000.0
+
+# Workers that sent a request within this many seconds count as running jobs
+ACTIVE_WINDOW = 1.0
+
+
+"""Worker side: sends a batch of keys and waits for its rows
+"""
+
+
+class BrokerClient(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def query(self, spec, pad, keys):
+        with self.lock:
+            try:
+                self.conn.send((spec, pad, keys))
+                reply = self.conn.recv()
+            except (EOFError, OSError) as e:
+                raise lk.BrokerError(f"Lookup broker unavailable: {str(e)}")
+        if reply[0] != "ok":
+            raise lk.BrokerError(reply[1])
+        return reply[1:]
+
+
+class Broker(object):
+    def __init__(self, batch_size=BATCH_SIZE, deadline=DEADLINE):
+        self.batch_size = max(1, int(batch_size))
+        self.deadline = max(0.0, float(deadline))
+        self.conns = []
+        self.lock = threading.Lock()
+        self.wake, self.waker = mpc.Pipe(duplex=False)
+        # (spec, pad) -> [(conn, keys, arrival time)]
+        self.pending = {}
+        # conn -> time of its last request
+        self.seen = {}
+        self.lookups = {}
+        self.db = None
+        self.stopping = False
+        self.requests = 0
+        self.keys = 0
+        self.queries = 0
+        self.deduplicated = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    """Starts the broker's thread; the pool forks its workers before (a child
+       forked while a thread holds a lock can deadlock on it)
+    """
+
+    def start(self):
+        self.thread.start()
+
+    """Returns the end of a new pipe for a worker to build its BrokerClient on
+    """
+
+    def connect(self):
+        conn, worker_conn = mpc.Pipe()
+        with self.lock:
+            self.conns.append(conn)
+        self.waker.send(None)
+        return worker_conn
+
+    def _lookup(self, spec, pad):
+        if self.db is None:
+            self.db = u.db_connect()
+            self.lookups = {}
+        if (spec, pad) not in self.lookups:
+            self.lookups[(spec, pad)] = lk.BatchedLookup(
+                spec, self.db.cursor(), None, pad=pad
+            )
+        return self.lookups[(spec, pad)]
+
+    def _flush(self, group, requests):
+        keys = []
+        seen = set()
+        for conn, request_keys, arrived in requests:
+            for key in request_keys:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        self.requests = self.requests + len(requests)
+        self.keys = self.keys + sum([len(r[1]) for r in requests])
+        self.deduplicated = self.deduplicated + len(keys)
+        try:
+            lookup = self._lookup(*group)
+            found = {}
+            names = None
+            for i in range(0, len(keys), self.batch_size):
+                chunk = keys[i : i + self.batch_size]
+                names, rows = lookup._query(chunk)
+                found.update(zip(chunk, rows))
+                self.queries = self.queries + 1
+            replies = [
+                ("ok", names, [found[k] for k in r[1]], len(requests) - 1)
+                for r in requests
+            ]
+        except Exception as e:
+            logging.error(f"Lookup broker query on {group[0].table} failed: {str(e)}")
+            self._disconnect()
+            replies = [("error", str(e)) for r in requests]
+        for (conn, request_keys, arrived), reply in zip(requests, replies):
+            try:
+                conn.send(reply)
+            except (EOFError, OSError):
+                pass
+
+    def _disconnect(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+        self.db = None
+
+    def _receive(self, timeout):
+        with self.lock:
+            conns = list(self.conns)
+        for conn in mpc.wait(conns + [self.wake], timeout):
+            if conn is self.wake:
+                self.wake.recv()
+                continue
+            try:
+                spec, pad, keys = conn.recv()
+            except (EOFError, OSError):
+                # The worker exited
+                with self.lock:
+                    self.conns.remove(conn)
+                self.seen.pop(conn, None)
+                conn.close()
+                continue
+            now = time.perf_counter()
+            self.seen[conn] = now
+            self.pending.setdefault((spec, pad), []).append((conn, keys, now))
+
+    """Workers wait on one request at a time: once every worker that asked
+       for something recently is waiting, no more requests can join
+    """
+
+    def _everyoneWaiting(self, now):
+        waiting = sum([len(r) for r in self.pending.values()])
+        active = len([t for t in self.seen.values() if now - t < ACTIVE_WINDOW])
+        return waiting >= active
+
+    def _run(self):
+        while not self.stopping:
+            timeout = None
+            if self.pending:
+                oldest = min([r[0][2] for r in self.pending.values()])
+                timeout = max(0.0, oldest + self.deadline - time.perf_counter())
+            self._receive(timeout)
+            now = time.perf_counter()
+            everyone = self._everyoneWaiting(now)
+            for group, requests in list(self.pending.items()):
+                size = sum([len(r[1]) for r in requests])
+                if (
+                    everyone
+                    or size >= self.batch_size
+                    or requests[0][2] + self.deadline <= now
+                ):
+                    del self.pending[group]
+                    self._flush(group, requests)
+        self._disconnect()
+
+    def stop(self):
+        self.stopping = True
+        self.waker.send(None)
+        self.thread.join()
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "keys": self.keys,
+            "distinct_keys": self.deduplicated,
+            "queries": self.queries,
+        }
+
+
+### EOF
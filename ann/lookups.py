@@ -0,0 +1,858 @@
+# lookups.py
+#
+# Reference lookup backends for the annotation stages
+#
+# Each stage asks a lookup for the reference rows overlapping one variant
+# position. SqlLookup queries the annotator database; on tables carrying the
+# UCSC bin column the range predicate is preceded by "bin in (...)", so MySQL
+# can use a (chrom, bin) index instead of scanning every row of the
+# chromosome. IndexLookup answers the same question from a binned in-memory
+# index loaded from the local reference snapshot (see reference.py), or
+# from its packed form memory-mapped and shared by all processes on the host
+# (see packed_index.py).
+#
+# WindowedLookup stays on the database but, for coordinate-sorted input,
+# fetches every row of a whole window of the chromosome with one query and
+# answers the variants falling in that window locally; the window size adapts
+# to the row density it observes. BatchedLookup reads ahead in the job's
+# input and fetches the rows of a batch of upcoming variants with one query;
+# PipelinedLookup queries the upcoming variants concurrently from a pool of
+# worker threads and hands the results back in input order. BrokeredLookup
+# sends its lookups to the annotator's lookup broker, which shares queries
+# between the jobs running at the same time.
+#
+# All keep probe counts, time spent and a latency histogram so that stages
+# can report per-stage lookup latency in the job metrics file.
+#
+##
+
+import bisect
+import collections
+import csv
+import os
+import queue
+import threading
+import time
+
+import metrics
+import packed_index as pi
+import reference as ref
+import utils as u
+import vcf_sort as vs
+
+# Default engine for tables not served from the local index: sql, batch,
+# pipeline or window
+LOOKUP_ENGINE = ref.config.get("ann", "LookupEngine", fallback="sql")
+WINDOW_SIZE = ref.config.getint("ann", "WindowSize", fallback=1000000)
+WINDOW_TARGET_ROWS = ref.config.getint("ann", "WindowTargetRows", fallback=5000)
+WINDOW_MIN_SIZE = 10000
+WINDOW_MAX_SIZE = 32000000
+BATCH_SIZE = ref.config.getint("ann", "BatchSize", fallback=200)
+BATCH_LOOKAHEAD = ref.config.getint("ann", "BatchLookahead", fallback=10000)
+PIPELINE_WORKERS = ref.config.getint("ann", "PipelineWorkers", fallback=4)
+PIPELINE_DEPTH = ref.config.getint("ann", "PipelineDepth", fallback=1000)
+
+# Tables a stage probes for only some of its variants (cpgIslandExt: near
+# the ends of the genes found); pipelining them would query every input key
+UNPIPELINED_TABLES = ("cpgIslandExt",)
+
+"""Rows are filtered per variant by "match": a list of {column: value}
+   dictionaries; a row qualifies when it equals every value of any one of them.
+   The database compares with its default, case-insensitive collation, so the
+   local engines compare case-insensitively too and every engine gives the
+   same rows
+"""
+
+
+def matchSql(match):
+    if not match:
+        return ""
+    groups = []
+    for m in match:
+        groups.append(
+            "(" + " AND ".join([f'{c}="{str(v)}"' for c, v in m.items()]) + ")"
+        )
+    return " AND (" + " OR ".join(groups) + ")"
+
+
+def rowMatches(row, colindex, match):
+    if not match:
+        return True
+    for m in match:
+        if all([str(row[colindex[c]]).upper() == str(v).upper() for c, v in m.items()]):
+            return True
+    return False
+
+
+"""Common bookkeeping: optional Bloom pre-screen, probe counts and timing
+"""
+
+
+class Lookup(object):
+    engine = None
+
+    def __init__(self, spec, pad=0, prescreen=None):
+        self.spec = spec
+        self.pad = int(pad)
+        self.prescreen = prescreen if self.pad == 0 else None
+        self.probes = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.latencies = [0] * (len(metrics.LATENCY_BUCKETS) + 1)
+
+    def fetch(self, chrom, pos, match=None, limit=None):
+        pos = int(pos)
+        if self.prescreen is not None and not self.prescreen.mayContain(chrom, pos):
+            return []
+
+        start = time.perf_counter()
+        rows = self._fetch(chrom, pos, match, limit)
+        elapsed = time.perf_counter() - start
+        self.seconds = self.seconds + elapsed
+        bucket = bisect.bisect_left(metrics.LATENCY_BUCKETS, elapsed)
+        self.latencies[bucket] = self.latencies[bucket] + 1
+        self.probes = self.probes + 1
+        self.rows = self.rows + len(rows)
+
+        if self.prescreen is not None and len(rows) == 0:
+            self.prescreen.recordMiss()
+        return rows
+
+    def _fetch(self, chrom, pos, match, limit):
+        raise NotImplementedError
+
+    """Releases what the lookup holds besides the stage's own cursor
+    """
+
+    def close(self):
+        pass
+
+    """Closes the lookup on leaving a with block (or a stage's ExitStack)
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def stats(self):
+        stats = {
+            "stage": self.spec.table,
+            "engine": self.engine,
+            "probes": self.probes,
+            "rows": self.rows,
+            "lookup_seconds": round(self.seconds, 6),
+            "mean_lookup_ms": (
+                round((self.seconds / self.probes) * 1000, 4) if self.probes else 0.0
+            ),
+            "lookup_latency_buckets": list(self.latencies),
+        }
+        if self.prescreen is not None:
+            stats.update(self.prescreen.stats())
+        return stats
+
+
+"""Per-variant query against the annotator database
+"""
+
+
+class SqlLookup(Lookup):
+    engine = "sql"
+
+    def __init__(self, spec, cursor, pad=0, prescreen=None):
+        Lookup.__init__(self, spec, pad=pad, prescreen=prescreen)
+        self.cursor = cursor
+
+    def whereSql(self, chrom, lo, hi):
+        spec = self.spec
+        conds = []
+        if not spec.per_chrom:
+            conds.append(f'{spec.chrom_col}="{str(chrom)}"')
+        if spec.binned:
+            # Stored bins cover half-open [chromStart, chromEnd); the closed
+            # comparisons below can also match a feature ending at lo - 1
+            bins = u.binsOverlapping(lo - 1, hi + 1)
+            conds.append("bin in (" + ",".join([str(b) for b in bins]) + ")")
+        if spec.start_col == spec.end_col and lo == hi:
+            conds.append(f"{spec.start_col} = {str(lo)}")
+        else:
+            conds.append(f"{spec.start_col} <= {str(hi)}")
+            conds.append(f"{spec.end_col} >= {str(lo)}")
+        return " AND ".join(conds)
+
+    def rangeSql(self, chrom, lo, hi):
+        return (
+            f"select {self.spec.columns} from {ref.tableName(self.spec, chrom)}"
+            + " where "
+            + self.whereSql(chrom, lo, hi)
+        )
+
+    def _fetch(self, chrom, pos, match, limit):
+        sql = self.rangeSql(chrom, pos - self.pad, pos + self.pad) + matchSql(match)
+        if limit is not None:
+            sql = sql + " limit " + str(limit)
+        self.cursor.execute(sql + ";")
+        return list(self.cursor.fetchall())
+
+
+"""Binned in-memory index over a set of rows of one table
+   Features are filed under the smallest bin containing their closed
+   interval [start, end]; a probe visits every bin overlapping its range
+"""
+
+
+class BinnedIndex(object):
+    def __init__(self, spec, columns):
+        self.spec = spec
+        self.bins = {}
+        self.count = 0
+        self.columns = list(columns)
+        self.colindex = dict([(c, i) for i, c in enumerate(self.columns)])
+        self.ci = self.colindex[spec.chrom_col]
+        self.si = self.colindex[spec.start_col]
+        self.ei = self.colindex[spec.end_col]
+
+    def add(self, row):
+        start = int(row[self.si])
+        end = int(row[self.ei])
+        key = (str(row[self.ci]), u.binFromRange(start, end + 1))
+        self.bins.setdefault(key, []).append((start, end, tuple(row)))
+        self.count = self.count + 1
+
+    """Loads a table exported to the snapshot by reference.exportTable
+    """
+
+    @classmethod
+    def load(cls, spec, path):
+        with open(path, newline="") as fh:
+            reader = csv.reader(fh, delimiter="\t")
+            index = cls(spec, next(reader))
+            for row in reader:
+                index.add(row)
+        return index
+
+    def query(self, chrom, lo, hi):
+        rows = []
+        for b in u.binsOverlapping(lo, hi + 1):
+            for start, end, row in self.bins.get((chrom, b), ()):
+                if start <= hi and lo <= end:
+                    rows.append(row)
+        return rows
+
+
+class IndexLookup(Lookup):
+    engine = "index"
+
+    def __init__(self, spec, index, pad=0, prescreen=None):
+        Lookup.__init__(self, spec, pad=pad, prescreen=prescreen)
+        self.index = index
+        self.load_seconds = 0.0
+
+    def _fetch(self, chrom, pos, match, limit):
+        rows = [
+            row
+            for row in self.index.query(chrom, pos - self.pad, pos + self.pad)
+            if rowMatches(row, self.index.colindex, match)
+        ]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def stats(self):
+        stats = Lookup.stats(self)
+        stats["index_load_seconds"] = round(self.load_seconds, 6)
+        return stats
+
+
+"""Sliding-window prefetch on the database for coordinate-sorted input
+   A miss outside the current window loads [lo, lo + window) of the
+   chromosome in one query; rows are kept in a small binned index and every
+   probe inside the window is answered locally. Unsorted input stays correct
+   (a probe behind the window simply loads a new window) but gains nothing
+"""
+
+
+class WindowedLookup(SqlLookup):
+    engine = "window"
+
+    def __init__(
+        self,
+        spec,
+        cursor,
+        pad=0,
+        prescreen=None,
+        window=WINDOW_SIZE,
+        target_rows=WINDOW_TARGET_ROWS,
+    ):
+        SqlLookup.__init__(self, spec, cursor, pad=pad, prescreen=prescreen)
+        self.window = max(int(window), 2 * self.pad + 1)
+        self.target_rows = target_rows
+        self.chrom = None
+        self.lo = 0
+        self.hi = -1
+        self.index = None
+        self.windows = 0
+        self.rows_fetched = 0
+
+    def _load(self, chrom, lo):
+        hi = lo + self.window - 1
+        self.cursor.execute(self.rangeSql(chrom, lo, hi) + ";")
+        self.index = BinnedIndex(self.spec, [d[0] for d in self.cursor.description])
+        for row in self.cursor.fetchall():
+            self.index.add(row)
+        self.chrom = chrom
+        self.lo = lo
+        self.hi = hi
+        self.windows = self.windows + 1
+        self.rows_fetched = self.rows_fetched + self.index.count
+
+        # Size the next window so it holds about target_rows rows
+        density = self.index.count / float(self.window)
+        if density > 0:
+            window = int(self.target_rows / density)
+        else:
+            window = self.window * 2
+        self.window = min(
+            WINDOW_MAX_SIZE, max(WINDOW_MIN_SIZE, 2 * self.pad + 1, window)
+        )
+
+    def _fetch(self, chrom, pos, match, limit):
+        lo = pos - self.pad
+        hi = pos + self.pad
+        if chrom != self.chrom or lo < self.lo or hi > self.hi:
+            self._load(chrom, lo)
+        rows = [
+            row
+            for row in self.index.query(str(chrom), lo, hi)
+            if rowMatches(row, self.index.colindex, match)
+        ]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def stats(self):
+        stats = SqlLookup.stats(self)
+        stats["windows"] = self.windows
+        stats["rows_fetched"] = self.rows_fetched
+        stats["window_size"] = self.window
+        return stats
+
+
+"""Reads the (chrom, position) keys of the data lines of a VCF file, with the
+   chromosome written the way the table stores it
+"""
+
+
+def normalizeChrom(spec, chrom):
+    chrom = str(chrom)
+    if spec.chr_prefix:
+        return chrom if chrom.startswith("chr") else "chr" + chrom
+    return chrom.replace("chr", "")
+
+
+def readKeys(spec, path):
+    with open(path) as fh:
+        for line in fh:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            fields = line.split("\t", 2)
+            try:
+                yield (normalizeChrom(spec, fields[0].strip()), int(fields[1]))
+            except (IndexError, ValueError):
+                continue
+
+
+"""Batched queries on the database driven by the job's input keys
+   Stages probe positions in input-line order (skipping some), so on a miss
+   the lookup looks for the missed key among the next lookahead keys of the
+   key source, takes it and the next batch_size - 1 keys, and fetches all of
+   them with one UNION ALL query whose rows are tagged with the key they
+   belong to. Works on unsorted input. A key not found there (probed again,
+   or not an input key) falls back to one query and leaves the keys read
+   ahead for the next probes; only batch_size such misses in a row, a stage
+   that has moved past all of them, skip them
+"""
+
+
+class BatchedLookup(SqlLookup):
+    engine = "batch"
+
+    def __init__(
+        self,
+        spec,
+        cursor,
+        keys_path,
+        pad=0,
+        prescreen=None,
+        batch_size=BATCH_SIZE,
+        lookahead=BATCH_LOOKAHEAD,
+    ):
+        SqlLookup.__init__(self, spec, cursor, pad=pad, prescreen=prescreen)
+        self.keys = readKeys(spec, keys_path) if keys_path is not None else iter([])
+        self.batch_size = max(1, int(batch_size))
+        self.lookahead = max(self.batch_size, int(lookahead))
+        # Keys read from the source and not passed yet, and their counts
+        self.ahead = collections.deque()
+        self.buffered = collections.Counter()
+        self.misses = 0
+        self.batch = {}
+        self.colindex = None
+        self.batches = 0
+        self.fallbacks = 0
+
+    """The missed key and the keys following it in the key source, up to
+       batch_size; empty when the key is not found there
+    """
+
+    def _readAhead(self):
+        for k in self.keys:
+            # Keys the Bloom filter rules out are never probed
+            if self.prescreen is not None and not self.prescreen.check(k[0], k[1]):
+                continue
+            self.ahead.append(k)
+            self.buffered[k] = self.buffered[k] + 1
+            return True
+        return False
+
+    def _pass(self):
+        k = self.ahead.popleft()
+        self.buffered[k] = self.buffered[k] - 1
+        if self.buffered[k] == 0:
+            del self.buffered[k]
+        return k
+
+    def _upcoming(self, key):
+        while key not in self.buffered and len(self.ahead) < self.lookahead:
+            if not self._readAhead():
+                break
+        if key not in self.buffered:
+            self.misses = self.misses + 1
+            if self.misses >= self.batch_size:
+                while self.ahead:
+                    self._pass()
+                self.misses = 0
+            return []
+        self.misses = 0
+        while self.ahead[0] != key:
+            self._pass()
+        keys = []
+        seen = set()
+        while len(keys) < self.batch_size and (self.ahead or self._readAhead()):
+            k = self._pass()
+            if k not in seen:
+                seen.add(k)
+                keys.append(k)
+        return keys
+
+    """Fetches the rows of distinct keys with one query; returns the column
+       names and, for each key, its rows
+    """
+
+    def _query(self, keys):
+        columns = "t.*" if self.spec.columns == "*" else self.spec.columns
+        parts = []
+        for i, (chrom, pos) in enumerate(keys):
+            parts.append(
+                f"(select {i} as gas_key, {columns} from "
+                + f"{ref.tableName(self.spec, chrom)} t where "
+                + self.whereSql(chrom, pos - self.pad, pos + self.pad)
+                + ")"
+            )
+        self.cursor.execute(" union all ".join(parts) + ";")
+        names = [d[0] for d in self.cursor.description[1:]]
+        rows = [[] for k in keys]
+        for row in self.cursor.fetchall():
+            rows[row[0]].append(tuple(row[1:]))
+        return names, rows
+
+    def _load(self, key):
+        keys = self._upcoming(key)
+        if len(keys) == 0:
+            # The batch's other keys may still be probed
+            return
+        names, rows = self._query(keys)
+        self.colindex = dict([(c, i) for i, c in enumerate(names)])
+        self.batch = dict(zip(keys, rows))
+        self.batches = self.batches + 1
+
+    def _fetch(self, chrom, pos, match, limit):
+        key = (str(chrom), pos)
+        if key not in self.batch:
+            self._load(key)
+        if key not in self.batch:
+            self.fallbacks = self.fallbacks + 1
+            return SqlLookup._fetch(self, chrom, pos, match, limit)
+        rows = [row for row in self.batch[key] if rowMatches(row, self.colindex, match)]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def stats(self):
+        stats = SqlLookup.stats(self)
+        stats["batches"] = self.batches
+        stats["batch_fallbacks"] = self.fallbacks
+        return stats
+
+
+"""Pipelined queries on the database driven by the job's input keys
+   A reader thread feeds the upcoming keys (those the Bloom filter does not
+   rule out) into a bounded queue; a pool of workers, each with its own
+   database connection, queries them concurrently; the stage thread takes the
+   results back in input-line order, skipping keys it does not probe. At most
+   depth keys are in flight, so parsing, formatting and writing in the stage
+   overlap with the database round trips instead of waiting on them.
+   A key probed again gets the result it was last given; results are only
+   skipped once the probed key is known to come later in the input, or is
+   past them in sort order, so a key that is not coming falls back to its
+   own query without draining the pipeline
+"""
+
+
+class PipelinedLookup(SqlLookup):
+    engine = "pipeline"
+
+    def __init__(
+        self,
+        spec,
+        cursor,
+        keys_path,
+        pad=0,
+        prescreen=None,
+        workers=PIPELINE_WORKERS,
+        depth=PIPELINE_DEPTH,
+    ):
+        SqlLookup.__init__(self, spec, cursor, pad=pad, prescreen=prescreen)
+        self.keys_path = keys_path
+        self.slots = threading.Semaphore(max(1, int(depth)))
+        self.pending = queue.Queue()
+        self.results = {}
+        # key -> sequence numbers of its results not taken yet, in order
+        self.positions = {}
+        self.last = None
+        self.done = threading.Condition()
+        self.produced = None
+        self.next_seq = 0
+        self.stopping = False
+        self.error = None
+        self.fallbacks = 0
+        self.workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for i in range(max(1, int(workers)))
+        ]
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        for t in self.workers:
+            t.start()
+        self.reader.start()
+
+    def _read(self):
+        seq = 0
+        try:
+            for key in readKeys(self.spec, self.keys_path):
+                if self.pad == 0 and self.prescreen is not None:
+                    if not self.prescreen.check(key[0], key[1]):
+                        continue
+                self.slots.acquire()
+                if self.stopping:
+                    break
+                with self.done:
+                    self.positions.setdefault(key, collections.deque()).append(seq)
+                    self.done.notify_all()
+                self.pending.put((seq, key))
+                seq = seq + 1
+        finally:
+            with self.done:
+                self.produced = seq
+                self.done.notify_all()
+            for t in self.workers:
+                self.pending.put(None)
+
+    def _work(self):
+        conn = None
+        try:
+            conn = u.db_connect()
+            cursor = conn.cursor()
+            while True:
+                item = self.pending.get()
+                if item is None:
+                    break
+                seq, (chrom, pos) = item
+                rows = None
+                if not self.stopping:
+                    cursor.execute(
+                        self.rangeSql(chrom, pos - self.pad, pos + self.pad) + ";"
+                    )
+                    colindex = dict(
+                        [(d[0], i) for i, d in enumerate(cursor.description)]
+                    )
+                    rows = (colindex, list(cursor.fetchall()))
+                with self.done:
+                    self.results[seq] = ((chrom, pos), rows)
+                    self.done.notify_all()
+        except Exception as e:
+            with self.done:
+                self.error = e
+                self.done.notify_all()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    """Takes the next result in input order; call with self.done held
+    """
+
+    def _take(self):
+        result = self.results.pop(self.next_seq)
+        seqs = self.positions[result[0]]
+        seqs.popleft()
+        if not seqs:
+            del self.positions[result[0]]
+        self.next_seq = self.next_seq + 1
+        self.slots.release()
+        return result
+
+    """The result of key in input order, skipping the results of the keys
+       before it; None when key is not coming (the reader is exhausted, or
+       the next result is past key in sort order) and nothing is skipped
+    """
+
+    def _next(self, key):
+        order = (vs.chromKey(key[0]), key[1])
+        with self.done:
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if key in self.positions:
+                    # Every result before the key's is for a key not probed
+                    if self.next_seq not in self.results:
+                        self.done.wait()
+                        continue
+                    result = self._take()
+                    if result[0] == key:
+                        return result
+                    continue
+                if self.produced is not None and self.next_seq >= self.produced:
+                    return None
+                if self.next_seq not in self.results:
+                    self.done.wait()
+                    continue
+                head = self.results[self.next_seq][0]
+                if (vs.chromKey(head[0]), head[1]) > order:
+                    return None
+                self._take()
+
+    def _fetch(self, chrom, pos, match, limit):
+        key = (str(chrom), pos)
+        if self.last is not None and self.last[0] == key:
+            result = self.last
+        else:
+            result = self._next(key)
+            if result is None:
+                self.fallbacks = self.fallbacks + 1
+                return SqlLookup._fetch(self, chrom, pos, match, limit)
+            self.last = result
+        colindex, rows = result[1]
+        rows = [row for row in rows if rowMatches(row, colindex, match)]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def close(self):
+        self.stopping = True
+        # Unblock the reader if it waits for a free slot
+        for t in self.workers:
+            self.slots.release()
+        self.reader.join()
+        for t in self.workers:
+            t.join()
+        self.results.clear()
+
+    def stats(self):
+        stats = SqlLookup.stats(self)
+        stats["workers"] = len(self.workers)
+        stats["pipeline_fallbacks"] = self.fallbacks
+        return stats
+
+
+"""Batched lookups answered by the annotator's lookup broker (see
+   lookup_broker.py), which coalesces them with the lookups of the other jobs
+   running on the instance into shared queries. With a key source the
+   upcoming keys go to the broker as one batch, without one each variant
+   goes on its own; if the broker cannot answer, the lookup queries the
+   database itself
+"""
+
+
+class BrokeredLookup(BatchedLookup):
+    engine = "broker"
+
+    def __init__(
+        self,
+        spec,
+        cursor,
+        keys_path,
+        broker,
+        pad=0,
+        prescreen=None,
+        batch_size=BATCH_SIZE,
+    ):
+        BatchedLookup.__init__(
+            self,
+            spec,
+            cursor,
+            keys_path,
+            pad=pad,
+            prescreen=prescreen,
+            batch_size=batch_size,
+        )
+        self.broker = broker
+        self.shared = 0
+        self.broker_fallbacks = 0
+
+    def _upcoming(self, key):
+        return BatchedLookup._upcoming(self, key) or [key]
+
+    def _query(self, keys):
+        try:
+            names, rows, shared = self.broker.query(self.spec, self.pad, keys)
+        except BrokerError:
+            self.broker_fallbacks = self.broker_fallbacks + 1
+            return BatchedLookup._query(self, keys)
+        self.shared = self.shared + shared
+        return names, rows
+
+    def stats(self):
+        stats = BatchedLookup.stats(self)
+        stats["broker_shared_requests"] = self.shared
+        stats["broker_fallbacks"] = self.broker_fallbacks
+        return stats
+
+
+# Per-table engine overrides (e.g. chosen by a planner for the current job)
+_engines = {}
+
+
+def setEngine(table, engine):
+    _engines[table] = engine
+
+
+def resetEngines():
+    _engines.clear()
+
+
+# Input whose data-line keys drive BatchedLookup; set by the driver per job
+_key_source = None
+
+
+def setKeySource(path):
+    global _key_source
+    _key_source = path
+
+
+# Lookup broker client of this process (a pooled worker); when set, the sql
+# and batch engines send their queries through it
+_broker = None
+
+
+class BrokerError(Exception):
+    pass
+
+
+def setBroker(client):
+    global _broker
+    _broker = client
+
+
+# Loaded indexes are kept for the life of the process, with their load time
+_indexes = {}
+_index_load_seconds = {}
+
+
+"""The packed index (shared by all processes through mmap) is used when the
+   snapshot has one; otherwise the export is parsed into a BinnedIndex
+"""
+
+
+def loadIndex(spec):
+    if spec.table not in _indexes:
+        packed = ref.snapshotPath(spec.table + ".idx")
+        path = ref.snapshotPath(spec.table + ".tsv")
+        start = time.perf_counter()
+        if os.path.isfile(packed):
+            _indexes[spec.table] = pi.PackedIndex(spec, packed)
+        elif os.path.isfile(path):
+            _indexes[spec.table] = BinnedIndex.load(spec, path)
+        else:
+            return None
+        _index_load_seconds[spec.table] = time.perf_counter() - start
+    return _indexes[spec.table]
+
+
+def indexAvailable(table):
+    return table in _indexes or any(
+        [os.path.isfile(ref.snapshotPath(table + ext)) for ext in (".idx", ".tsv")]
+    )
+
+
+def isPacked(table):
+    return os.path.isfile(ref.snapshotPath(table + ".idx"))
+
+
+def isIndexLoaded(table):
+    return table in _indexes
+
+
+"""Picks the backend for a stage's table: the engine set for the table
+   (setEngine), else the local index when the table is configured in
+   IndexTables, else the configured LookupEngine. The index engine needs the
+   table in the snapshot and the batch engine a key source; otherwise the
+   lookup goes to the database one query per variant. In a process with a
+   lookup broker the sql and batch engines query through the broker. Column names are only
+   used for tables not in reference.TABLES
+"""
+
+
+def openLookup(
+    table,
+    cursor,
+    pad=0,
+    chrom_col="chrom",
+    start_col="chromStart",
+    end_col="chromEnd",
+):
+    spec = ref.tableSpec(table, chrom_col, start_col, end_col)
+    prescreen = ref.openPrescreen(table)
+
+    engine = _engines.get(table)
+    if engine is None:
+        engine = "index" if table in ref.INDEX_TABLES else LOOKUP_ENGINE
+
+    if engine == "index":
+        loaded = isIndexLoaded(table)
+        index = loadIndex(spec)
+        if index is not None:
+            lookup = IndexLookup(spec, index, pad=pad, prescreen=prescreen)
+            if not loaded:
+                lookup.load_seconds = _index_load_seconds[table]
+            return lookup
+        engine = LOOKUP_ENGINE
+
+    if engine == "window":
+        return WindowedLookup(spec, cursor, pad=pad, prescreen=prescreen)
+    if engine in ("sql", "batch") and _broker is not None:
+        keys_path = _key_source if engine == "batch" else None
+        return BrokeredLookup(
+            spec, cursor, keys_path, _broker, pad=pad, prescreen=prescreen
+        )
+    if engine == "batch" and _key_source is not None:
+        return BatchedLookup(spec, cursor, _key_source, pad=pad, prescreen=prescreen)
+    if (
+        engine == "pipeline"
+        and _key_source is not None
+        and table not in UNPIPELINED_TABLES
+    ):
+        return PipelinedLookup(spec, cursor, _key_source, pad=pad, prescreen=prescreen)
+    return SqlLookup(spec, cursor, pad=pad, prescreen=prescreen)
+
+
+### EOF
@@ -0,0 +1,282 @@
+# metrics.py
+#
+# Prometheus metrics of the annotator, served on /metrics
+#
+# The poller (annotator.py) holds the registry. Workers hand every stage
+# metrics record (utils.logStageMetrics) to the poller over their pipe, and
+# recordStage() turns them into the lookup latency histograms, per-stage
+# throughput counters and cache hit counters; the poller itself records
+# queue receive latency and job wall times, and the in-flight jobs and
+# worker utilization are read when the endpoint is scraped. serve() runs a
+# small Flask app (as annotator_webhook.py does) in a background thread that
+# renders the registry in the Prometheus text format.
+#
+##
+
+import bisect
+import logging
+import threading
+
+import reference as ref
+
+METRICS_PORT = ref.config.getint("ann", "MetricsPort", fallback=9100)
+
+# Lookup latency buckets (seconds), shared with lookups.Lookup
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+QUEUE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Every metric created, in the order they are rendered
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join([f'{n}="{_escape(v)}"' for n, v in pairs]) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple([str(labels.get(n, "")) for n in self.labelnames])
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, None, v) for key, v in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(
+                f"{name}{_labels(self.labelnames, key, extra)} {_number(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+"""A gauge is set, or read from function (no labels) when scraped
+"""
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            return Metric.samples(self)
+        try:
+            return [(self.name, (), None, self.function())]
+        except Exception as e:
+            logging.error(f"Failed to read metric {self.name}: {str(e)}")
+            return []
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        counts = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] = 1
+        self.merge(counts, value, **labels)
+
+    """Adds counts per bucket (the last one above every bound) observed
+       elsewhere, e.g. by a lookup in a worker, and their sum
+    """
+
+    def merge(self, counts, total, **labels):
+        if len(counts) != len(self.buckets) + 1:
+            raise ValueError(f"{self.name} has {len(self.buckets) + 1} buckets")
+        key = self._key(labels)
+        with self.lock:
+            value = self.values.setdefault(key, [[0] * len(counts), 0.0])
+            value[0] = [a + b for a, b in zip(value[0], counts)]
+            value[1] = value[1] + total
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(v[0]), v[1]) for key, v in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative = cumulative + count
+                samples.append(
+                    (self.name + "_bucket", key, [("le", _number(bound))], cumulative)
+                )
+            samples.append((self.name + "_sum", key, None, total))
+            samples.append((self.name + "_count", key, None, cumulative))
+        return samples
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+RECEIVE_LATENCY = Histogram(
+    "ann_queue_receive_latency_seconds",
+    "Time from a job request being sent to the queue to its receipt",
+    buckets=QUEUE_BUCKETS,
+)
+JOB_SECONDS = Histogram(
+    "ann_job_seconds",
+    "Wall time of a job on its worker, annotation and upload",
+    labels=("status",),
+    buckets=JOB_BUCKETS,
+)
+JOB_QUEUED_SECONDS = Histogram(
+    "ann_job_queued_seconds",
+    "Time a job waited in the pool for a worker",
+    buckets=QUEUE_BUCKETS,
+)
+JOBS = Counter("ann_jobs_total", "Jobs finished", labels=("status",))
+STAGE_VARIANTS = Counter(
+    "ann_stage_variants_total", "Variants annotated by a stage", labels=("stage",)
+)
+STAGE_SECONDS = Counter(
+    "ann_stage_seconds_total", "Wall time spent in a stage", labels=("stage",)
+)
+STAGE_RATE = Gauge(
+    "ann_stage_variants_per_second",
+    "Throughput of a stage in the last job",
+    labels=("stage",),
+)
+LOOKUP_SECONDS = Histogram(
+    "ann_lookup_seconds",
+    "Latency of a stage's reference lookups (database or local index)",
+    labels=("table", "engine"),
+)
+CACHE_REQUESTS = Counter(
+    "ann_cache_requests_total",
+    "Lookups that could be answered by a cache or pre-screen",
+    labels=("cache", "table"),
+)
+CACHE_HITS = Counter(
+    "ann_cache_hits_total",
+    "Lookups answered by a cache or pre-screen without their own query",
+    labels=("cache", "table"),
+)
+
+
+"""Records a stage metrics record sent by a worker
+"""
+
+
+def recordStage(record):
+    if record.get("stage") == "driver":
+        for stage, seconds in record.get("stage_seconds", {}).items():
+            STAGE_VARIANTS.inc(record["variants"], stage=stage)
+            STAGE_SECONDS.inc(seconds, stage=stage)
+            if seconds > 0:
+                STAGE_RATE.set(record["variants"] / seconds, stage=stage)
+        return
+    table = record.get("stage")
+    buckets = record.get("lookup_latency_buckets")
+    if buckets is None:
+        return
+    LOOKUP_SECONDS.merge(
+        buckets, record.get("lookup_seconds", 0.0), table=table, engine=record["engine"]
+    )
+    fetches = sum(buckets)
+    if "skipped_lookups" in record:
+        CACHE_REQUESTS.inc(
+            fetches + record["skipped_lookups"], cache="bloom", table=table
+        )
+        CACHE_HITS.inc(record["skipped_lookups"], cache="bloom", table=table)
+    for cache, queries in (("window", "windows"), ("batch", "batches")):
+        if queries in record:
+            CACHE_REQUESTS.inc(fetches, cache=cache, table=table)
+            CACHE_HITS.inc(max(0, fetches - record[queries]), cache=cache, table=table)
+    if "broker_shared_requests" in record:
+        CACHE_REQUESTS.inc(record["batches"], cache="broker", table=table)
+        CACHE_HITS.inc(record["broker_shared_requests"], cache="broker", table=table)
+
+
+"""Serves /metrics on port in a background thread; returns the server, or
+   None when the port is 0 or cannot be bound
+"""
+
+
+def serve(port=METRICS_PORT, host="0.0.0.0"):
+    if not port:
+        return None
+    from flask import Flask, Response
+    from werkzeug.serving import make_server
+
+    app = Flask(__name__)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    try:
+        server = make_server(host, port, app, threaded=True)
+    except OSError as e:
+        logging.error(f"Cannot serve metrics on port {port}: {str(e)}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on port {port}")
+    return server
+
+
+### EOF
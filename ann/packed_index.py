@@ -0,0 +1,228 @@
+# packed_index.py
+#
+# Packed, memory-mapped form of the local reference index
+#
+# BinnedIndex (lookups.py) parses a table's snapshot export into Python
+# objects in every process that loads it. The packed index is built once per
+# snapshot into a flat file next to the export and opened with mmap, so every
+# annotator worker on the host shares the same page-cache pages and opening
+# it costs no parsing: memory per host stays flat as workers are added.
+#
+# Layout (integers in native byte order):
+#   MAGIC
+#   "<QQQQ" header length, directory entries, records, blob bytes
+#   JSON header (table, columns, chromosomes), padded to 8 bytes
+#   directory: int64 keys, int64 first record, int64 record count
+#              key = chromosome number << 20 | UCSC bin, sorted
+#   records:   int64 start, end, blob offset, blob length per feature,
+#              grouped by directory key
+#   blob:      each row as tab-separated UTF-8 text
+#
+##
+
+import bisect
+import csv
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+import utils as u
+import vcf_sort as vs
+
+MAGIC = b"GASIDX1\n"
+HEADER = "<QQQQ"
+BIN_BITS = 20
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+"""Packs a snapshot export (reference.exportTable) into path; rows are
+   grouped by (chromosome, bin) with the bounded-memory external sort, so
+   tables larger than memory can be packed
+"""
+
+
+def build(spec, tsv_path, path, tmpdir=None):
+    tmpdir = tempfile.mkdtemp(
+        prefix="packidx.", dir=tmpdir or os.path.dirname(os.path.abspath(path))
+    )
+    chroms = {}
+    try:
+        with open(tsv_path, newline="") as fh:
+            reader = csv.reader(fh, delimiter="\t")
+            columns = next(reader)
+            ci = columns.index(spec.chrom_col)
+            si = columns.index(spec.start_col)
+            ei = columns.index(spec.end_col)
+
+            def records():
+                for row in reader:
+                    chrom_id = chroms.setdefault(row[ci], len(chroms))
+                    start = int(row[si])
+                    end = int(row[ei])
+                    key = (chrom_id << BIN_BITS) | u.binFromRange(start, end + 1)
+                    yield f"{key}\t{start}\t{end}\t" + "\t".join(row)
+
+            def sortKey(record):
+                parts = record.split("\t", 2)
+                return (int(parts[0]), int(parts[1]))
+
+            keys = array("q")
+            firsts = array("q")
+            counts = array("q")
+            n_rec = 0
+            blob_len = 0
+            rec_path = os.path.join(tmpdir, "records")
+            blob_path = os.path.join(tmpdir, "blob")
+            with open(rec_path, "wb") as fh_rec, open(blob_path, "wb") as fh_blob:
+                recs = array("q")
+                for record in vs.externalSort(records(), sortKey, tmpdir):
+                    key, start, end, text = record.split("\t", 3)
+                    key = int(key)
+                    if len(keys) == 0 or keys[-1] != key:
+                        keys.append(key)
+                        firsts.append(n_rec)
+                        counts.append(0)
+                    counts[-1] = counts[-1] + 1
+                    data = text.encode("utf-8")
+                    recs.extend([int(start), int(end), blob_len, len(data)])
+                    fh_blob.write(data)
+                    blob_len = blob_len + len(data)
+                    n_rec = n_rec + 1
+                    if len(recs) >= 4 * vs.ORDER_BUFFER:
+                        recs.tofile(fh_rec)
+                        recs = array("q")
+                recs.tofile(fh_rec)
+
+        header = json.dumps(
+            {
+                "table": spec.table,
+                "columns": columns,
+                "chroms": sorted(chroms, key=chroms.get),
+            }
+        ).encode("utf-8")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(struct.pack(HEADER, len(header), len(keys), n_rec, blob_len))
+            fh.write(header)
+            fh.write(b"\0" * _pad(len(MAGIC) + struct.calcsize(HEADER) + len(header)))
+            keys.tofile(fh)
+            firsts.tofile(fh)
+            counts.tofile(fh)
+            for name in (rec_path, blob_path):
+                with open(name, "rb") as fh_in:
+                    shutil.copyfileobj(fh_in, fh)
+        os.replace(tmp, path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return n_rec
+
+
+"""Read-only view of a packed index; answers the same queries as
+   lookups.BinnedIndex without copying the table into the process
+"""
+
+
+class PackedIndex(object):
+    def __init__(self, spec, path):
+        self.spec = spec
+        self.path = path
+        with open(path, "rb") as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a GAS packed index file")
+        offset = len(MAGIC)
+        header_len, n_dir, n_rec, blob_len = struct.unpack_from(HEADER, self.mm, offset)
+        offset = offset + struct.calcsize(HEADER)
+        header = json.loads(self.mm[offset : offset + header_len].decode("utf-8"))
+        offset = offset + header_len
+        offset = offset + _pad(offset)
+
+        view = memoryview(self.mm)
+        self.keys = view[offset : offset + 8 * n_dir].cast("q")
+        offset = offset + 8 * n_dir
+        self.firsts = view[offset : offset + 8 * n_dir].cast("q")
+        offset = offset + 8 * n_dir
+        self.counts = view[offset : offset + 8 * n_dir].cast("q")
+        offset = offset + 8 * n_dir
+        self.records_offset = offset
+        self.records = view[offset : offset + 32 * n_rec].cast("q")
+        offset = offset + 32 * n_rec
+        self.blob_offset = offset
+        self.blob = view[offset : offset + blob_len]
+
+        self.count = n_rec
+        self.columns = header["columns"]
+        self.colindex = dict([(c, i) for i, c in enumerate(self.columns)])
+        self.chroms = dict([(c, i) for i, c in enumerate(header["chroms"])])
+
+    def query(self, chrom, lo, hi):
+        rows = []
+        chrom_id = self.chroms.get(chrom)
+        if chrom_id is None:
+            return rows
+        for b in u.binsOverlapping(lo, hi + 1):
+            key = (chrom_id << BIN_BITS) | b
+            i = bisect.bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                continue
+            first = self.firsts[i]
+            for r in range(4 * first, 4 * (first + self.counts[i]), 4):
+                if self.records[r] <= hi and lo <= self.records[r + 1]:
+                    off = self.records[r + 2]
+                    text = bytes(self.blob[off : off + self.records[r + 3]])
+                    rows.append(tuple(text.decode("utf-8").split("\t")))
+        return rows
+
+    """Asks the kernel to read a chromosome's records and rows into the page
+       cache ahead of its queries; returns the bytes advised
+    """
+
+    def prefetch(self, chrom):
+        chrom_id = self.chroms.get(chrom)
+        if chrom_id is None:
+            return 0
+        lo = bisect.bisect_left(self.keys, chrom_id << BIN_BITS)
+        hi = bisect.bisect_left(self.keys, (chrom_id + 1) << BIN_BITS)
+        if lo == hi:
+            return 0
+        first = self.firsts[lo]
+        last = self.firsts[hi - 1] + self.counts[hi - 1] - 1
+        # A chromosome's records, and so its rows, are contiguous
+        ranges = [
+            (self.records_offset + 32 * first, self.records_offset + 32 * (last + 1)),
+            (
+                self.blob_offset + self.records[4 * first + 2],
+                self.blob_offset
+                + self.records[4 * last + 2]
+                + self.records[4 * last + 3],
+            ),
+        ]
+        advised = 0
+        for start, end in ranges:
+            aligned = start - start % mmap.PAGESIZE
+            if end > aligned:
+                self.mm.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+                advised = advised + end - start
+        return advised
+
+
+if __name__ == "__main__":
+    import reference as ref
+
+    for table in sys.argv[1:] or ref.INDEX_TABLES:
+        spec = ref.TABLES[table]
+        rows = build(
+            spec, ref.snapshotPath(table + ".tsv"), ref.snapshotPath(table + ".idx")
+        )
+        print(f"{table} - {rows} rows packed.")
+
+### EOF
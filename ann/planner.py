@@ -0,0 +1,292 @@
+# planner.py
+#
+# Cost-based choice of lookup engine per stage table
+#
+# profileInput() makes one pass over the job's input and records the variant
+# count, how much of it is in coordinate order, and the chromosomes it covers
+# with their spans. plan() predicts the lookup time of every engine for every
+# table the stages query with a linear cost model, and sets the cheapest with
+# lookups.setEngine; report() logs each choice with its predicted and actual
+# time to the job metrics file and calibrates the model.
+#
+# The model's unit costs start from defaults and are moved towards the
+# measured costs after every job; they are kept per table in the snapshot
+# directory, so the planner learns the latency of the database it runs
+# against.
+#
+##
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from collections import namedtuple
+
+import lookups as lk
+import reference as ref
+import utils as u
+import vcf_sort as vs
+
+# Choose engines per job; when off every table uses the configured engine
+PLANNER = ref.config.getboolean("ann", "Planner", fallback=False)
+
+ENGINES = ["sql", "batch", "pipeline", "window", "index"]
+
+CALIBRATION_FILE = "planner_calibration.json"
+
+# Weight of a new observation in the calibrated unit costs
+CALIBRATION_WEIGHT = 0.3
+
+# Input is treated as sorted (window engine usable) above this fraction of
+# in-order adjacent lines
+SORTED_FRACTION = 0.99
+
+"""Unit costs in seconds: sql, batch, pipeline and index per input variant,
+   window per window loaded, index_load per exported row loaded into the
+   local index
+"""
+
+DEFAULT_COSTS = {
+    "sql": 0.0015,
+    "batch": 0.0003,
+    "pipeline": 0.0004,
+    "window": 0.02,
+    "index": 0.00003,
+    "index_load": 0.000005,
+}
+
+"""Shape of a job's input; spans maps chromosome -> [first, last, count]
+"""
+
+Profile = namedtuple("Profile", ["variants", "sorted_fraction", "spans"])
+
+
+def profileInput(path):
+    variants = 0
+    in_order = 0
+    last = None
+    spans = {}
+    with open(path) as fh:
+        for line in fh:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            fields = line.split("\t", 2)
+            if len(fields) < 2:
+                continue
+            chrom = fields[0].strip().replace("chr", "")
+            pos = vs.positionKey(fields[1])
+            key = (vs.chromKey(chrom), pos)
+            if last is not None and key >= last:
+                in_order = in_order + 1
+            last = key
+            variants = variants + 1
+
+            span = spans.setdefault(chrom, [pos, pos, 0])
+            span[0] = min(span[0], pos)
+            span[1] = max(span[1], pos)
+            span[2] = span[2] + 1
+
+    sorted_fraction = (in_order / float(variants - 1)) if variants > 1 else 1.0
+    return Profile(variants, sorted_fraction, spans)
+
+
+def loadCalibration():
+    try:
+        with open(ref.snapshotPath(CALIBRATION_FILE)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+"""Moves the saved unit costs towards the observations ((table, key, unit
+   cost) of a job). The pool's workers finish jobs at once, so the read,
+   merge and write hold a lock, and each process writes its own temporary
+   file; a calibration that cannot be saved is logged and lost
+"""
+
+
+def saveCalibration(observations):
+    if not observations:
+        return
+    path = ref.snapshotPath(CALIBRATION_FILE)
+    try:
+        os.makedirs(ref.SNAPSHOT_DIR, exist_ok=True)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            calibration = loadCalibration()
+            for table, key, value in observations:
+                _calibrate(calibration, table, key, value)
+            fd, tmp = tempfile.mkstemp(
+                prefix=CALIBRATION_FILE + ".", dir=ref.SNAPSHOT_DIR
+            )
+            try:
+                with os.fdopen(fd, "w") as fh:
+                    json.dump(calibration, fh, indent=2, sort_keys=True)
+                os.replace(tmp, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+                raise
+    except (IOError, OSError) as e:
+        logging.error(f"Failed to save the planner calibration: {str(e)}")
+
+
+def unitCost(calibration, table, engine):
+    return calibration.get(table, {}).get(engine, DEFAULT_COSTS[engine])
+
+
+"""Windows a sorted input needs: per chromosome, one per WindowSize of span
+   but never more than the variants on it; every out-of-order line of an
+   unsorted input costs another window
+"""
+
+
+def estimateWindows(profile):
+    windows = 0
+    for first, last, count in profile.spans.values():
+        windows = windows + min(count, (last - first) // lk.WINDOW_SIZE + 1)
+    out_of_order = int(round(profile.variants * (1.0 - profile.sorted_fraction)))
+    return windows + out_of_order
+
+
+def indexRows(manifest, table):
+    try:
+        return int(manifest["tables"][table]["index"]["rows"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+"""Predicted seconds of each engine usable for the table
+"""
+
+
+def predict(profile, table, calibration, manifest):
+    n = profile.variants
+    costs = {
+        "sql": n * unitCost(calibration, table, "sql"),
+        "batch": n * unitCost(calibration, table, "batch"),
+        "pipeline": n * unitCost(calibration, table, "pipeline"),
+    }
+    if profile.sorted_fraction >= SORTED_FRACTION:
+        costs["window"] = estimateWindows(profile) * unitCost(
+            calibration, table, "window"
+        )
+
+    rows = indexRows(manifest, table)
+    if rows is not None and lk.indexAvailable(table):
+        load = 0.0
+        # A packed index is mapped, not loaded
+        if not lk.isIndexLoaded(table) and not lk.isPacked(table):
+            load = rows * unitCost(calibration, table, "index_load")
+        costs["index"] = load + n * unitCost(calibration, table, "index")
+    return costs
+
+
+"""Chooses and sets the engine of every stage table for the profiled input;
+   returns {table: {"engine": ..., "predicted_seconds": {engine: seconds}}}
+"""
+
+
+def plan(profile, tables=ref.STAGE_TABLES):
+    calibration = loadCalibration()
+    manifest = ref.loadManifest()
+    lk.resetEngines()
+
+    choices = {}
+    for table in tables:
+        costs = predict(profile, table, calibration, manifest)
+        engine = min(costs, key=lambda e: (costs[e], ENGINES.index(e)))
+        lk.setEngine(table, engine)
+        choices[table] = {
+            "engine": engine,
+            "predicted_seconds": dict([(e, round(s, 6)) for e, s in costs.items()]),
+        }
+    print(
+        f"Planner: {profile.variants} variants on {len(profile.spans)} chromosomes,"
+        + f" {round(profile.sorted_fraction * 100, 1)}% in order."
+    )
+    return choices
+
+
+def readMetrics(basefile):
+    records = []
+    try:
+        with open(basefile + ".metrics.log") as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return records
+
+
+def _calibrate(calibration, table, key, value):
+    costs = calibration.setdefault(table, {})
+    old = costs.get(key, DEFAULT_COSTS[key])
+    costs[key] = round((1 - CALIBRATION_WEIGHT) * old + CALIBRATION_WEIGHT * value, 9)
+
+
+"""Logs every choice with its predicted and actual lookup time (summed over
+   the stage lookups of the table in the job metrics file) and moves the unit
+   cost of the engines used towards the measured ones
+"""
+
+
+def report(choices, profile, basefile):
+    observations = []
+    manifest = ref.loadManifest()
+
+    actual = {}
+    for record in readMetrics(basefile):
+        if "lookup_seconds" not in record or "engine" not in record:
+            continue
+        entry = actual.setdefault(
+            record["stage"],
+            {"engine": record["engine"], "seconds": 0.0, "load": 0.0, "windows": 0},
+        )
+        entry["seconds"] = entry["seconds"] + record["lookup_seconds"]
+        entry["load"] = entry["load"] + record.get("index_load_seconds", 0.0)
+        entry["windows"] = entry["windows"] + record.get("windows", 0)
+
+    for table, choice in choices.items():
+        engine = choice["engine"]
+        predicted = choice["predicted_seconds"][engine]
+        measured = actual.get(table)
+        record = {
+            "planner": table,
+            "engine": engine,
+            "variants": profile.variants,
+            "predicted_seconds": predicted,
+            "actual_seconds": None,
+        }
+        if measured is not None:
+            record["actual_seconds"] = round(measured["seconds"] + measured["load"], 6)
+            # The stage may have fallen back to another engine
+            record["engine_used"] = measured["engine"]
+            used = measured["engine"]
+            if used in ("sql", "batch", "pipeline", "index") and profile.variants > 0:
+                observations.append(
+                    (table, used, measured["seconds"] / profile.variants)
+                )
+            if used == "window" and measured["windows"] > 0:
+                observations.append(
+                    (table, used, measured["seconds"] / measured["windows"])
+                )
+            rows = indexRows(manifest, table)
+            packed = lk.isPacked(table)
+            if used == "index" and measured["load"] > 0 and rows and not packed:
+                observations.append((table, "index_load", measured["load"] / rows))
+        u.logStageMetrics(basefile, record)
+        print(
+            f"Planner: {table} - {engine}, predicted {predicted}s,"
+            + f" actual {record['actual_seconds']}s."
+        )
+
+    saveCalibration(observations)
+
+
+### EOF
@@ -0,0 +1,197 @@
+# profiling.py
+#
+# Profiler capture of selected annotation jobs
+#
+# A job is profiled when its request says so ("profile": true in the job
+# request message, copied to the chunks of a split job) or when it falls in
+# the ProfilePercent sample the operator sets; the poller decides when it
+# receives the request and the worker runs just that job's annotation under
+# Capture. ProfileMode picks the profiler: "deterministic" (cProfile, every
+# call of the worker's main thread, where the stages run) or "sampling" (a
+# thread records the stacks of every thread, pipeline lookup threads
+# included, every ProfileSampleMs). Allocations are traced with tracemalloc
+# (ProfileTraceFrames frames per allocation). The artifacts are written next
+# to the job's count log and uploaded with it (run.publish_job):
+#   <input>.profile.txt     top functions, allocation sites and peak memory
+#   <input>.profile.pstats  cProfile stats (deterministic), for pstats/snakeviz
+#   <input>.profile.folded  folded stacks (sampling), for flamegraph.pl
+# Jobs not profiled only pay for the check of their flag.
+#
+##
+
+import collections
+import cProfile
+import io
+import logging
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import reference as ref
+
+PROFILE_PERCENT = ref.config.getfloat("ann", "ProfilePercent", fallback=0.0)
+PROFILE_MODE = ref.config.get("ann", "ProfileMode", fallback="deterministic")
+PROFILE_SAMPLE_MS = ref.config.getfloat("ann", "ProfileSampleMs", fallback=10.0)
+PROFILE_TRACE_FRAMES = ref.config.getint("ann", "ProfileTraceFrames", fallback=1)
+PROFILE_TOP = ref.config.getint("ann", "ProfileTop", fallback=30)
+
+EXTENSIONS = (".profile.txt", ".profile.pstats", ".profile.folded")
+
+
+"""True when the job of the request data is to be profiled
+"""
+
+
+def shouldProfile(data, percent=PROFILE_PERCENT):
+    if data.get("profile"):
+        return True
+    return percent > 0 and random.random() * 100 < percent
+
+
+"""Local profile artifacts of an input (those written exist)
+"""
+
+
+def artifacts(basefile):
+    return [basefile + extension for extension in EXTENSIONS]
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+"""Stack sampler: folded stacks (outermost frame first) of every thread but
+   its own, counted every interval seconds
+"""
+
+
+class Sampler(object):
+    def __init__(self, interval):
+        self.interval = max(0.001, interval)
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frameName(frame))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks[key] + 1
+            self.samples = self.samples + 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def top(self, n):
+        own = collections.Counter()
+        for stack, count in self.stacks.items():
+            name = stack.split(";")[-1]
+            own[name] = own[name] + count
+        return own.most_common(n)
+
+
+"""Runs the code in its block under the profiler and tracemalloc and writes
+   the artifacts of basefile when it exits, raised or not
+"""
+
+
+class Capture(object):
+    def __init__(
+        self,
+        basefile,
+        mode=PROFILE_MODE,
+        sample_ms=PROFILE_SAMPLE_MS,
+        frames=PROFILE_TRACE_FRAMES,
+        top=PROFILE_TOP,
+    ):
+        if mode not in ("deterministic", "sampling"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.basefile = basefile
+        self.mode = mode
+        self.sample_ms = sample_ms
+        self.frames = max(1, int(frames))
+        self.top = top
+        self.profiler = None
+        self.sampler = None
+
+    def __enter__(self):
+        # Another capture (or a debugging session) may be tracing already
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(self.frames)
+        tracemalloc.reset_peak()
+        if self.mode == "sampling":
+            self.sampler = Sampler(self.sample_ms / 1000.0)
+            self.sampler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.time() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.tracing:
+            tracemalloc.stop()
+        try:
+            self._write(seconds, snapshot, current, peak)
+        except (IOError, OSError) as e:
+            logging.error(f"Failed to write the profile of {self.basefile}: {str(e)}")
+        return False
+
+    def _write(self, seconds, snapshot, current, peak):
+        report = io.StringIO()
+        report.write(f"Profile of {self.basefile} ({self.mode})\n")
+        report.write(f"Wall time: {seconds:.3f} s\n")
+        report.write(
+            f"Traced memory: peak {peak} bytes, {current} bytes at the end\n\n"
+        )
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.basefile + ".profile.pstats")
+            report.write(f"Top {self.top} functions by cumulative time\n")
+            stats = pstats.Stats(self.profiler, stream=report)
+            stats.sort_stats("cumulative").print_stats(self.top)
+        if self.sampler is not None:
+            with open(self.basefile + ".profile.folded", "w") as fh:
+                for stack, count in self.sampler.stacks.most_common():
+                    fh.write(f"{stack} {count}\n")
+            report.write(
+                f"Top {self.top} functions by samples "
+                + f"({self.sampler.samples} samples every {self.sample_ms} ms)\n"
+            )
+            for name, count in self.sampler.top(self.top):
+                report.write(f"{count:>10}  {name}\n")
+            report.write("\n")
+        report.write(f"Top {self.top} allocation sites (memory held at the end)\n")
+        statistics = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        ).statistics("lineno")
+        for stat in statistics[: self.top]:
+            report.write(f"{stat}\n")
+        with open(self.basefile + ".profile.txt", "w") as fh:
+            fh.write(report.getvalue())
+
+
+### EOF
@@ -0,0 +1,316 @@
+# reference.py
+#
+# Reference snapshot for the annotator
+#
+# Describes the reference tables queried by annotate.py and builds the
+# local snapshot directory (manifest plus per-table artifacts) from the
+# annotator database. Run on an annotator instance with:
+#   python reference.py [table ...]
+#
+##
+
+import configparser
+import csv
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+
+import pymysql
+
+import packed_index as pi
+import utils as u
+from bloom import BloomFilter, Prescreen, featureKey
+
+# Load configuration file next to this module
+# https://docs.python.org/3/library/configparser.html
+config = configparser.ConfigParser()
+config.read(
+    os.path.join(os.path.abspath(os.path.dirname(__file__)), "annotator_config.ini")
+)
+
+SNAPSHOT_DIR = os.path.expanduser(
+    config.get("ann", "SnapshotDir", fallback="~/gas/ann/anntools/snapshot")
+)
+BLOOM_FILTER_TABLES = [
+    t.strip()
+    for t in config.get("ann", "BloomFilterTables", fallback="").split(",")
+    if t.strip()
+]
+BLOOM_FILTER_ERROR_RATE = config.getfloat("ann", "BloomFilterErrorRate", fallback=0.01)
+INDEX_TABLES = [
+    t.strip()
+    for t in config.get("ann", "IndexTables", fallback="").split(",")
+    if t.strip()
+]
+PACKED_INDEX = config.getboolean("ann", "PackedIndex", fallback=True)
+
+"""Query shape of a reference table: a feature matches position pos when
+   chrom_col = chrom AND start_col <= pos AND pos <= end_col
+   chr_prefix tells whether the table stores chromosomes as "chr1" or "1",
+   binned whether it carries the UCSC bin column, and per_chrom whether it
+   is split into one table per chromosome (table name + "1", "2", ... "Y")
+"""
+
+TableSpec = namedtuple(
+    "TableSpec",
+    [
+        "table",
+        "chrom_col",
+        "start_col",
+        "end_col",
+        "chr_prefix",
+        "binned",
+        "columns",
+        "per_chrom",
+    ],
+    defaults=[True, False, "*", False],
+)
+
+TABLES = {
+    "dbSNP": TableSpec("dbSNP", "CHR", "POS", "POS", False),
+    "chrom_pos_equal_base": TableSpec(
+        "chrom_pos_equal_base", "CHR", "start", "start", False
+    ),
+    "chrom_pos_equal_nobase": TableSpec(
+        "chrom_pos_equal_nobase", "CHR", "start", "start", False
+    ),
+    "chrom_pos_unequal": TableSpec("chrom_pos_unequal", "CHR", "start", "end", False),
+    "refGene": TableSpec("refGene", "chrom", "txStart", "txEnd", True, True),
+    "cpgIslandExt": TableSpec(
+        "cpgIslandExt",
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        True,
+        True,
+        "chrom, chromStart, chromEnd, name",
+    ),
+    "cytoBand": TableSpec("cytoBand", "chrom", "chromStart", "chromEnd"),
+    "gadAll": TableSpec("gadAll", "chromosome", "chromStart", "chromEnd", False),
+    "gwasCatalog": TableSpec(
+        "gwasCatalog", "chrom", "chromEnd", "chromEnd", True, True
+    ),
+    "targetScanS": TableSpec(
+        "targetScanS", "chrom", "chromStart", "chromEnd", True, True
+    ),
+    "hugo": TableSpec("hugo", "chrom", "chromStart", "chromEnd"),
+    "genomicSuperDups": TableSpec(
+        "genomicSuperDups", "chrom", "chromStart", "chromEnd", True, True
+    ),
+    "tfbsConsSites": TableSpec(
+        "tfbsConsSites",
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        True,
+        True,
+        "chrom, chromStart, chromEnd, name",
+        True,
+    ),
+}
+
+# Every table the driver's stages query: the registered tables plus the CNV
+# tables passed to addOverlapWithCnvDatabase by name
+STAGE_TABLES = list(TABLES) + [
+    "dgv_Cnv",
+    "abParts_IG_T_CelReceptors",
+    "mcCarroll_Cnv",
+    "conrad_Cnv",
+]
+
+PER_CHROM_SUFFIXES = [str(c) for c in range(1, 23)] + ["X", "Y"]
+
+
+"""Spec for a table passed to a stage; tables not registered above (e.g. the
+   CNV tables) are treated as plain unbinned chrom/start/end tables
+"""
+
+
+def tableSpec(table, chrom_col="chrom", start_col="chromStart", end_col="chromEnd"):
+    if table in TABLES:
+        return TABLES[table]
+    return TableSpec(table, chrom_col, start_col, end_col)
+
+
+"""Physical table holding the rows for a chromosome
+"""
+
+
+def tableName(spec, chrom):
+    if spec.per_chrom:
+        return spec.table + str(chrom).replace("chr", "")
+    return spec.table
+
+
+"""All physical tables behind a spec
+"""
+
+
+def tableNames(spec):
+    if spec.per_chrom:
+        return [spec.table + c for c in PER_CHROM_SUFFIXES]
+    return [spec.table]
+
+
+def snapshotPath(name):
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+def loadManifest():
+    try:
+        with open(snapshotPath("manifest.json")) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+"""Returns a Prescreen for the table, or None when the table has no filter
+   (not configured or not present in the snapshot); stages then query as usual
+"""
+
+
+# Loaded filters are kept for the life of the process
+_blooms = {}
+
+
+def loadBloom(table):
+    if table not in _blooms:
+        path = snapshotPath(table + ".bloom")
+        if not os.path.isfile(path):
+            return None
+        _blooms[table] = BloomFilter.load(path)
+    return _blooms[table]
+
+
+def openPrescreen(table):
+    if table not in BLOOM_FILTER_TABLES:
+        return None
+    try:
+        bloom = loadBloom(table)
+    except (IOError, ValueError) as e:
+        print(f"Ignoring Bloom filter for {table}: {e}")
+        return None
+    if bloom is None:
+        return None
+    return Prescreen(table, bloom)
+
+
+"""Builds the (chrom, bin) Bloom filter for one table, streaming its rows
+"""
+
+
+def buildBloomFilter(conn, spec, error_rate=BLOOM_FILTER_ERROR_RATE):
+    capacity = 0
+    cursor = conn.cursor()
+    for table in tableNames(spec):
+        cursor.execute(f"select count(*) from {table};")
+        capacity = capacity + int(cursor.fetchone()[0])
+    cursor.close()
+
+    bloom = BloomFilter(capacity, error_rate=error_rate)
+    for table in tableNames(spec):
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(
+            f"select {spec.chrom_col}, {spec.start_col}, {spec.end_col} from {table};"
+        )
+        for chrom, start, end in cursor:
+            bloom.add(featureKey(chrom, start, end))
+        cursor.close()
+    return bloom
+
+
+"""Dumps a table's rows (as the stages select them) to a tab-separated file
+   with a header line of column names; this is what the local index loads
+"""
+
+
+def exportTable(conn, spec, path):
+    count = 0
+    tmp = path + ".tmp"
+    with open(tmp, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        header_written = False
+        for table in tableNames(spec):
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            cursor.execute(f"select {spec.columns} from {table};")
+            if not header_written:
+                writer.writerow([d[0] for d in cursor.description])
+                header_written = True
+            for row in cursor:
+                writer.writerow(
+                    [v.decode("utf-8") if isinstance(v, bytes) else str(v) for v in row]
+                )
+                count = count + 1
+            cursor.close()
+    os.replace(tmp, path)
+    return count
+
+
+"""Builds the snapshot directory; the version is the build timestamp.
+   With a list of tables only those are rebuilt and the rest of the
+   manifest is kept; names not in TABLES raise ValueError
+"""
+
+
+def buildSnapshot(tables=None):
+    unknown = [t for t in tables or [] if t not in TABLES]
+    if unknown:
+        raise ValueError(
+            f"Unknown tables: {', '.join(unknown)} "
+            + f"(registered: {', '.join(sorted(TABLES))})"
+        )
+    previous = loadManifest() if tables else None
+    if not tables:
+        tables = u.dedup(BLOOM_FILTER_TABLES + INDEX_TABLES)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    manifest = {
+        "version": time.strftime("%Y%m%d%H%M%S", time.gmtime()),
+        "built": int(time.time()),
+        "tables": previous["tables"] if previous else {},
+    }
+
+    conn = u.db_connect()
+    for table in tables:
+        spec = TABLES[table]
+        entry = {}
+        if table in BLOOM_FILTER_TABLES:
+            bloom = buildBloomFilter(conn, spec)
+            bloom.save(snapshotPath(table + ".bloom"))
+            entry["bloom"] = {
+                "keys": bloom.count,
+                "bits": bloom.num_bits,
+                "hashes": bloom.num_hashes,
+                "error_rate": bloom.error_rate,
+            }
+            print(f"{table} - {bloom.count} keys, {bloom.num_bits} bits.")
+        if table in INDEX_TABLES:
+            entry["index"] = {
+                "rows": exportTable(conn, spec, snapshotPath(table + ".tsv"))
+            }
+            print(f"{table} - {entry['index']['rows']} rows exported.")
+            if PACKED_INDEX:
+                pi.build(
+                    spec, snapshotPath(table + ".tsv"), snapshotPath(table + ".idx")
+                )
+                entry["index"]["packed"] = True
+                print(f"{table} - packed index built.")
+        manifest["tables"][table] = entry
+    conn.close()
+
+    tmp = snapshotPath("manifest.json.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp, snapshotPath("manifest.json"))
+    return manifest
+
+
+if __name__ == "__main__":
+    try:
+        buildSnapshot(sys.argv[1:] or None)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
+
+### EOF
@@ -5,6 +5,12 @@ import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 import subprocess
 import driver
+import s3_stream
+import s3_upload
+import scatter
+import checkpoint
+import profiling
+import utils as u
 import configparser
 
 #Load configuration file
@@ -22,6 +28,8 @@ ANNOTATIONS_TABLE = config.get('dynamodb', 'AnnotationsTable')
 USER_ID = config.get('gas','user_id')
 RESULTS_BUCKET_NAME = config['s3']['ResultsBucketName']
 CNET_ID = config['DEFAULT']['CnetId'] 
+# Stream the annotated output to S3 while the last stage writes it
+STREAM_OUTPUT = config.getboolean('s3', 'StreamOutput', fallback=True)
 
 class Timer(object):
     def __init__(self, verbose=True):
@@ -77,36 +85,106 @@ def delete_local_file(file_path):
     except OSError as e:
         print(f"Error: {file_path} : {e.strerror}")
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        input_file_path = sys.argv[1].strip()
-        with Timer():
-            results_file = input_file_path.replace('.vcf', '.annot.vcf')
-            log_file = input_file_path + '.count.log'
+def result_keys(input_file_path, chunk=None):
+    """Local results, log and metrics files of an input and their S3 keys; a chunk of a split job (scatter.py) goes under its parent's parts/."""
+    results_file = input_file_path.replace('.vcf', '.annot.vcf')
+    log_file = input_file_path + '.count.log'
+    metrics_file = input_file_path + '.metrics.log'
+    if chunk is not None:
+        return chunk['parent'], list(zip((results_file, log_file, metrics_file), scatter.partKeys(chunk)))
+    unique_id = os.path.basename(input_file_path).split('~')[0]
+    prefix = f"{CNET_ID}/{USER_ID}/{unique_id}"
+    return unique_id, [(f, f"{prefix}/{os.path.basename(f)}") for f in (results_file, log_file, metrics_file)]
 
-            driver.run(input_file_path, 'vcf')
+def annotate_job(input_file_path, progress=None, source=None, chunk=None):
+    """Annotate one input; progress is called with the fraction of annotation stages done.
+    With source = (bucket, key) the input is streamed from S3 and input_file_path only names the outputs;
+    with a chunk of a split job only the chunk's byte range of it is streamed.
+    Returns True when the results were streamed to S3 (multipart upload) while they were written."""
+    writers = []
 
-        # S3 Configuration
-        bucket_name = RESULTS_BUCKET_NAME
-        cnet_id = CNET_ID
-        user_prefix = USER_ID # user_id from  session
-        unique_id = os.path.basename(input_file_path).split('~')[0]
+    def open_results():
+        unique_id, files = result_keys(input_file_path, chunk)
+        writers.append(s3_upload.MultipartWriter(RESULTS_BUCKET_NAME, files[0][1]))
+        return writers[0]
 
-        s3_results_key = f"{cnet_id}/{user_prefix}/{unique_id}/{os.path.basename(results_file)}"
-        s3_log_key = f"{cnet_id}/{user_prefix}/{unique_id}/{os.path.basename(log_file)}"
+    with Timer():
+        reader = None
+        if source is not None:
+            if chunk is not None:
+                reader = s3_stream.S3LineReader(source[0], source[1], start=chunk['start'], end=chunk['end'])
+            else:
+                reader = s3_stream.S3LineReader(source[0], source[1])
+        if reader is None and chunk is None and checkpoint.enabled():
+            # Annotated in runs with a durable checkpoint after each; resumes an interrupted job
+            checkpoint.run(input_file_path, 'vcf', progress=progress)
+            return False
+        try:
+            driver.run(input_file_path, 'vcf', progress=progress, source=reader,
+                       sink=open_results if STREAM_OUTPUT else None)
+        except Exception:
+            # Never leave a partial results object (or its parts) behind
+            for writer in writers:
+                writer.abort()
+            raise
+        finally:
+            # Stops its read-ahead fetcher, which a failed stage leaves running
+            if reader is not None:
+                reader.close()
+        for writer in writers:
+            writer.close()
+            u.logStageMetrics(input_file_path, writer.stats())
+            print(f"Results streamed to {RESULTS_BUCKET_NAME}/{writer.key}")
+    return len(writers) > 0
 
-        upload_file_to_s3(results_file, bucket_name, s3_results_key)
-        upload_file_to_s3(log_file, bucket_name, s3_log_key)
+def publish_job(input_file_path, results_uploaded=False, chunk=None):
+    """Upload the results (unless annotate_job streamed them) and log files of an annotated input and record them in DynamoDB;
+    the last chunk of a split job to finish gathers the parts into the job's results."""
+    unique_id, files = result_keys(input_file_path, chunk)
+    (results_file, s3_results_key), (log_file, s3_log_key), (metrics_file, s3_metrics_key) = files
 
+    # S3 Configuration
+    bucket_name = RESULTS_BUCKET_NAME
+
+    if not results_uploaded:
+        upload_file_to_s3(results_file, bucket_name, s3_results_key)
         delete_local_file(results_file)
-        delete_local_file(log_file)
-
-        # Update DynamoDB
-        update_data = {
-            's3_results_bucket': bucket_name,
-            's3_key_result_file': s3_results_key,
-            's3_key_log_file': s3_log_key
-        }
-        update_dynamodb(unique_id, update_data)
+    upload_file_to_s3(log_file, bucket_name, s3_log_key)
+    # Per-stage job metrics are only written when a stage has something to report
+    if os.path.exists(metrics_file):
+        upload_file_to_s3(metrics_file, bucket_name, s3_metrics_key)
+        delete_local_file(metrics_file)
+    # Profile artifacts of a profiled job (profiling.py) go next to its count log
+    log_base = s3_log_key[:-len('.count.log')]
+    for profile_file in profiling.artifacts(input_file_path):
+        if os.path.exists(profile_file):
+            upload_file_to_s3(profile_file, bucket_name, log_base + profile_file[len(input_file_path):])
+            delete_local_file(profile_file)
+
+    delete_local_file(log_file)
+
+    if chunk is not None:
+        if scatter.chunkDone(chunk):
+            print(f"Gathered {chunk['count']} chunks of job {unique_id}")
+        return
+
+    # Update DynamoDB
+    update_data = {
+        's3_results_bucket': bucket_name,
+        's3_key_result_file': s3_results_key,
+        's3_key_log_file': s3_log_key
+    }
+    update_dynamodb(unique_id, update_data)
+    if checkpoint.enabled():
+        checkpoint.clear(unique_id)
+
+def run_job(input_file_path, progress=None):
+    """Annotate and publish one downloaded input; raises when a step fails."""
+    uploaded = annotate_job(input_file_path, progress=progress)
+    publish_job(input_file_path, results_uploaded=uploaded)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_job(sys.argv[1].strip())
     else:
         print("A valid .vcf file must be provided as input to this program.")
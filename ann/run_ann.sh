@@ -11,6 +11,7 @@
 
 cd /home/ubuntu/gas/ann
 source /home/ubuntu/.virtualenvs/mpcs/bin/activate
-/home/ubuntu/.virtualenvs/mpcs/bin/python /home/ubuntu/gas/ann/annotator.py
+# exec, so SIGTERM (scale-in, service stop) reaches the annotator and it drains
+exec /home/ubuntu/.virtualenvs/mpcs/bin/python /home/ubuntu/gas/ann/annotator.py
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,115 @@
+# s3_stream.py
+#
+# Line-by-line reading of an S3 object as it arrives
+#
+# S3LineReader fetches the object with ranged GETs on a background thread,
+# keeping a bounded number of chunks read ahead, and yields text lines to the
+# caller. The first annotation stage consumes it directly, so annotation
+# starts on the first bytes of the input and no local copy of the input is
+# ever written.
+#
+##
+
+import codecs
+import queue
+import threading
+import time
+
+import boto3
+
+import reference as ref
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+CHUNK_BYTES = ref.config.getint("s3", "StreamChunkBytes", fallback=8 * 1024 * 1024)
+READ_AHEAD = ref.config.getint("s3", "StreamReadAhead", fallback=4)
+
+
+"""Text lines of an S3 object; with start and end only those of bytes
+   [start, end), e.g. a chunk of a split job (see scatter.py)
+"""
+
+
+class S3LineReader(object):
+    def __init__(
+        self,
+        bucket,
+        key,
+        client=None,
+        chunk_bytes=CHUNK_BYTES,
+        read_ahead=READ_AHEAD,
+        start=0,
+        end=None,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.client = client or boto3.client("s3", region_name=AWS_REGION)
+        self.chunk_bytes = max(1, int(chunk_bytes))
+        if end is None:
+            end = self.client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.start = int(start)
+        self.end = int(end)
+        self.chunks = queue.Queue(maxsize=max(1, int(read_ahead)))
+        self.stopping = False
+        self.opened = time.perf_counter()
+        self.first_byte_seconds = None
+        self.bytes_read = 0
+        self.fetcher = threading.Thread(target=self._fetch, daemon=True)
+        self.fetcher.start()
+
+    def _fetch(self):
+        try:
+            for start in range(self.start, self.end, self.chunk_bytes):
+                if self.stopping:
+                    return
+                end = min(start + self.chunk_bytes, self.end) - 1
+                response = self.client.get_object(
+                    Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}"
+                )
+                self.chunks.put(response["Body"].read())
+            self.chunks.put(None)
+        except Exception as e:
+            self.chunks.put(e)
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = ""
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if self.first_byte_seconds is None:
+                self.first_byte_seconds = time.perf_counter() - self.opened
+            self.bytes_read = self.bytes_read + len(chunk)
+            lines = (pending + decoder.decode(chunk)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        pending = pending + decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+
+    def close(self):
+        self.stopping = True
+        # Unblock the fetcher if it waits for room in the read-ahead queue
+        while self.fetcher.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def stats(self):
+        return {
+            "stage": "input",
+            "source": f"s3://{self.bucket}/{self.key}",
+            "bytes": self.bytes_read,
+            "first_byte_seconds": (
+                round(self.first_byte_seconds, 6)
+                if self.first_byte_seconds is not None
+                else None
+            ),
+        }
+
+
+### EOF
@@ -0,0 +1,132 @@
+# s3_upload.py
+#
+# Streaming multipart upload of an S3 object as it is written
+#
+# MultipartWriter is a file-like object the last annotation stage writes its
+# output to. Completed parts are handed to a small thread pool that uploads
+# them with UploadPart while the stage keeps annotating, so by the time the
+# last line is written only the final part is left to send. close() commits
+# the object with CompleteMultipartUpload; abort() (or any failure) aborts the
+# upload so no partial object or orphaned parts are left behind.
+#
+##
+
+import concurrent.futures
+import threading
+import time
+
+import boto3
+
+import reference as ref
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+
+# S3 needs every part but the last to be at least 5 MiB
+MIN_PART_BYTES = 5 * 1024 * 1024
+PART_BYTES = ref.config.getint("s3", "UploadPartBytes", fallback=16 * 1024 * 1024)
+UPLOAD_THREADS = ref.config.getint("s3", "UploadThreads", fallback=4)
+
+
+class MultipartWriter(object):
+    def __init__(
+        self, bucket, key, client=None, part_bytes=PART_BYTES, threads=UPLOAD_THREADS
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.client = client or boto3.client("s3", region_name=AWS_REGION)
+        self.part_bytes = max(MIN_PART_BYTES, int(part_bytes))
+        self.upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+        threads = max(1, int(threads))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # Parts buffered or in flight are bounded so memory stays flat when
+        # annotation outruns the upload
+        self.slots = threading.Semaphore(2 * threads)
+        self.futures = []
+        self.buffer = bytearray()
+        self.closed = False
+        self.bytes_written = 0
+        self.wait_seconds = 0.0
+
+    def _upload(self, number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            self.slots.release()
+
+    def _flush(self):
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.wait_seconds = self.wait_seconds + time.perf_counter() - start
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.futures.append(
+            self.executor.submit(self._upload, len(self.futures) + 1, data)
+        )
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.buffer.extend(data)
+        self.bytes_written = self.bytes_written + len(data)
+        if len(self.buffer) >= self.part_bytes:
+            self._flush()
+
+    """Uploads the last part and commits the object; the upload is aborted
+       if any part failed
+    """
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An empty object is still one (empty) part
+            if self.buffer or not self.futures:
+                self._flush()
+            start = time.perf_counter()
+            parts = [future.result() for future in self.futures]
+            self.wait_seconds = self.wait_seconds + time.perf_counter() - start
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self.executor.shutdown()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+    def stats(self):
+        return {
+            "stage": "output",
+            "target": f"s3://{self.bucket}/{self.key}",
+            "bytes": self.bytes_written,
+            "parts": len(self.futures),
+            "upload_wait_seconds": round(self.wait_seconds, 6),
+        }
+
+
+### EOF
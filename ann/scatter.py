@@ -0,0 +1,335 @@
+# scatter.py
+#
+# Scatter-gather of large annotation jobs across the annotator fleet
+#
+# A huge input would keep one instance busy for hours while others sit idle.
+# The annotator that receives such a job splits it instead of running it:
+# split() cuts the input into byte ranges at line boundaries (every
+# SplitChunkBytes, or at chromosome changes once a chunk is that large) and
+# publishes one child work item per chunk to the request queue. Any
+# annotator takes a child, annotates just its range of the input and
+# uploads the part's results and count log under the parent's
+# "<prefix>/parts/". Completed chunks are recorded on the parent's job item
+# (a set, so redelivered messages count once); the annotator that completes
+# the last one runs gather(): the parts are concatenated into the job's
+# results with a server-side multipart copy, the count logs are merged and
+# the parent job is marked COMPLETED.
+#
+# Every call takes its S3 client, queue and table, so the whole flow runs
+# against the local stand-ins of local_aws.py as well.
+#
+##
+
+import json
+import re
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import reference as ref
+import s3_stream
+import s3_upload
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+ANNOTATIONS_TABLE = ref.config.get("dynamodb", "AnnotationsTable", fallback=None)
+RESULTS_BUCKET_NAME = ref.config.get("s3", "ResultsBucketName", fallback=None)
+RESULTS_PREFIX = "/".join(
+    [
+        ref.config.get("DEFAULT", "CnetId", fallback=""),
+        ref.config.get("gas", "user_id", fallback=""),
+    ]
+)
+
+# Inputs larger than SplitBytes are split (0 disables splitting) into chunks
+# of about SplitChunkBytes, cut anywhere at a line boundary ("bytes") or only
+# where the chromosome changes ("chrom")
+SPLIT_BYTES = ref.config.getint("ann", "SplitBytes", fallback=0)
+CHUNK_BYTES = ref.config.getint("ann", "SplitChunkBytes", fallback=256 * 1024 * 1024)
+SPLIT_BY = ref.config.get("ann", "SplitBy", fallback="bytes")
+
+# Release of the reference data, recorded with results for their reuse
+REFERENCE_VERSION = ref.config.get("ann", "ReferenceVersion", fallback="1")
+
+# Bytes read around a cut point to find the end of its line
+PROBE_BYTES = 64 * 1024
+
+
+def shouldSplit(data, size):
+    return SPLIT_BYTES > 0 and "chunk" not in data and size > SPLIT_BYTES
+
+
+"""Offsets of the chunk boundaries, 0 first and size last; every cut is
+   just after a newline. When cutting by chromosome, each chunk's
+   chromosomes are appended to chroms (a list) if one is given
+"""
+
+
+def cutPoints(s3, bucket, key, size, chunk_bytes=CHUNK_BYTES, by=SPLIT_BY, chroms=None):
+    chunk_bytes = max(1, int(chunk_bytes))
+    cuts = [0]
+    if by == "chrom":
+        offset = 0
+        chrom = None
+        seen = []
+        reader = s3_stream.S3LineReader(bucket, key, client=s3, end=size)
+        for line in reader:
+            if not line.startswith("#"):
+                c = line.split("\t", 1)[0].strip()
+                if (
+                    chrom is not None
+                    and c != chrom
+                    and offset - cuts[-1] >= chunk_bytes
+                ):
+                    cuts.append(offset)
+                    if chroms is not None:
+                        chroms.append(seen)
+                    seen = []
+                if c not in seen:
+                    seen.append(c)
+                chrom = c
+            offset = offset + len(line.encode("utf-8"))
+        if chroms is not None:
+            chroms.append(seen)
+    else:
+        target = chunk_bytes
+        while target < size:
+            window = PROBE_BYTES
+            while True:
+                end = min(size, target + window) - 1
+                data = s3.get_object(
+                    Bucket=bucket, Key=key, Range=f"bytes={target - 1}-{end}"
+                )["Body"].read()
+                newline = data.find(b"\n")
+                if newline >= 0:
+                    cut = target + newline
+                    break
+                if end >= size - 1:
+                    cut = size
+                    break
+                window = 2 * window
+            if cut >= size:
+                break
+            cuts.append(cut)
+            target = cut + chunk_bytes
+    cuts.append(size)
+    return cuts
+
+
+"""Keys of a chunk's results, count log and metrics under the parent's
+   results prefix
+"""
+
+
+def partKeys(chunk):
+    base = f"{chunk['prefix']}/parts/{chunk['index']:05d}"
+    return (f"{base}.annot.vcf", f"{base}.count.log", f"{base}.metrics.log")
+
+
+"""Splits the job described by data (the job request message) with an
+   input of size bytes; publishes a child work item per chunk and returns
+   the number of chunks
+"""
+
+
+def split(data, size, s3, queue, table, chunk_bytes=CHUNK_BYTES, by=SPLIT_BY):
+    job_id = data["job_id"]
+    bucket = data["s3_inputs_bucket"]
+    key = data["s3_key_input_file"]
+    chroms = []
+    cuts = cutPoints(s3, bucket, key, size, chunk_bytes, by, chroms)
+    count = len(cuts) - 1
+    input_name = key.split("/")[-1]
+
+    table.update_item(
+        Key={"job_id": job_id},
+        UpdateExpression="SET job_status = :js, chunks = :n",
+        ExpressionAttributeValues={":js": "RUNNING", ":n": count},
+    )
+    for i in range(count):
+        child = dict(data)
+        child["job_id"] = f"{job_id}-{i:05d}"
+        child["chunk"] = {
+            "parent": job_id,
+            "index": i,
+            "count": count,
+            "start": cuts[i],
+            "end": cuts[i + 1],
+            "results_bucket": RESULTS_BUCKET_NAME,
+            "prefix": f"{RESULTS_PREFIX}/{job_id}",
+            "results_name": input_name.replace(".vcf", ".annot.vcf"),
+            "log_name": input_name + ".count.log",
+            "input_hash": data.get("input_hash"),
+            # Reference shards the chunk needs, for locality routing (shards.py)
+            "chroms": chroms[i] if len(chroms) == count else [],
+            "queued": int(time.time()),
+        }
+        queue.send_message(MessageBody=json.dumps(child))
+    return count
+
+
+# Integers standing alone in a count log line ("3" in "In '3 UTR" is a name)
+NUMBER = re.compile(r"(?<![\w'.])(\d+)(?![\w.])")
+
+"""Merges the count logs of the chunks into the log of the whole input:
+   counts are summed line by line, "Total" (one more than the data lines in
+   each log) is adjusted and the dbSNP ratio recomputed from the merged
+   counts
+"""
+
+
+def mergeCountLogs(texts):
+    logs = [text.splitlines() for text in texts]
+    if len(set([len(lines) for lines in logs])) > 1:
+        raise ValueError("Count logs of the chunks do not match")
+    merged = []
+    total = None
+    for lines in zip(*logs):
+        if lines[0].startswith("##"):
+            merged.append(lines[0])
+            continue
+        if lines[0].startswith("Total:"):
+            total = sum([int(l.split(":")[1]) for l in lines]) - (len(lines) - 1)
+            merged.append(f"Total: {str(total)}")
+            continue
+        if lines[0].startswith("In dbSNP:") and total is not None:
+            count = sum([int(l.split(":")[1].split()[0]) for l in lines])
+            ratio = (count / float(total)) * 100
+            merged.append(f"In dbSNP: {str(count)} ({str(ratio)}%)")
+            continue
+        pieces = [NUMBER.split(l) for l in lines]
+        text = [p[0::2] for p in pieces]
+        if any([t != text[0] for t in text]):
+            raise ValueError(f"Count logs of the chunks do not match: {lines[0]}")
+        sums = [sum([int(p[i]) for p in pieces]) for i in range(1, len(pieces[0]), 2)]
+        line = text[0][0]
+        for n, t in zip(sums, text[0][1:]):
+            line = line + str(n) + t
+        merged.append(line)
+    return "".join([line + "\n" for line in merged])
+
+
+"""Records a chunk as done on its parent; the caller that completes the
+   last chunk gathers the job. Returns True if it did
+"""
+
+
+def chunkDone(chunk, s3=None, table=None):
+    s3 = s3 or boto3.client("s3", region_name=AWS_REGION)
+    table = table or boto3.resource("dynamodb", region_name=AWS_REGION).Table(
+        ANNOTATIONS_TABLE
+    )
+    response = table.update_item(
+        Key={"job_id": chunk["parent"]},
+        UpdateExpression="ADD chunks_done :i",
+        ExpressionAttributeValues={":i": set([chunk["index"]])},
+        ReturnValues="UPDATED_NEW",
+    )
+    if len(response["Attributes"]["chunks_done"]) < chunk["count"]:
+        return False
+    # A redelivered chunk also sees every chunk done; only one gathers
+    try:
+        table.update_item(
+            Key={"job_id": chunk["parent"]},
+            UpdateExpression="SET gathered = :t",
+            ConditionExpression="attribute_not_exists(gathered)",
+            ExpressionAttributeValues={":t": int(time.time())},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+    gather(chunk, s3, table)
+    return True
+
+
+"""Concatenates the parts into the job's results, merges the count logs,
+   marks the parent job COMPLETED and deletes the parts
+"""
+
+
+def gather(chunk, s3, table):
+    bucket = chunk["results_bucket"]
+    parts = [partKeys(dict(chunk, index=i)) for i in range(chunk["count"])]
+    results_key = f"{chunk['prefix']}/{chunk['results_name']}"
+    log_key = f"{chunk['prefix']}/{chunk['log_name']}"
+
+    sizes = [
+        s3.head_object(Bucket=bucket, Key=results)["ContentLength"]
+        for results, log, metrics in parts
+    ]
+    if all([size >= s3_upload.MIN_PART_BYTES for size in sizes[:-1]]):
+        # Every part but the last is large enough to be copied by S3 itself
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=results_key)[
+            "UploadId"
+        ]
+        try:
+            etags = []
+            for number, (results, log, metrics) in enumerate(parts, 1):
+                response = s3.upload_part_copy(
+                    Bucket=bucket,
+                    Key=results_key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    CopySource={"Bucket": bucket, "Key": results},
+                )
+                etags.append(
+                    {"PartNumber": number, "ETag": response["CopyPartResult"]["ETag"]}
+                )
+            s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=results_key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": etags},
+            )
+        except Exception:
+            s3.abort_multipart_upload(
+                Bucket=bucket, Key=results_key, UploadId=upload_id
+            )
+            raise
+    else:
+        writer = s3_upload.MultipartWriter(bucket, results_key, client=s3)
+        try:
+            for (results, log, metrics), size in zip(parts, sizes):
+                if size == 0:
+                    continue
+                for line in s3_stream.S3LineReader(
+                    bucket, results, client=s3, end=size
+                ):
+                    writer.write(line)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+    logs = [
+        s3.get_object(Bucket=bucket, Key=log)["Body"].read().decode("utf-8")
+        for results, log, metrics in parts
+    ]
+    s3.put_object(Bucket=bucket, Key=log_key, Body=mergeCountLogs(logs).encode("utf-8"))
+
+    update = "SET s3_results_bucket = :rb, s3_key_result_file = :rf, s3_key_log_file = :lf, complete_time = :ct, job_status = :js"
+    values = {
+        ":rb": bucket,
+        ":rf": results_key,
+        ":lf": log_key,
+        ":ct": int(time.time()),
+        ":js": "COMPLETED",
+    }
+    if chunk.get("input_hash"):
+        # Reusable for identical inputs, as annotator.py records for whole jobs
+        update = update + ", cache_key = :ck, reference_version = :rv"
+        values[":ck"] = f"{chunk['input_hash']}#{REFERENCE_VERSION}"
+        values[":rv"] = REFERENCE_VERSION
+    table.update_item(
+        Key={"job_id": chunk["parent"]},
+        UpdateExpression=update,
+        ExpressionAttributeValues=values,
+    )
+    # Per-chunk metrics stay under parts/ for inspection
+    for results, log, metrics in parts:
+        s3.delete_object(Bucket=bucket, Key=results)
+        s3.delete_object(Bucket=bucket, Key=log)
+
+
+### EOF
@@ -0,0 +1,201 @@
+# scatter_check.py
+#
+# End-to-end check of scatter-gather (scatter.py) on the local stand-ins
+#
+# Runs the flow of a split job against local_aws.py instead of AWS: the input
+# is put in a LocalS3 and split() into chunk messages on a LocalQueue; every
+# chunk is taken from the queue, its byte range annotated by a stand-in for
+# the stages (each data line gets one more column and the count log counts
+# the lines, as annotate.py writes it) and published with run.publish_job,
+# which records it (chunkDone) and, for the last chunk, gathers the job. The
+# job's results must be the annotated input in input order, its count log
+# the one of the whole input (mergeCountLogs) and its item COMPLETED. Both
+# ways gather() joins the parts are run: the server-side multipart copy
+# (every part but the last at least s3_upload.MIN_PART_BYTES) and the
+# re-stream of smaller parts.
+#
+# Usage:
+#   python scatter_check.py
+#
+##
+
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import types
+
+import boto3
+
+import local_aws
+import run
+import s3_stream
+import s3_upload
+import scatter
+
+INPUT_KEY = "check/input~check.vcf"
+INPUTS_BUCKET = "inputs"
+
+HEADER = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+
+"""LocalS3 counting the parts copied server-side
+"""
+
+
+class CheckS3(local_aws.LocalS3):
+    def __init__(self):
+        local_aws.LocalS3.__init__(self)
+        self.copies = 0
+
+    def upload_part_copy(self, **kwargs):
+        self.copies = self.copies + 1
+        return local_aws.LocalS3.upload_part_copy(self, **kwargs)
+
+
+"""Makes the boto3 clients and tables the modules open the stand-ins
+"""
+
+
+@contextlib.contextmanager
+def localAws(s3, table):
+    client, resource = boto3.client, boto3.resource
+    boto3.client = lambda service, **kwargs: s3
+    boto3.resource = lambda service, **kwargs: types.SimpleNamespace(
+        Table=lambda name: table
+    )
+    try:
+        yield
+    finally:
+        boto3.client, boto3.resource = client, resource
+
+
+def makeInput(variants):
+    rng = random.Random(variants)
+    lines = [HEADER]
+    pos = 0
+    for i in range(variants):
+        pos = pos + rng.randint(1, 1000)
+        chrom = str(1 + i * 3 // variants)
+        lines.append(f"{chrom}\t{pos}\trs{i}\tA\tG\t.\tPASS\tDP={rng.randint(1, 99)}\n")
+    return "".join(lines)
+
+
+def annotateLines(lines):
+    out = []
+    variants = 0
+    found = 0
+    for line in lines:
+        if line.startswith("#"):
+            out.append(line)
+            continue
+        variants = variants + 1
+        dbsnp = line.split("\t")[2].endswith("7")
+        found = found + (1 if dbsnp else 0)
+        out.append(line.rstrip("\n") + ("\tdbSNP\n" if dbsnp else "\t.\n"))
+    total = variants + 1
+    ratio = (found / float(total)) * 100
+    log = (
+        "## Please notice that all Isoforms were counted\n"
+        + f"Total: {str(total)}\n"
+        + f"In dbSNP: {str(found)} ({str(ratio)}%)\n"
+        + "Variants located:\n"
+        + f"In CDS {str(variants - found)}\n"
+        + f"In '3 UTR {str(found)}\n"
+    )
+    return "".join(out), log
+
+
+"""Annotates one chunk message's byte range into the local files
+   run.publish_job uploads
+"""
+
+
+def annotateChunk(s3, data, workdir):
+    chunk = data["chunk"]
+    path = os.path.join(workdir, f"{data['job_id']}~check.vcf")
+    reader = s3_stream.S3LineReader(
+        data["s3_inputs_bucket"],
+        data["s3_key_input_file"],
+        client=s3,
+        start=chunk["start"],
+        end=chunk["end"],
+    )
+    try:
+        results, log = annotateLines(reader)
+    finally:
+        reader.close()
+    with open(path.replace(".vcf", ".annot.vcf"), "w") as fh:
+        fh.write(results)
+    with open(path + ".count.log", "w") as fh:
+        fh.write(log)
+    return path
+
+
+def check(name, variants, chunk_bytes, copied):
+    s3 = CheckS3()
+    queue = local_aws.LocalQueue()
+    table = local_aws.LocalTable("job_id")
+    workdir = tempfile.mkdtemp(prefix="scatter_check.")
+    text = makeInput(variants)
+    s3.put_object(Bucket=INPUTS_BUCKET, Key=INPUT_KEY, Body=text)
+    data = {
+        "job_id": "check",
+        "s3_inputs_bucket": INPUTS_BUCKET,
+        "s3_key_input_file": INPUT_KEY,
+    }
+    table.put_item(Item={"job_id": "check", "job_status": "PENDING"})
+
+    try:
+        with localAws(s3, table):
+            count = scatter.split(
+                data, len(text.encode("utf-8")), s3, queue, table, chunk_bytes
+            )
+            for message in queue.receive_messages(MaxNumberOfMessages=count):
+                child = json.loads(message.body)
+                path = annotateChunk(s3, child, workdir)
+                run.publish_job(path, chunk=child["chunk"])
+                message.delete()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results, log = annotateLines(text.splitlines(True))
+    item = table.get_item(Key={"job_id": "check"})["Item"]
+    bucket = item.get("s3_results_bucket")
+    failures = []
+    if count < 2:
+        failures.append(f"split into {count} chunk")
+    if item.get("job_status") != "COMPLETED":
+        failures.append(f"job status {item.get('job_status')}")
+    elif s3.objects.get((bucket, item["s3_key_result_file"])) != results.encode():
+        failures.append("results differ from the annotated input")
+    elif s3.objects.get((bucket, item["s3_key_log_file"])) != log.encode():
+        failures.append("count log differs from the whole input's")
+    if (s3.copies > 0) != copied:
+        failures.append(f"{s3.copies} parts copied server-side")
+    if [k for b, k in s3.objects if "/parts/" in k and not k.endswith(".metrics.log")]:
+        failures.append("parts left behind")
+    print(
+        f"{name}: {count} chunks, {s3.copies} parts copied - "
+        + ("; ".join(failures) if failures else "ok")
+    )
+    return len(failures) == 0
+
+
+def main():
+    line_bytes = len(makeInput(1000)) // 1000
+    variants = 3 * s3_upload.MIN_PART_BYTES // line_bytes
+    passed = [
+        check("re-stream", 2000, 16 * 1024, False),
+        check("multipart copy", variants, s3_upload.MIN_PART_BYTES + 1, True),
+    ]
+    sys.exit(0 if all(passed) else 1)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
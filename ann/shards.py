@@ -0,0 +1,241 @@
+# shards.py
+#
+# Warm reference shards and locality routing of chunk jobs
+#
+# The local reference index is packed per chromosome (packed_index.py) and
+# memory-mapped, so the first job on an instance to touch a chromosome pays
+# for reading that shard from disk into the page cache. With ShardRouting,
+# each annotator remembers the chromosomes it annotated last (its warm
+# shards, at most WarmShards) and advertises them to the fleet in the
+# results bucket ("<prefix>/fleet/<instance>.json", refreshed every
+# ShardAdvertiseInterval seconds). Chunks of jobs split by chromosome
+# (scatter.py) carry their chromosomes. An annotator that receives a chunk
+# whose shards it does not hold, while another live instance holds more of
+# them, hands the message back for a few seconds so the warm instance can
+# take it. Once the chunk has waited ShardRouteWaitSeconds, any instance
+# takes it. An instance that takes a chunk prefetches the chunk's shards
+# into the page cache (madvise) before its worker starts on it.
+#
+##
+
+import collections
+import json
+import logging
+import socket
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import lookups as lk
+import reference as ref
+import scatter
+
+AWS_REGION = ref.config.get("aws", "AwsRegionName", fallback="us-east-1")
+
+SHARD_ROUTING = ref.config.getboolean("ann", "ShardRouting", fallback=False)
+WARM_SHARDS = ref.config.getint("ann", "WarmShards", fallback=8)
+ROUTE_WAIT = ref.config.getint("ann", "ShardRouteWaitSeconds", fallback=30)
+ADVERTISE_INTERVAL = ref.config.getint("ann", "ShardAdvertiseInterval", fallback=30)
+
+# Seconds a chunk handed back for a warmer instance stays invisible
+DEFER_VISIBILITY = 5
+
+# Advertisements older than this many intervals are from instances gone
+STALE_INTERVALS = 3
+
+
+def instanceId():
+    return socket.gethostname()
+
+
+"""Share of chroms among shards (1.0 when the chunk names no chromosomes)
+"""
+
+
+def coverage(shards, chroms):
+    if not chroms:
+        return 1.0
+    return len([c for c in chroms if c in shards]) / float(len(chroms))
+
+
+"""Reads the chromosomes' regions of the packed local indexes into the page
+   cache ahead of the job; returns the bytes advised
+"""
+
+
+def prefetch(chroms):
+    advised = 0
+    for table in ref.INDEX_TABLES:
+        spec = ref.TABLES[table]
+        index = lk.loadIndex(spec)
+        if not hasattr(index, "prefetch"):
+            continue
+        for chrom in chroms:
+            advised = advised + index.prefetch(lk.normalizeChrom(spec, chrom))
+    return advised
+
+
+"""Chromosomes most recently annotated on this instance, least recent first
+"""
+
+
+class WarmShards(object):
+    def __init__(self, capacity=WARM_SHARDS):
+        self.capacity = max(1, int(capacity))
+        self.shards = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def touch(self, chroms):
+        with self.lock:
+            for chrom in chroms:
+                self.shards[chrom] = time.time()
+                self.shards.move_to_end(chrom)
+            while len(self.shards) > self.capacity:
+                self.shards.popitem(last=False)
+
+    def list(self):
+        with self.lock:
+            return list(self.shards)
+
+
+class Router(object):
+    def __init__(
+        self,
+        s3=None,
+        bucket=None,
+        instance=None,
+        capacity=WARM_SHARDS,
+        wait=ROUTE_WAIT,
+        interval=ADVERTISE_INTERVAL,
+    ):
+        self.s3 = s3 or boto3.client("s3", region_name=AWS_REGION)
+        self.bucket = bucket or scatter.RESULTS_BUCKET_NAME
+        self.instance = instance or instanceId()
+        self.prefix = f"{scatter.RESULTS_PREFIX}/fleet/"
+        self.warm = WarmShards(capacity)
+        self.wait = wait
+        self.interval = interval
+        # instance -> warm shards, as last read from the fleet's adverts
+        self.fleet = {}
+        self.fleet_read = 0.0
+        self.taken_warm = 0
+        self.taken_cold = 0
+        self.deferred = 0
+        self.fallbacks = 0
+        self.prefetched_bytes = 0
+        self.stopping = threading.Event()
+        self.changed = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _advertise(self):
+        advert = {
+            "instance": self.instance,
+            "shards": self.warm.list(),
+            "updated": time.time(),
+            "stats": self.stats(),
+        }
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self.prefix + self.instance + ".json",
+                Body=json.dumps(advert).encode("utf-8"),
+            )
+        except ClientError as e:
+            logging.error(f"Failed to advertise warm shards: {str(e)}")
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self._advertise()
+            self.changed.wait(self.interval)
+            self.changed.clear()
+
+    """Warm shards of the other live instances, re-read at most once per
+       advertise interval
+    """
+
+    def _readFleet(self, now):
+        if now - self.fleet_read < self.interval:
+            return self.fleet
+        fleet = {}
+        try:
+            response = self.s3.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix)
+            for item in response.get("Contents", []):
+                if item["Key"] == self.prefix + self.instance + ".json":
+                    continue
+                body = self.s3.get_object(Bucket=self.bucket, Key=item["Key"])["Body"]
+                advert = json.loads(body.read().decode("utf-8"))
+                if now - advert["updated"] < STALE_INTERVALS * self.interval:
+                    fleet[advert["instance"]] = set(advert["shards"])
+        except (ClientError, ValueError, KeyError) as e:
+            logging.error(f"Failed to read the fleet's warm shards: {str(e)}")
+        self.fleet = fleet
+        self.fleet_read = now
+        return fleet
+
+    """True when the chunk should be left to a warmer instance for now
+    """
+
+    def defer(self, chunk, now=None):
+        now = now or time.time()
+        chroms = chunk.get("chroms") or []
+        local = coverage(set(self.warm.list()), chroms)
+        if local >= 1.0:
+            return False
+        best = max(
+            [coverage(shards, chroms) for shards in self._readFleet(now).values()],
+            default=0.0,
+        )
+        if best <= local:
+            return False
+        if now - chunk.get("queued", now) >= self.wait:
+            self.fallbacks = self.fallbacks + 1
+            return False
+        self.deferred = self.deferred + 1
+        return True
+
+    """Records a chunk taken by this instance and warms its shards
+    """
+
+    def taken(self, chunk):
+        chroms = chunk.get("chroms") or []
+        if not chroms:
+            return
+        if coverage(set(self.warm.list()), chroms) >= 1.0:
+            self.taken_warm = self.taken_warm + 1
+        else:
+            self.taken_cold = self.taken_cold + 1
+        try:
+            self.prefetched_bytes = self.prefetched_bytes + prefetch(chroms)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to prefetch shards {chroms}: {str(e)}")
+        self.warm.touch(chroms)
+        self.changed.set()
+
+    def stats(self):
+        return {
+            "taken_warm": self.taken_warm,
+            "taken_cold": self.taken_cold,
+            "deferred": self.deferred,
+            "fallbacks": self.fallbacks,
+            "prefetched_bytes": self.prefetched_bytes,
+        }
+
+    """Stops advertising and withdraws this instance's advert
+    """
+
+    def stop(self):
+        self.stopping.set()
+        self.changed.set()
+        self.thread.join()
+        try:
+            self.s3.delete_object(
+                Bucket=self.bucket, Key=self.prefix + self.instance + ".json"
+            )
+        except ClientError as e:
+            logging.error(f"Failed to withdraw warm shards advert: {str(e)}")
+
+
+### EOF
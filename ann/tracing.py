@@ -0,0 +1,185 @@
+# tracing.py
+#
+# End-to-end latency trace of a job
+#
+# The web app starts a job's trace when the job is submitted: it records the
+# browser's upload of the input and its own request handling as spans on
+# the job item ("trace_spans") and puts the trace context in the job request
+# message ({"trace_id", "published_ms"} under "trace"). The poller keeps the
+# spans of every traced job it admits, from the message's timestamps and its
+# own clock:
+#   sns_to_sqs   publish by the web app to the message arriving in SQS
+#   queue_wait   arrival in SQS to its receipt by this instance
+#   split        cutting a large job into chunks (scatter.py)
+#   download     download of the input to the job directory
+#   pool_wait    waiting in the pool for a worker
+#   annotate     the worker's annotation of the job, with a span per stage
+#                ("stage:<table>", from the driver's metrics record)
+#   publish      upload of the results (and, for a chunk, its gather)
+#   record       the job item's final status update in DynamoDB
+# and appends them to the job item when the job is done. Spans of a chunk go
+# on its parent's item with the chunk's index. Every span is a map of name,
+# component, start_ms and end_ms (epoch milliseconds: DynamoDB takes no
+# floats); other components append theirs to the same list.
+# util/trace_report breaks the spans of recent jobs down by phase.
+#
+##
+
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+COMPONENT = "annotator"
+
+
+def ms(t):
+    return int(t * 1000)
+
+
+def span(name, start, end, component=COMPONENT, **fields):
+    record = {
+        "name": name,
+        "component": component,
+        "start_ms": ms(start),
+        "end_ms": ms(end),
+    }
+    record.update(fields)
+    return record
+
+
+"""Appends spans to the trace of the job item job_id
+"""
+
+
+def persist(table, job_id, spans):
+    if not spans:
+        return
+    try:
+        table.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="SET trace_spans = list_append(if_not_exists(trace_spans, :empty), :spans)",
+            ExpressionAttributeValues={":empty": [], ":spans": spans},
+        )
+    except ClientError as e:
+        logging.error(f"Failed to record the trace of job {job_id}: {str(e)}")
+
+
+class Trace(object):
+    def __init__(self, item, chunk=None):
+        # The job item the spans go on and the chunk's index on it, if any
+        self.item = item
+        self.fields = {"chunk": chunk} if chunk is not None else {}
+        self.spans = []
+        self.marks = {}
+
+    def add(self, name, start, end):
+        self.spans.append(span(name, start, end, **self.fields))
+
+    def mark(self, name, t=None):
+        self.marks[name] = t or time.time()
+
+    """Adds a span from the time marked as since to end (now by default)
+    """
+
+    def since(self, name, since, end=None):
+        if since in self.marks:
+            self.add(name, self.marks[since], end or time.time())
+
+
+"""Traces of the jobs this instance holds; only jobs whose request carries
+   a trace context are traced
+"""
+
+
+class Tracer(object):
+    def __init__(self):
+        self.traces = {}
+
+    """Starts the trace of a job on receipt of its request message data;
+       sent is the time the message arrived in SQS (its SentTimestamp)
+    """
+
+    def received(self, job_id, data, sent=None, received=None):
+        context = data.get("trace")
+        if not isinstance(context, dict):
+            return None
+        received = received or time.time()
+        chunk = data.get("chunk")
+        if chunk is not None:
+            trace = Trace(chunk["parent"], chunk["index"])
+        else:
+            trace = Trace(job_id)
+        if sent is not None:
+            # A chunk's message was sent by the annotator that split the job
+            published = context.get("published_ms")
+            if chunk is None and published is not None:
+                trace.add("sns_to_sqs", published / 1000.0, sent)
+            trace.add("queue_wait", sent, received)
+        self.traces[job_id] = trace
+        return trace
+
+    def get(self, job_id):
+        return self.traces.get(job_id)
+
+    def mark(self, job_id, name, t=None):
+        trace = self.traces.get(job_id)
+        if trace is not None:
+            trace.mark(name, t)
+
+    def since(self, job_id, name, since, end=None):
+        trace = self.traces.get(job_id)
+        if trace is not None:
+            trace.since(name, since, end)
+
+    """Adds a span per annotation stage from the driver's stage_spans
+       (stage -> [start_ms, end_ms])
+    """
+
+    def stages(self, job_id, stage_spans):
+        trace = self.traces.get(job_id)
+        if trace is None or not stage_spans:
+            return
+        for stage, (start, end) in stage_spans.items():
+            trace.add("stage:" + stage, start / 1000.0, end / 1000.0)
+
+    """Adds the spans of a job's run from its outcome (a worker_pool.JobResult):
+       the wait for a worker, the annotation and the upload of its results
+    """
+
+    def ran(self, result):
+        trace = self.traces.get(result.job_id)
+        if trace is None or "submitted" not in trace.marks:
+            return
+        submitted = trace.marks["submitted"]
+        start = submitted + result.queued
+        end = start + result.seconds
+        self.stages(result.job_id, result.stage_spans)
+        if "annotated" in trace.marks:
+            annotated = trace.marks["annotated"]
+        elif result.stage_spans:
+            annotated = max([e for s, e in result.stage_spans.values()]) / 1000.0
+        else:
+            annotated = end
+        trace.add("pool_wait", submitted, start)
+        trace.add("annotate", start, annotated)
+        if annotated < end:
+            trace.add("publish", annotated, end)
+
+    """Forgets a job that was handed back without being run here
+    """
+
+    def discard(self, job_id):
+        self.traces.pop(job_id, None)
+
+    """Appends a finished job's spans to its item and forgets it
+    """
+
+    def finish(self, job_id, table):
+        trace = self.traces.pop(job_id, None)
+        if trace is not None:
+            persist(table, trace.item, trace.spans)
+        return trace
+
+
+### EOF
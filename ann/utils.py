@@ -13,29 +13,81 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import os
 import json
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+"""RDS credentials from AWS Secrets Manager, fetched once per process
+"""
+
+_rds_secret = None
+
+
+def get_rds_secret():
+    global _rds_secret
+    if _rds_secret is None:
+        AWS_REGION_NAME = (
+            os.environ["AWS_REGION_NAME"]
+            if ("AWS_REGION_NAME" in os.environ)
+            else "us-east-1"
+        )
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
+            _rds_secret = json.loads(asm_response["SecretString"])
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+    return _rds_secret
+
+
+"""Connection kept open for the life of a worker process; close() only ends
+   the current transaction so the next stage reuses the socket
+"""
+
+
+class ResidentConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        self.conn.rollback()
+
+
+_resident = None
+
+
+def keep_connection():
+    global _resident
+    if _resident is None:
+        _resident = ResidentConnection(None)
+
+
 """Get connection to reference database
+   With keep_connection() in effect, the process's main thread always gets
+   the resident connection (reconnected if the server dropped it); other
+   threads get connections of their own
 """
 
 
 def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
+    if _resident is not None and threading.current_thread() is threading.main_thread():
+        if _resident.conn is None:
+            _resident.conn = _connect()
+        else:
+            _resident.conn.ping(reconnect=True)
+        return _resident
+    return _connect()
+
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+def _connect():
+    rds_secret = get_rds_secret()
 
     # Extract database connection parameters
     rds_host = rds_secret["host"]
@@ -136,4 +188,67 @@ def parse_field(text, key, sep1, sep2):
     return "."
 
 
+"""UCSC hierarchical binning scheme (standard 512Mb address space)
+   See http://genome.ucsc.edu/goldenPath/help/hgTracksHelp.html#BinIndexing
+"""
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+
+"""Smallest bin that fully contains the half-open range [start, end)
+"""
+
+
+def binFromRange(start, end):
+    start = max(0, int(start))
+    end = max(start + 1, int(end))
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if startBin == endBin:
+            return offset + startBin
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    raise ValueError(f"Range {start}-{end} out of range for standard binning")
+
+
+"""All bins, at every level, that may hold features overlapping [start, end)
+"""
+
+
+def binsOverlapping(start, end):
+    start = max(0, int(start))
+    end = max(start + 1, int(end))
+    bins = []
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    return bins
+
+
+# Callables every stage metrics record is also handed to (a pool worker sends
+# them to the poller's /metrics endpoint)
+_metrics_sinks = []
+
+
+def addMetricsSink(sink):
+    _metrics_sinks.append(sink)
+
+
+"""Append one JSON record to the job metrics file that sits next to count.log
+"""
+
+
+def logStageMetrics(basefile, record):
+    with open(basefile + ".metrics.log", "a") as fh:
+        fh.write(json.dumps(record) + "\n")
+    for sink in _metrics_sinks:
+        sink(record)
+
+
 ### EOF
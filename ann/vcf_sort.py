@@ -0,0 +1,247 @@
+# vcf_sort.py
+#
+# External-memory coordinate sort for VCF input
+#
+# Data lines are ordered by natural chromosome order (1..22, X, Y, M, then
+# anything else alphabetically) and position. Lines are collected into runs
+# of bounded size, each run is sorted in memory and spilled to local disk,
+# and the runs are k-way merged. Header lines are kept, in order, at the top.
+#
+# The original position of every data line is recorded in an order file
+# (one 64-bit ordinal per sorted data line), so an annotated result, whose
+# data lines are in sorted order, can be put back into the user's order.
+#
+##
+
+import configparser
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+
+# Load configuration file next to this module
+config = configparser.ConfigParser()
+config.read(
+    os.path.join(os.path.abspath(os.path.dirname(__file__)), "annotator_config.ini")
+)
+
+# Sort unsorted input before annotation, and put the result back into the
+# user's line order afterwards
+SORT_INPUT = config.getboolean("ann", "SortInput", fallback=False)
+RESTORE_INPUT_ORDER = config.getboolean("ann", "RestoreInputOrder", fallback=False)
+
+# Bytes of line text held in memory per run; Python object overhead roughly
+# triples this, so the default keeps a sort within a few hundred MB
+RUN_BYTES = config.getint("ann", "SortRunBytes", fallback=64 * 1024 * 1024)
+
+# Runs merged at once; more runs are merged in several passes
+MAX_FANIN = 64
+
+# Ordinals are buffered before being appended to the order file
+ORDER_BUFFER = 65536
+
+SPECIAL_CHROMS = {"X": 23, "Y": 24, "M": 25, "MT": 25}
+
+
+"""Sort key of a chromosome name in natural order
+"""
+
+
+def chromKey(chrom):
+    c = str(chrom).strip()
+    if c.lower().startswith("chr"):
+        c = c[3:]
+    if c.isdigit():
+        return (0, int(c), "")
+    if c.upper() in SPECIAL_CHROMS:
+        return (0, SPECIAL_CHROMS[c.upper()], "")
+    return (1, 0, c)
+
+
+def positionKey(pos):
+    try:
+        return int(pos)
+    except ValueError:
+        return 0
+
+
+"""Records are "<ordinal>\\t<original line>"
+"""
+
+
+def coordinateKey(record):
+    parts = record.split("\t", 3)
+    return (chromKey(parts[1]), positionKey(parts[2]), int(parts[0]))
+
+
+def ordinalKey(record):
+    return int(record.split("\t", 1)[0])
+
+
+def _spill(records, tmpdir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+    with os.fdopen(fd, "w") as fh:
+        for record in records:
+            fh.write(record + "\n")
+    return path
+
+
+def _readRun(path):
+    with open(path) as fh:
+        for line in fh:
+            yield line.rstrip("\n")
+
+
+"""Sorts an iterator of records with bounded memory, yielding them in order
+"""
+
+
+def externalSort(records, key, tmpdir, run_bytes=RUN_BYTES):
+    runs = []
+    buf = []
+    size = 0
+    for record in records:
+        buf.append(record)
+        size = size + len(record) + 1
+        if size >= run_bytes:
+            buf.sort(key=key)
+            runs.append(_spill(buf, tmpdir))
+            buf = []
+            size = 0
+
+    buf.sort(key=key)
+    if len(runs) == 0:
+        for record in buf:
+            yield record
+        return
+    if len(buf) > 0:
+        runs.append(_spill(buf, tmpdir))
+    buf = None
+
+    while len(runs) > MAX_FANIN:
+        group = runs[:MAX_FANIN]
+        runs = runs[MAX_FANIN:]
+        runs.append(_spill(heapq.merge(*[_readRun(r) for r in group], key=key), tmpdir))
+        for r in group:
+            os.unlink(r)
+
+    for record in heapq.merge(*[_readRun(r) for r in runs], key=key):
+        yield record
+    for r in runs:
+        os.unlink(r)
+
+
+"""Writes header lines to fh_out as they are read and yields data records
+"""
+
+
+def _records(fh, fh_out):
+    ordinal = 0
+    for line in fh:
+        line = line.rstrip("\n")
+        if line.startswith("#"):
+            fh_out.write(line + "\n")
+        elif len(line.strip()) > 0:
+            yield str(ordinal) + "\t" + line
+            ordinal = ordinal + 1
+
+
+"""True when data lines are already in natural coordinate order
+"""
+
+
+def isSorted(path):
+    last = None
+    with open(path) as fh:
+        for line in fh:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            parts = line.split("\t", 2)
+            key = (chromKey(parts[0]), positionKey(parts[1]) if len(parts) > 1 else 0)
+            if last is not None and key < last:
+                return False
+            last = key
+    return True
+
+
+"""Sorts infile into outfile; with order_file, records the original ordinal
+   of each sorted data line for restoreOrder
+"""
+
+
+def sortVcf(infile, outfile, order_file=None, run_bytes=RUN_BYTES, tmpdir=None):
+    tmpdir = tempfile.mkdtemp(
+        prefix="vcfsort.", dir=tmpdir or os.path.dirname(os.path.abspath(outfile))
+    )
+    fh_order = open(order_file, "wb") if order_file else None
+    ordinals = array("q")
+    try:
+        with open(infile) as fh, open(outfile, "w") as fh_out:
+            sorted_records = externalSort(
+                _records(fh, fh_out), coordinateKey, tmpdir, run_bytes
+            )
+            for record in sorted_records:
+                ordinal, line = record.split("\t", 1)
+                fh_out.write(line + "\n")
+                if fh_order is not None:
+                    ordinals.append(int(ordinal))
+                    if len(ordinals) >= ORDER_BUFFER:
+                        ordinals.tofile(fh_order)
+                        ordinals = array("q")
+        if fh_order is not None:
+            ordinals.tofile(fh_order)
+    finally:
+        if fh_order is not None:
+            fh_order.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _ordinals(order_file):
+    with open(order_file, "rb") as fh:
+        while True:
+            chunk = array("q")
+            try:
+                chunk.fromfile(fh, ORDER_BUFFER)
+            except EOFError:
+                pass
+            if len(chunk) == 0:
+                return
+            for ordinal in chunk:
+                yield ordinal
+
+
+"""Puts the data lines of a file produced from the sorted input (same data
+   lines, same order, e.g. the annotated result) back into the original order
+"""
+
+
+def restoreOrder(infile, order_file, outfile, run_bytes=RUN_BYTES, tmpdir=None):
+    tmpdir = tempfile.mkdtemp(
+        prefix="vcfsort.", dir=tmpdir or os.path.dirname(os.path.abspath(outfile))
+    )
+    tmpout = outfile + ".restoring"
+    try:
+        with open(infile) as fh, open(tmpout, "w") as fh_out:
+            ordinals = _ordinals(order_file)
+            records = (
+                str(next(ordinals)) + "\t" + record.split("\t", 1)[1]
+                for record in _records(fh, fh_out)
+            )
+            for record in externalSort(records, ordinalKey, tmpdir, run_bytes):
+                fh_out.write(record.split("\t", 1)[1] + "\n")
+        os.replace(tmpout, outfile)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if os.path.exists(tmpout):
+            os.unlink(tmpout)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python vcf_sort.py <input.vcf> <output.vcf> [order_file]")
+        sys.exit(1)
+    sortVcf(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+
+### EOF
@@ -0,0 +1,569 @@
+# worker_pool.py
+#
+# Pre-forked pool of warm annotation workers
+#
+# The poller (annotator.py) used to start "python run.py <input>" for every
+# job, paying interpreter start-up, the boto3/pymysql/annotate imports and
+# all reference warm-up each time. The pool warms up once in the parent
+# (RDS credentials, local indexes, Bloom filters), then forks long-lived
+# workers that inherit it. Workers take jobs over a local pipe, keep a
+# resident database connection, run run.run_job in-process and report the
+# job's progress (fraction of stages done) and real outcome back to the
+# poller. With LookupBroker the pool also runs a lookup broker
+# (lookup_broker.py) that the workers send their database lookups to.
+#
+# Every worker is forked before the poller starts a thread (a child forked
+# while another thread holds a lock, botocore's or pymysql's, can deadlock
+# on it): the initial ones when the pool starts, before the lookup broker's
+# thread, and the replacements of workers that die from a zygote, a child
+# forked right after them that forks a new worker whenever the poller asks.
+#
+# Workers ignore SIGTERM, so stopping the annotator's service does not kill
+# the jobs mid-run: the poller drains the pool instead (drain(), then
+# terminate() once its deadline has passed).
+#
+##
+
+import collections
+import contextlib
+import logging
+import multiprocessing
+import multiprocessing.connection as mpc
+import multiprocessing.reduction as reduction
+import os
+import signal
+import threading
+import time
+import traceback
+
+import checkpoint
+import lookup_broker
+import lookups as lk
+import metrics
+import profiling
+import reference as ref
+import run
+import utils as u
+
+# Worker processes, i.e. jobs run at once; 0 means one per CPU
+WORKERS = ref.config.getint("ann", "Workers", fallback=0) or os.cpu_count() or 1
+
+# Upload results in the background while the worker starts its next job
+ASYNC_UPLOAD = ref.config.getboolean("ann", "AsyncUpload", fallback=True)
+
+# Coalesce the workers' database lookups in a broker in the poller process
+LOOKUP_BROKER = ref.config.getboolean("ann", "LookupBroker", fallback=False)
+
+# How often the poller checks for workers that died while waiting on a result
+REAP_INTERVAL = 5
+
+
+"""Loads what every job needs into this process before the workers fork
+"""
+
+
+def warm():
+    u.get_rds_secret()
+    for table in ref.INDEX_TABLES:
+        if lk.loadIndex(ref.TABLES[table]) is None:
+            logging.warning(f"No local index for {table} in the snapshot")
+    for table in ref.BLOOM_FILTER_TABLES:
+        ref.loadBloom(table)
+
+
+"""Uploads an annotated job's results and reports its outcome
+"""
+
+
+def _publish(send, job_id, path, start, submitted, uploaded=False, chunk=None):
+    status = "COMPLETED"
+    error = None
+    try:
+        run.publish_job(path, results_uploaded=uploaded, chunk=chunk)
+    except Exception as e:
+        status = "FAILED"
+        error = str(e)
+        traceback.print_exc()
+    send(
+        (
+            "finished",
+            job_id,
+            status,
+            error,
+            round(time.time() - start, 3),
+            round(start - submitted, 3),
+        )
+    )
+
+
+"""Worker loop: annotates in the main thread; with ASYNC_UPLOAD the upload
+   runs in a background thread and the worker reports "annotated" so it can
+   be handed the next job while the upload is still going
+"""
+
+
+def _work(conn, broker_conn=None):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: checkpoint.interrupt())
+    u.keep_connection()
+    if broker_conn is not None:
+        lk.setBroker(lookup_broker.BrokerClient(broker_conn))
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    # Stage metrics records also go to the poller's /metrics endpoint
+    u.addMetricsSink(lambda record: send(("metrics", record)))
+
+    uploads = []
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        job_id, path, submitted, source, chunk, profile = item
+        start = time.time()
+        try:
+            # Profile artifacts go next to the count log and are uploaded with it
+            capture = profiling.Capture(path) if profile else contextlib.nullcontext()
+            with capture:
+                uploaded = run.annotate_job(
+                    path,
+                    progress=lambda fraction: send(("progress", job_id, fraction)),
+                    source=source,
+                    chunk=chunk,
+                )
+        except checkpoint.Interrupted as e:
+            # Drained: the job resumes from its checkpoint on another instance
+            send(
+                (
+                    "finished",
+                    job_id,
+                    "INTERRUPTED",
+                    str(e),
+                    round(time.time() - start, 3),
+                    round(start - submitted, 3),
+                )
+            )
+            continue
+        except Exception as e:
+            traceback.print_exc()
+            send(
+                (
+                    "finished",
+                    job_id,
+                    "FAILED",
+                    str(e),
+                    round(time.time() - start, 3),
+                    round(start - submitted, 3),
+                )
+            )
+            continue
+
+        if not ASYNC_UPLOAD:
+            _publish(send, job_id, path, start, submitted, uploaded, chunk)
+            continue
+        send(("annotated", job_id))
+        upload = threading.Thread(
+            target=_publish,
+            args=(send, job_id, path, start, submitted, uploaded, chunk),
+        )
+        upload.start()
+        uploads = [t for t in uploads if t.is_alive()] + [upload]
+
+    for upload in uploads:
+        upload.join()
+
+
+"""Outcome of a job as reported to the poller
+"""
+
+
+class JobResult(object):
+    def __init__(
+        self, job_id, status, error=None, seconds=0.0, queued=0.0, stage_spans=None
+    ):
+        self.job_id = job_id
+        self.status = status
+        self.error = error
+        self.seconds = seconds
+        self.queued = queued
+        # Start and end of each annotation stage, for the job's trace
+        self.stage_spans = stage_spans
+
+
+"""Each worker has its own pipe and is handed one job at a time, so the pool
+   always knows which job a worker holds, even if it dies without a word
+"""
+
+
+"""Zygote: forks the replacement workers, each on the pipe (and broker pipe)
+   whose ends the poller sends; it was forked before the poller started any
+   thread, so the workers it forks are as warm and as safe as the first ones
+"""
+
+
+def _reapChildren(signum=None, frame=None):
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] > 0:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def _zygote(control, inherited):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Its workers are not the poller's children: reaped here, as they exit
+    signal.signal(signal.SIGCHLD, _reapChildren)
+    for conn in inherited:
+        conn.close()
+    while True:
+        try:
+            brokered = control.recv()
+        except EOFError:
+            break
+        if brokered is None:
+            break
+        conn = mpc.Connection(reduction.recv_handle(control))
+        broker_conn = None
+        if brokered:
+            broker_conn = mpc.Connection(reduction.recv_handle(control))
+        # Not reaped before its pidfd is open, so its pid is not reused yet
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGCHLD])
+            control.close()
+            code = 0
+            try:
+                _work(conn, broker_conn)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        pidfd = os.pidfd_open(pid)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGCHLD])
+        conn.close()
+        if broker_conn is not None:
+            broker_conn.close()
+        control.send(pid)
+        reduction.send_handle(control, pidfd, os.getppid())
+        os.close(pidfd)
+
+
+"""Poller's handle on a worker forked by the zygote, with the part of the
+   multiprocessing.Process interface the pool uses. It holds the worker's
+   pidfd, opened by the zygote before the worker could be reaped, and
+   signals through it, so it never reaches a process that reused the pid;
+   the exit code is the zygote's to collect, so it is unknown here
+"""
+
+
+class ZygoteWorker(object):
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.exitcode = None
+        self.sentinel = pidfd
+
+    def is_alive(self):
+        return not mpc.wait([self.sentinel], 0)
+
+    def kill(self):
+        try:
+            signal.pidfd_send_signal(self.sentinel, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def join(self, timeout=None):
+        mpc.wait([self.sentinel], timeout)
+
+    def close(self):
+        os.close(self.sentinel)
+
+
+class WorkerPool(object):
+    def __init__(self, size=WORKERS):
+        warm()
+        self.size = max(1, int(size))
+        self.ctx = multiprocessing.get_context("fork")
+        self.pending = collections.deque()
+        self.workers = {}
+        self.idle = []
+        self.running = {}
+        self.uploading = {}
+        self.progress = {}
+        self.finished = {}
+        self.annotated = []
+        self.stage_spans = {}
+        # Its thread starts once every process is forked
+        self.broker = lookup_broker.Broker() if LOOKUP_BROKER else None
+        for i in range(self.size):
+            self._spawn()
+        self.zygote = None
+        self.control = None
+        self._startZygote()
+        if self.broker is not None:
+            self.broker.start()
+
+    def _spawn(self):
+        conn, child_conn = self.ctx.Pipe()
+        broker_conn = self.broker.connect() if self.broker is not None else None
+        worker = self.ctx.Process(
+            target=_work, args=(child_conn, broker_conn), daemon=True
+        )
+        worker.start()
+        child_conn.close()
+        if broker_conn is not None:
+            broker_conn.close()
+        self._started(worker, conn)
+
+    def _started(self, worker, conn):
+        self.workers[worker.pid] = (worker, conn)
+        self.idle.append(worker.pid)
+        logging.info(f"Started annotation worker {worker.pid}")
+
+    def _startZygote(self):
+        self.control, control = self.ctx.Pipe()
+        # The poller's ends of the workers' pipes stay with the poller, or a
+        # worker would not see the poller go
+        inherited = [conn for worker, conn in self.workers.values()]
+        if self.broker is not None:
+            inherited = inherited + list(self.broker.conns)
+        self.zygote = self.ctx.Process(
+            target=_zygote, args=(control, inherited + [self.control]), daemon=True
+        )
+        self.zygote.start()
+        control.close()
+        logging.info(f"Started worker zygote {self.zygote.pid}")
+
+    """Replaces a worker that died with one forked by the zygote (the poller
+       runs threads by now, so it does not fork); if the zygote is gone, the
+       pool goes on with the workers it has left
+    """
+
+    def _respawn(self):
+        conn, child_conn = self.ctx.Pipe()
+        broker_conn = self.broker.connect() if self.broker is not None else None
+        try:
+            self.control.send(broker_conn is not None)
+            reduction.send_handle(self.control, child_conn.fileno(), self.zygote.pid)
+            if broker_conn is not None:
+                reduction.send_handle(
+                    self.control, broker_conn.fileno(), self.zygote.pid
+                )
+            pid = self.control.recv()
+            pidfd = reduction.recv_handle(self.control)
+        except (EOFError, OSError, ValueError) as e:
+            logging.error(
+                f"Cannot replace an annotation worker, zygote {self.zygote.pid} "
+                + f"is gone ({str(e)}): {len(self.workers)} workers left"
+            )
+            conn.close()
+            return
+        finally:
+            child_conn.close()
+            if broker_conn is not None:
+                broker_conn.close()
+        self._started(ZygoteWorker(pid, pidfd), conn)
+
+    """source: optional (bucket, key) to stream the input from instead of
+       reading path; chunk: the chunk of a split job the input is (scatter.py);
+       profile: annotate it under the profiler (profiling.py)
+    """
+
+    def submit(self, job_id, path, source=None, chunk=None, profile=False):
+        self.pending.append((job_id, path, time.time(), source, chunk, profile))
+        self._reap()
+        self._dispatch()
+
+    """Hands pending jobs to idle workers; a job stays pending until a worker
+       has taken it, so one sent to a worker that died while idle is handed
+       to the next (and the dead worker is replaced by _reap)
+    """
+
+    def _dispatch(self):
+        while self.pending and self.idle:
+            pid = self.idle.pop()
+            worker, conn = self.workers[pid]
+            try:
+                conn.send(self.pending[0])
+            except (OSError, ValueError) as e:
+                logging.error(f"Cannot hand a job to annotation worker {pid}: {str(e)}")
+                # Not idle any more; killed so _reap replaces it
+                worker.kill()
+                continue
+            job = self.pending.popleft()
+            self.running[pid] = job[0]
+
+    """Replaces workers that exited; a job they were running has failed
+    """
+
+    def _reap(self):
+        for pid, (worker, conn) in list(self.workers.items()):
+            if worker.is_alive():
+                continue
+            del self.workers[pid]
+            conn.close()
+            if pid in self.idle:
+                self.idle.remove(pid)
+            job_id = self.running.pop(pid, None)
+            self.progress.pop(job_id, None)
+            self.stage_spans.pop(job_id, None)
+            # Unknown for a worker the zygote forked
+            exited = "exited" + (
+                f" with code {worker.exitcode}" if worker.exitcode is not None else ""
+            )
+            logging.error(
+                f"Annotation worker {pid} {exited}"
+                + (f" while running job {job_id}" if job_id else "")
+            )
+            lost = [j for j, p in self.uploading.items() if p == pid]
+            if job_id is not None:
+                lost.append(job_id)
+            for job_id in lost:
+                self.uploading.pop(job_id, None)
+                self.finished[job_id] = JobResult(job_id, "FAILED", f"worker {exited}")
+            worker.close()
+            self._respawn()
+
+    def _collect(self, timeout):
+        pids = dict([(conn, pid) for pid, (worker, conn) in self.workers.items()])
+        sentinels = [worker.sentinel for worker, conn in self.workers.values()]
+        for ready in mpc.wait(list(pids) + sentinels, timeout):
+            if ready not in pids:
+                continue
+            try:
+                message = ready.recv()
+            except EOFError:
+                continue
+            pid = pids[ready]
+            if message[0] == "progress":
+                self.progress[message[1]] = message[2]
+                continue
+            if message[0] == "metrics":
+                metrics.recordStage(message[1])
+                if message[1].get("stage") == "driver" and pid in self.running:
+                    self.stage_spans[self.running[pid]] = message[1].get("stage_spans")
+                continue
+            if message[0] == "annotated":
+                # The worker is free again while the job's upload runs
+                self.running.pop(pid, None)
+                self.progress.pop(message[1], None)
+                self.uploading[message[1]] = pid
+                self.idle.append(pid)
+                self.annotated.append(
+                    JobResult(
+                        message[1],
+                        "ANNOTATED",
+                        stage_spans=self.stage_spans.pop(message[1], None),
+                    )
+                )
+                continue
+            job_id, status, error, seconds, queued = message[1:]
+            if self.uploading.pop(job_id, None) is None:
+                self.running.pop(pid, None)
+                self.progress.pop(job_id, None)
+                self.idle.append(pid)
+            self.finished[job_id] = JobResult(
+                job_id,
+                status,
+                error,
+                seconds,
+                queued,
+                stage_spans=self.stage_spans.pop(job_id, None),
+            )
+        self._reap()
+        self._dispatch()
+
+    """JobResults of the jobs finished so far (and, with ASYNC_UPLOAD, of jobs
+       annotated and now uploading, status ANNOTATED), waiting up to timeout
+       seconds for one when there are none
+    """
+
+    def poll(self, timeout=0):
+        if not self.finished and not self.annotated:
+            self._collect(timeout)
+        results = self.annotated + list(self.finished.values())
+        self.annotated = []
+        self.finished.clear()
+        return results
+
+    """Workers annotating a job (not counting background uploads)
+    """
+
+    def busy(self):
+        return len(self.running)
+
+    """Jobs submitted but not yet handed to a worker
+    """
+
+    def queued(self):
+        return [job[0] for job in self.pending]
+
+    """Withdraws a job not yet handed to a worker; True if it was pending
+    """
+
+    def cancel(self, job_id):
+        for job in list(self.pending):
+            if job[0] == job_id:
+                self.pending.remove(job)
+                return True
+        return False
+
+    """Stops the pool taking on work: returns the jobs not yet handed to a
+       worker and asks the running ones to stop at their next checkpoint
+    """
+
+    def drain(self):
+        cancelled = self.queued()
+        self.pending.clear()
+        for pid in self.running:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except OSError:
+                pass
+        return cancelled
+
+    """Kills the workers, running jobs and all, e.g. when a drain runs out
+       of time
+    """
+
+    def terminate(self):
+        self.zygote.kill()
+        for worker, conn in self.workers.values():
+            worker.kill()
+        for worker, conn in self.workers.values():
+            worker.join()
+            conn.close()
+        self.workers.clear()
+        self.idle = []
+        self.running.clear()
+        self.uploading.clear()
+        self.zygote.join()
+        self.control.close()
+        if self.broker is not None:
+            self.broker.stop()
+
+    def close(self):
+        for worker, conn in self.workers.values():
+            conn.send(None)
+        with contextlib.suppress(OSError, ValueError):
+            self.control.send(None)
+        for worker, conn in self.workers.values():
+            worker.join()
+            conn.close()
+        self.workers.clear()
+        self.idle = []
+        self.zygote.join()
+        self.control.close()
+        if self.broker is not None:
+            logging.info(f"Lookup broker: {self.broker.stats()}")
+            self.broker.stop()
+
+
+### EOF
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# run_scheduler.sh
+#
+# Runs the job scheduler
+#
+##
+
+cd /home/ubuntu/gas/util/scheduler
+source /home/ubuntu/.virtualenvs/mpcs/bin/activate
+/home/ubuntu/.virtualenvs/mpcs/bin/python /home/ubuntu/gas/util/scheduler/scheduler.py
+
+### EOF
@@ -0,0 +1,321 @@
+# scheduler.py
+#
+# Size- and tier-aware job scheduler in front of the annotators
+#
+# The web app's job request topic delivers to the scheduler's intake queue
+# instead of the annotators' queue. The scheduler holds each request (its
+# message stays in flight on the intake queue, its visibility extended) in
+# a lane chosen by the user's role (profile.role, premium or free) and the
+# job's input size (S3 object metadata), and forwards requests to the
+# annotators' queue only as fast as they drain it. Which request goes next
+# is decided by weighted fair sharing across the lanes (stride scheduling:
+# a lane is charged input bytes over its weight for every job it sends, so
+# backlogged lanes get annotator time in proportion to their weights) and
+# shortest job first inside a lane. Large jobs have lanes of their own, so
+# a genome never waits behind a stream of small panels forever.
+#
+# Per-lane queue times (submit to dispatch) are kept, and their percentiles
+# are written to StatsFile every StatsInterval seconds for tuning the weights.
+#
+##
+
+import boto3
+import collections
+import heapq
+import json
+import os
+import sys
+import time
+
+from botocore.exceptions import ClientError
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read("../util_config.ini")
+config.read("scheduler_config.ini")
+
+AWS_REGION = config["aws"]["AwsRegionName"]
+WAIT_TIME = config.getint("sqs", "WaitTime", fallback=20)
+MAX_MESSAGES = config.getint("sqs", "MaxMessages", fallback=10)
+
+# lane name -> weight; lanes are "<tier>_<small|large>"
+LANES = dict(
+    [
+        (lane.split(":")[0].strip(), float(lane.split(":")[1]))
+        for lane in config.get(
+            "scheduler",
+            "Lanes",
+            fallback="premium_small:8, premium_large:4, free_small:2, free_large:1",
+        ).split(",")
+        if lane.strip()
+    ]
+)
+PREMIUM_ROLES = [
+    r.strip()
+    for r in config.get("scheduler", "PremiumRoles", fallback="premium_user").split(",")
+]
+LARGE_JOB_BYTES = config.getint(
+    "scheduler", "LargeJobBytes", fallback=100 * 1024 * 1024
+)
+# Every job is charged at least this many bytes, so small jobs are not free
+MIN_JOB_BYTES = config.getint("scheduler", "MinJobBytes", fallback=1024 * 1024)
+
+# Requests are forwarded while the annotators' queue holds fewer than this
+DISPATCH_DEPTH = config.getint("scheduler", "DispatchDepth", fallback=10)
+MAX_HELD = config.getint("scheduler", "MaxHeld", fallback=1000)
+HOLD_VISIBILITY = config.getint("scheduler", "HoldVisibility", fallback=300)
+ROLE_CACHE_SECONDS = config.getint("scheduler", "RoleCacheSeconds", fallback=300)
+WAIT_SAMPLES = config.getint("scheduler", "WaitSamples", fallback=1000)
+STATS_FILE = config.get("scheduler", "StatsFile", fallback="scheduler_stats.json")
+STATS_INTERVAL = config.getint("scheduler", "StatsInterval", fallback=60)
+
+
+"""Nearest-rank percentile of a sorted list
+"""
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+class Lane(object):
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = max(float(weight), 1e-6)
+        # (size, arrival, job_id, submitted, item): shortest job first
+        self.jobs = []
+        self.pass_ = 0.0
+        self.dispatched = 0
+        self.waits = collections.deque(maxlen=WAIT_SAMPLES)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "weight": self.weight,
+            "queued": len(self.jobs),
+            "queued_bytes": sum([job[0] for job in self.jobs]),
+            "dispatched": self.dispatched,
+            "wait_p50": percentile(waits, 50),
+            "wait_p90": percentile(waits, 90),
+            "wait_p99": percentile(waits, 99),
+            "wait_max": waits[-1] if waits else None,
+        }
+
+
+"""Lanes and the choice of the next job; knows nothing of SQS
+"""
+
+
+class Scheduler(object):
+    def __init__(
+        self,
+        lanes=LANES,
+        large_bytes=LARGE_JOB_BYTES,
+        premium_roles=PREMIUM_ROLES,
+        min_bytes=MIN_JOB_BYTES,
+    ):
+        self.lanes = dict(
+            [(name, Lane(name, weight)) for name, weight in lanes.items()]
+        )
+        self.large_bytes = large_bytes
+        self.premium_roles = premium_roles
+        self.min_bytes = max(1, int(min_bytes))
+        self.vtime = 0.0
+        self.arrivals = 0
+
+    def laneFor(self, role, size):
+        tier = "premium" if role in self.premium_roles else "free"
+        name = f"{tier}_{'large' if size >= self.large_bytes else 'small'}"
+        if name not in self.lanes:
+            # A lane missing from the configuration gets the lowest weight
+            self.lanes[name] = Lane(name, 1.0)
+        return self.lanes[name]
+
+    def add(self, job_id, role, size, submitted, item):
+        lane = self.laneFor(role, size)
+        if not lane.jobs:
+            # An idle lane does not bank credit while it has nothing queued
+            lane.pass_ = max(lane.pass_, self.vtime)
+        heapq.heappush(lane.jobs, (size, self.arrivals, job_id, submitted, item))
+        self.arrivals = self.arrivals + 1
+        return lane.name
+
+    def __len__(self):
+        return sum([len(lane.jobs) for lane in self.lanes.values()])
+
+    """Takes the next job: the smallest one of the backlogged lane that is
+       furthest behind its share; returns (lane name, job_id, item) or None
+    """
+
+    def next(self, now=None):
+        backlogged = [lane for lane in self.lanes.values() if lane.jobs]
+        if not backlogged:
+            return None
+        lane = min(backlogged, key=lambda l: (l.pass_, -l.weight))
+        size, arrival, job_id, submitted, item = heapq.heappop(lane.jobs)
+        self.vtime = lane.pass_
+        lane.pass_ = lane.pass_ + max(size, self.min_bytes) / lane.weight
+        lane.dispatched = lane.dispatched + 1
+        lane.waits.append(max(0.0, (now or time.time()) - submitted))
+        return (lane.name, job_id, item)
+
+    def stats(self):
+        return dict([(name, lane.stats()) for name, lane in self.lanes.items()])
+
+
+"""Job request data of an intake message (an SNS notification or the data itself)
+"""
+
+
+def parse_message(message):
+    body = json.loads(message.body)
+    if body.get("Type") == "Notification" and "Message" in body:
+        return json.loads(body["Message"])
+    return body
+
+
+class RoleCache(object):
+    def __init__(self, seconds=ROLE_CACHE_SECONDS):
+        self.seconds = seconds
+        self.roles = {}
+
+    def get(self, user_id):
+        role, fetched = self.roles.get(user_id, (None, 0))
+        if role is not None and time.time() - fetched < self.seconds:
+            return role
+        try:
+            role = helpers.get_user_profile(id=user_id)["role"]
+        except Exception as e:
+            # Without the profile the job is scheduled as a free user's
+            print(f"Failed to get the profile of user {user_id}: {str(e)}")
+            return role or "free_user"
+        self.roles[user_id] = (role, time.time())
+        return role
+
+
+"""Receives new requests from the intake queue into the lanes
+"""
+
+
+def handle_intake_queue(intake, s3, scheduler, held, roles):
+    room = MAX_HELD - len(held)
+    if room <= 0:
+        return
+    messages = intake.receive_messages(
+        WaitTimeSeconds=WAIT_TIME if not held else 1,
+        MaxNumberOfMessages=min(MAX_MESSAGES, room),
+        VisibilityTimeout=HOLD_VISIBILITY,
+    )
+    for message in messages:
+        try:
+            data = parse_message(message)
+            job_id = data["job_id"]
+            size = s3.head_object(
+                Bucket=data["s3_inputs_bucket"], Key=data["s3_key_input_file"]
+            )["ContentLength"]
+        except (ValueError, KeyError, ClientError) as e:
+            # Let the annotators handle (and report) a request we cannot size
+            print(f"Forwarding unschedulable request as is: {str(e)}")
+            size = 0
+            job_id = message.message_id
+            data = {}
+        role = roles.get(data["user_id"]) if "user_id" in data else "free_user"
+        submitted = data.get("submit_time", time.time())
+        lane = scheduler.add(job_id, role, size, submitted, message)
+        held[job_id] = (message, time.time())
+        print(f"Queued job {job_id} ({size} bytes) in lane {lane}")
+
+
+"""Forwards jobs to the annotators' queue while it is short
+"""
+
+
+def dispatch_jobs(dispatch, scheduler, held):
+    if not len(scheduler):
+        return
+    dispatch.load()
+    depth = int(dispatch.attributes["ApproximateNumberOfMessages"])
+    while depth < DISPATCH_DEPTH:
+        job = scheduler.next()
+        if job is None:
+            break
+        lane, job_id, message = job
+        dispatch.send_message(MessageBody=message.body)
+        held.pop(job_id, None)
+        try:
+            message.delete()
+        except ClientError as e:
+            print(f"Failed to delete intake message of job {job_id}: {str(e)}")
+        depth = depth + 1
+        print(f"Dispatched job {job_id} from lane {lane}")
+
+
+"""Keeps held requests invisible on the intake queue
+"""
+
+
+def extend_held(held):
+    now = time.time()
+    for job_id, (message, extended) in list(held.items()):
+        if now - extended < HOLD_VISIBILITY / 2:
+            continue
+        try:
+            message.change_visibility(VisibilityTimeout=HOLD_VISIBILITY)
+            held[job_id] = (message, now)
+        except ClientError as e:
+            print(f"Failed to extend visibility of job {job_id}: {str(e)}")
+
+
+def write_stats(scheduler, path=STATS_FILE):
+    stats = {"time": int(time.time()), "lanes": scheduler.stats()}
+    with open(path + ".tmp", "w") as fh:
+        json.dump(stats, fh, indent=2)
+    os.replace(path + ".tmp", path)
+    for name, lane in stats["lanes"].items():
+        print(
+            f"Lane {name}: {lane['queued']} queued, {lane['dispatched']} dispatched, "
+            + f"wait p50 {lane['wait_p50']} p90 {lane['wait_p90']} p99 {lane['wait_p99']}"
+        )
+
+
+def main():
+
+    # Get handles to SQS and S3
+    sqs = boto3.resource("sqs", region_name=AWS_REGION)
+    intake = sqs.Queue(config["scheduler"]["IntakeQueueUrl"])
+    dispatch = sqs.Queue(config["scheduler"]["DispatchQueueUrl"])
+    s3 = boto3.client("s3", region_name=AWS_REGION)
+
+    scheduler = Scheduler()
+    roles = RoleCache()
+    # job_id -> (intake message, time its visibility was last extended)
+    held = {}
+    reported = time.time()
+
+    # Poll the intake queue and feed the annotators from the lanes
+    while True:
+        try:
+            handle_intake_queue(intake, s3, scheduler, held, roles)
+            dispatch_jobs(dispatch, scheduler, held)
+            extend_held(held)
+        except ClientError as e:
+            print(f"SQS client error occurred: {str(e)}")
+            time.sleep(1)
+        if time.time() - reported >= STATS_INTERVAL:
+            write_stats(scheduler)
+            reported = time.time()
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# run_trace_report.sh
+#
+# Reports the latency of recent jobs by phase
+#
+##
+
+cd /home/ubuntu/gas/util/trace_report
+source /home/ubuntu/.virtualenvs/mpcs/bin/activate
+/home/ubuntu/.virtualenvs/mpcs/bin/python /home/ubuntu/gas/util/trace_report/trace_report.py "$@"
+
+### EOF
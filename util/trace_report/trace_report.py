@@ -0,0 +1,161 @@
+# trace_report.py
+#
+# Latency of recent jobs broken down by phase
+#
+# Every component of a job's path appends timestamped spans to the job item
+# ("trace_spans": name, component, start_ms, end_ms): the web app the
+# upload and its request handling, the annotator SNS to SQS delivery, queue
+# wait, download, pool wait, annotation (and each stage), results upload
+# and the status update (ann/tracing.py). The report scans the annotations
+# table for the traced jobs submitted in the last Hours hours and gives,
+# per phase, the p50, p95 and p99 of its duration across the jobs. A
+# phase's duration in a job is from its first span's start to its last
+# span's end, so the chunks of a split job, run in parallel, count once.
+# "end_to_end" is from the first span of a job to its last.
+#
+##
+
+import boto3
+import json
+import os
+import sys
+import time
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read("../util_config.ini")
+config.read("trace_report_config.ini")
+
+AWS_REGION = config["aws"]["AwsRegionName"]
+ANNOTATIONS_TABLE = config["gas"]["AnnotationsTable"]
+HOURS = config.getfloat("trace_report", "Hours", fallback=24)
+PHASES = [
+    p.strip()
+    for p in config.get(
+        "trace_report",
+        "Phases",
+        fallback="upload, submit, sns_to_sqs, queue_wait, split, download, pool_wait, annotate, publish, record, notify",
+    ).split(",")
+    if p.strip()
+]
+REPORT_FILE = config.get("trace_report", "ReportFile", fallback="trace_report.json")
+
+
+"""Nearest-rank percentile of a sorted list
+"""
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+"""Job items with a trace submitted since the given epoch time
+"""
+
+
+def traced_jobs(table, since):
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/scan.html
+    kwargs = {
+        "FilterExpression": Attr("trace_spans").exists()
+        & Attr("submit_time").gte(int(since)),
+        "ProjectionExpression": "job_id, submit_time, trace_spans",
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            yield item
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+"""Seconds spent in each phase of one job (phase -> seconds)
+"""
+
+
+def phase_durations(spans):
+    bounds = {}
+    for span in spans:
+        name = span["name"]
+        start = int(span["start_ms"])
+        end = int(span["end_ms"])
+        first, last = bounds.get(name, (start, end))
+        bounds[name] = (min(first, start), max(last, end))
+    durations = dict(
+        [(name, max(0, end - start) / 1000.0) for name, (start, end) in bounds.items()]
+    )
+    if bounds:
+        start = min([first for first, last in bounds.values()])
+        end = max([last for first, last in bounds.values()])
+        durations["end_to_end"] = max(0, end - start) / 1000.0
+    return durations
+
+
+def report(items):
+    samples = {}
+    jobs = 0
+    for item in items:
+        jobs = jobs + 1
+        for phase, seconds in phase_durations(item["trace_spans"]).items():
+            samples.setdefault(phase, []).append(seconds)
+    stages = sorted([p for p in samples if p.startswith("stage:")])
+    others = sorted(
+        [
+            p
+            for p in samples
+            if p not in PHASES and p not in stages and p != "end_to_end"
+        ]
+    )
+    phases = {}
+    for phase in [p for p in PHASES if p in samples] + others + stages + ["end_to_end"]:
+        if phase not in samples:
+            continue
+        values = sorted(samples[phase])
+        phases[phase] = {
+            "jobs": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        }
+    return {"time": int(time.time()), "jobs": jobs, "phases": phases}
+
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else HOURS
+
+    # Get a handle to the annotations table
+    dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
+    table = dynamodb.Table(ANNOTATIONS_TABLE)
+
+    try:
+        result = report(traced_jobs(table, time.time() - hours * 3600))
+    except ClientError as e:
+        print(f"Failed to read the job traces: {str(e)}")
+        sys.exit(1)
+
+    print(
+        f"Latency of {result['jobs']} traced jobs in the last {hours} hours (seconds)"
+    )
+    print(f"{'phase':<40} {'jobs':>6} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for phase, stats in result["phases"].items():
+        print(
+            f"{phase:<40} {stats['jobs']:>6} {stats['p50']:>10.3f} "
+            + f"{stats['p95']:>10.3f} {stats['p99']:>10.3f}"
+        )
+    with open(REPORT_FILE, "w") as fh:
+        json.dump(dict(result, hours=hours), fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
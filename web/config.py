@@ -159,6 +159,19 @@ class Config(object):
 
     # AWS DynamoDB table
     AWS_DYNAMODB_ANNOTATIONS_TABLE = f"{iam_username}_annotations"
+    # Index of completed jobs by input content hash and reference version:
+    # a global secondary index of the annotations table, partition key
+    # cache_key (String), no sort key, projection ALL (see README.md);
+    # results are not reused when the table has no such index
+    AWS_DYNAMODB_CACHE_KEY_INDEX = "cache_key_index"
+
+    # Release of the reference data the annotators use (ReferenceVersion in
+    # annotator_config.ini); results are only reused within one release
+    GAS_REFERENCE_VERSION = (
+        os.environ["GAS_REFERENCE_VERSION"]
+        if ("GAS_REFERENCE_VERSION" in os.environ)
+        else "1"
+    )
 
     # Use this email address to send email via SES
     MAIL_DEFAULT_SENDER = f"{iam_username}@ucmpcs.org"
@@ -12,6 +12,7 @@ import uuid
 import time
 import json
 import boto3
+from datetime import datetime, timezone
 from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
@@ -49,12 +50,18 @@ def annotate():
         "x-amz-server-side-encryption": app.config["AWS_S3_ENCRYPTION"],
         "acl": app.config["AWS_S3_ACL"],
         "csrf_token": app.config["SECRET_KEY"],
+        # S3 computes the input's SHA-256 on upload, used to reuse results
+        "x-amz-checksum-algorithm": "SHA256",
+        # Set by the form when the upload starts, for the job's trace
+        "x-amz-meta-upload-start": "",
     }
     conditions = [
         ["starts-with", "$success_action_redirect", redirect_url],
         {"x-amz-server-side-encryption": app.config["AWS_S3_ENCRYPTION"]},
         {"acl": app.config["AWS_S3_ACL"]},
         ["starts-with", "$csrf_token", ""],
+        {"x-amz-checksum-algorithm": "SHA256"},
+        ["starts-with", "$x-amz-meta-upload-start", ""],
     ]
 
     try:
@@ -72,6 +79,142 @@ def annotate():
     return render_template("annotate.html", s3_post=presigned_post, role=session["role"])
 
 
+"""S3 metadata of an uploaded input, with its checksum
+"""
+
+
+def head_input(s3, bucket_name, s3_key):
+    # https://docs.aws.amazon.com/AmazonS3/latest/userguide/checking-object-integrity.html
+    return s3.head_object(Bucket=bucket_name, Key=s3_key, ChecksumMode="ENABLED")
+
+
+"""Content hash of an uploaded input from its S3 metadata (head_input): the
+SHA-256 checksum S3 computed on upload, else the MD5 ETag of a single-part
+upload; None when neither is available
+"""
+
+
+def input_content_hash(head):
+    if head.get("ChecksumSHA256") and "-" not in head["ChecksumSHA256"]:
+        return f"sha256:{head['ChecksumSHA256']}"
+    etag = head.get("ETag", "").strip('"')
+    if etag and "-" not in etag:
+        return f"md5:{etag}"
+    return None
+
+
+# Whether the annotations table has the cache key index; None until known
+cache_index_found = None
+
+"""True when the annotations table has the index find_reusable_result
+queries (AWS_DYNAMODB_CACHE_KEY_INDEX, see README.md); looked up once, and
+its absence logged once, as result reuse is off without it
+"""
+
+
+def cache_index_ready(table):
+    global cache_index_found
+    if cache_index_found is None:
+        name = app.config["AWS_DYNAMODB_CACHE_KEY_INDEX"]
+        indexes = dict(
+            [(i["IndexName"], i) for i in table.global_secondary_indexes or []]
+        )
+        if name not in indexes:
+            cache_index_found = False
+            app.logger.error(
+                f"Table {table.name} has no index {name}: results are not reused"
+            )
+        elif indexes[name].get("IndexStatus", "ACTIVE") == "ACTIVE":
+            cache_index_found = True
+        else:
+            # Still being built: looked up again on the next job
+            return False
+    return cache_index_found
+
+
+"""Completed job with the same input content and reference version whose
+results can be reused, or None
+"""
+
+
+def find_reusable_result(table, cache_key):
+    if not cache_index_ready(table):
+        return None
+    response = table.query(
+        IndexName=app.config["AWS_DYNAMODB_CACHE_KEY_INDEX"],
+        KeyConditionExpression=Key("cache_key").eq(cache_key),
+    )
+    for item in response["Items"]:
+        # Results archived to Glacier are no longer in S3
+        if (
+            item.get("job_status") == "COMPLETED"
+            and item.get("s3_key_result_file")
+            and not item.get("results_file_archive_id")
+        ):
+            return item
+    return None
+
+
+"""Trace span: a named phase of a job with its start and end as epoch
+milliseconds (DynamoDB takes no floats)
+"""
+
+
+def trace_span(name, start, end, component="web"):
+    return {
+        "name": name,
+        "component": component,
+        "start_ms": int(start * 1000),
+        "end_ms": int(end * 1000),
+    }
+
+
+"""Span of the browser's upload of the input: from the start time the form
+stored in the object's metadata to the object's creation in S3
+"""
+
+
+def upload_span(head):
+    started = head.get("Metadata", {}).get("upload-start", "")
+    if not started.isdigit() or "LastModified" not in head:
+        return None
+    return trace_span(
+        "upload", int(started) / 1000.0, head["LastModified"].timestamp()
+    )
+
+
+"""Satisfies a new job with server-side copies of an earlier job's result
+and log files; returns the job item fields for the copies
+"""
+
+
+def reuse_result(s3, source, job_id, user_id, input_filename):
+    bucket = app.config["AWS_S3_RESULTS_BUCKET"]
+    prefix = f"{app.config['AWS_S3_KEY_PREFIX']}{user_id}/{job_id}"
+    results_key = f"{prefix}/{job_id}~{input_filename}".replace(".vcf", ".annot.vcf")
+    log_key = f"{prefix}/{job_id}~{input_filename}.count.log"
+
+    # Managed copy: done by S3 itself, in parts for large objects
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+    for source_key, key in [
+        (source["s3_key_result_file"], results_key),
+        (source["s3_key_log_file"], log_key),
+    ]:
+        s3.copy(
+            {"Bucket": source["s3_results_bucket"], "Key": source_key}, bucket, key
+        )
+    return {
+        "s3_results_bucket": bucket,
+        "s3_key_result_file": results_key,
+        "s3_key_log_file": log_key,
+        "complete_time": int(time.time()),
+        "job_status": "COMPLETED",
+        "cache_hit": True,
+        "cache_source_job_id": source["job_id"],
+        "cache_key": source["cache_key"],
+    }
+
+
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -85,6 +228,12 @@ homework assignments
 @app.route("/annotate/job", methods=["GET"])
 @authenticated
 def create_annotation_job_request():
+    # The job's trace starts with this request; its context rides in the
+    # job request message and every component adds spans to the job item
+    received = time.time()
+    trace = {"trace_id": uuid.uuid4().hex}
+    spans = []
+
     # access value in config.py
     # https://flask.palletsprojects.com/en/3.0.x/config/
     region = app.config["AWS_REGION_NAME"]
@@ -109,12 +258,42 @@ def create_annotation_job_request():
         "job_status": "PENDING"
     }
 
+    # Reuse the results of an identical input annotated with the same
+    # reference data instead of annotating it again
+    s3 = boto3.client('s3', region_name=region)
+    try:
+        head = head_input(s3, bucket_name, s3_key)
+        span = upload_span(head)
+        if span is not None:
+            spans.append(span)
+        content_hash = input_content_hash(head)
+        if content_hash is not None:
+            data["input_hash"] = content_hash
+            source = find_reusable_result(
+                table, f"{content_hash}#{app.config['GAS_REFERENCE_VERSION']}"
+            )
+            if source is not None:
+                reused = reuse_result(s3, source, job_id, user_id, input_filename)
+                spans.append(trace_span("submit", received, time.time()))
+                table.put_item(
+                    Item=dict(data, trace=trace, trace_spans=spans, **reused)
+                )
+                app.logger.info(f"Job {job_id} reused the results of job {source['job_id']}")
+                return render_template("annotate_confirm.html", job_id=job_id)
+    except ClientError as e:
+        # Not fatal: the job is annotated as usual
+        app.logger.warning(f"Unable to reuse results for job {job_id}: {e}")
+    data["cache_hit"] = False
+    spans.append(trace_span("submit", received, time.time()))
+
     try:
-        table.put_item(Item=data)
+        table.put_item(Item=dict(data, trace=trace, trace_spans=spans))
     except ClientError as e:
         app.logger.error(f"Error writing to DynamoDB: {e}")
         return abort(500)  # Server error page if DynamoDB write fails
 
+    # The annotator measures SNS to SQS delivery from the publish time
+    data["trace"] = dict(trace, published_ms=int(time.time() * 1000))
     try:
         sns_client = boto3.client('sns', region_name=region)
         sns_client.publish(